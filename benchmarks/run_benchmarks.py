@@ -0,0 +1,222 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate_inputs
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+STEPS = ['gen_mzml_tims_sage_msdt', 'gen_mzml_fragpipe_msdt', 'mgf_to_parquet', 'msdt2mgf']
+mgf_field_types = {"TITLE": "string", "PEPMASS": "float", "CHARGE": "int", "RTINSECONDS": "float", "SCANS": "string"}
+
+
+def count_spectra(step, paths):
+    if step == 'mgf_to_parquet':
+        with open(paths['mgf'], 'rb') as f:
+            return sum(line.startswith(b'BEGIN IONS') for line in f)
+    with open(paths['rawspectrum'], 'rb') as f:
+        return sum(1 for _ in f) - 1
+
+
+def step_io(step, paths, work_dir):
+    """Input files and output path of a benchmarked step."""
+    if step == 'gen_mzml_tims_sage_msdt':
+        return [paths['rawspectrum'], paths['sage']], os.path.join(work_dir, 'sage_msdt.parquet')
+    if step == 'gen_mzml_fragpipe_msdt':
+        return [paths['rawspectrum'], paths['fragpipe']], os.path.join(work_dir, 'fp_msdt.parquet')
+    if step == 'mgf_to_parquet':
+        return [paths['mgf']], os.path.join(work_dir, 'mgf.parquet')
+    return [os.path.join(work_dir, 'sage_msdt.parquet')], os.path.join(work_dir, 'sage_msdt.mgf')
+
+
+def run_step(step, paths, work_dir):
+    """Run one step in this (fresh) process and measure it."""
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    from scripts import step_cache
+    from scripts.generate_msdt import gen_mzml_tims_sage_msdt, gen_mzml_fragpipe_msdt
+    from scripts.mgf2parquet import mgf_to_parquet
+    from scripts.msdt2mgf import msdt2mgf
+
+    inputs, output = step_io(step, paths, work_dir)
+    step_cache.invalidate(output)
+    calls = {
+        'gen_mzml_tims_sage_msdt': lambda: gen_mzml_tims_sage_msdt(paths['rawspectrum'], paths['sage'], output, True),
+        'gen_mzml_fragpipe_msdt': lambda: gen_mzml_fragpipe_msdt(paths['rawspectrum'], paths['fragpipe'], output, True),
+        'mgf_to_parquet': lambda: mgf_to_parquet({'mgf_path': paths['mgf'], 'output_path': output, 'field_type_dict': mgf_field_types}),
+        'msdt2mgf': lambda: msdt2mgf({'msdt_path': inputs[0], 'output_path': output})
+    }
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    state = calls[step]()
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    return {
+        'state': state,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'input_mb': sum(os.path.getsize(path) for path in inputs) / (1 << 20),
+        'output_mb': os.path.getsize(output) / (1 << 20) if os.path.exists(output) else 0
+    }
+
+
+def measure(step, paths, work_dir):
+    """Run a step in its own spawned process so peak RSS and imports do not carry over between steps."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_step, step, paths, work_dir).result()
+
+
+def benchmark_profiles(msdt_path, profiles, work_dir, repeat):
+    """Rewrite an MSDT file with every write profile and measure its size, write time and decode throughput."""
+    import pyarrow.parquet as pq
+    from scripts import parquet_profiles
+
+    table = pq.read_table(msdt_path)
+    results = []
+    for profile in profiles:
+        profile = None if profile == 'default' else profile
+        path = os.path.join(work_dir, f"profile_{profile or 'default'}.parquet")
+        writes, reads, peak_reads = [], [], []
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            pq.write_table(table, path, row_group_size=4096, **parquet_profiles.writer_kwargs(profile, table.schema))
+            writes.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            pq.read_table(path)
+            reads.append(time.perf_counter() - start)
+            # what a training data loader reads
+            start = time.perf_counter()
+            pq.read_table(path, columns=['scan', 'mz_array', 'intensity_array'])
+            peak_reads.append(time.perf_counter() - start)
+        result = {
+            'profile': profile or 'default',
+            'size_mb': os.path.getsize(path) / (1 << 20),
+            'write_s': min(writes),
+            'read_s': min(reads),
+            'spectra_per_s': table.num_rows / min(reads) if min(reads) else 0,
+            'peak_read_s': min(peak_reads),
+            'decoded_mb_per_s': table.nbytes / (1 << 20) / min(reads) if min(reads) else 0
+        }
+        results.append(result)
+        logger.info(f"profile {result['profile']}: {result['size_mb']:.1f} MB, write {result['write_s']:.2f}s, "
+                    f"read {result['read_s']:.3f}s ({result['decoded_mb_per_s']:.0f} MB/s decoded), peaks {result['peak_read_s']:.3f}s")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def library_versions():
+    import numpy, pandas, pyarrow
+    return {'python': platform.python_version(), 'numpy': numpy.__version__,
+            'pandas': pandas.__version__, 'pyarrow': pyarrow.__version__}
+
+
+def compare(results, previous_path, tolerance):
+    """Log the wall time of every step against an earlier result file."""
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = {r['step']: r for r in json.load(f)['results']}
+    for result in results:
+        before = previous.get(result['step'])
+        if before is None or not before['wall_s']:
+            continue
+        ratio = result['wall_s'] / before['wall_s']
+        message = f"{result['step']}: {before['wall_s']:.2f}s -> {result['wall_s']:.2f}s ({ratio:.2f}x)"
+        if ratio > 1 + tolerance:
+            logger.warning(f"Regression {message}")
+        else:
+            logger.info(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversion steps on synthetic data")
+    parser.add_argument('-spectra', type=int, default=20000, help="spectra per synthetic run")
+    parser.add_argument('-mean_peaks', type=int, default=150, help="mean peaks per spectrum")
+    parser.add_argument('-psms_per_spectrum', type=float, default=1.5, help="Sage PSM rows per spectrum")
+    parser.add_argument('-steps', type=str, default=','.join(STEPS), help="comma separated steps to time")
+    parser.add_argument('-repeat', type=int, default=1, help="runs per step, the fastest is reported")
+    parser.add_argument('-seed', type=int, default=0)
+    parser.add_argument('-data_dir', type=str, default='benchmarks/data', help="synthetic inputs, reused across runs")
+    parser.add_argument('-work_dir', type=str, default='benchmarks/work', help="step outputs")
+    parser.add_argument('-output', type=str, default='', help="result json (default benchmarks/results/<time>.json)")
+    parser.add_argument('-profiles', type=str, default='default,fast-write,small,training-read',
+                        help="comma separated Parquet write profiles to compare on the Sage MSDT file ('' skips)")
+    parser.add_argument('-compare', type=str, default='', help="earlier result json to compare against")
+    parser.add_argument('-tolerance', type=float, default=0.1, help="slowdown reported as regression")
+    args = parser.parse_args()
+
+    steps = [step for step in args.steps.split(',') if step]
+    unknown = set(steps) - set(STEPS)
+    if unknown:
+        parser.error(f"Unknown steps: {', '.join(sorted(unknown))}")
+
+    paths = generate_inputs(args.data_dir, spectra=args.spectra, mean_peaks=args.mean_peaks,
+                            psms_per_spectrum=args.psms_per_spectrum, seed=args.seed)
+    os.makedirs(args.work_dir, exist_ok=True)
+    profiles = [profile for profile in args.profiles.split(',') if profile]
+    if (profiles or 'msdt2mgf' in steps) and 'gen_mzml_tims_sage_msdt' not in steps:
+        # msdt2mgf and the profile comparison read the Sage MSDT file
+        measure('gen_mzml_tims_sage_msdt', paths, args.work_dir)
+
+    results = []
+    for step in STEPS:
+        if step not in steps:
+            continue
+        runs = [measure(step, paths, args.work_dir) for _ in range(max(1, args.repeat))]
+        best = min(runs, key=lambda run: run['wall_s'])
+        spectra = count_spectra(step, paths)
+        result = {
+            'step': step,
+            **best,
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+            'spectra': spectra,
+            'spectra_per_s': spectra / best['wall_s'] if best['wall_s'] else 0,
+            'mb_per_s': best['input_mb'] / best['wall_s'] if best['wall_s'] else 0
+        }
+        results.append(result)
+        logger.info(f"{step}: state {result['state']}, {result['wall_s']:.2f}s wall, {result['cpu_s']:.2f}s cpu, "
+                    f"{result['spectra_per_s']:.0f} spectra/s, {result['mb_per_s']:.1f} MB/s, {result['peak_rss_mb']:.0f} MB peak RSS")
+
+    profile_results = []
+    if profiles:
+        profile_results = benchmark_profiles(os.path.join(args.work_dir, 'sage_msdt.parquet'), profiles, args.work_dir, args.repeat)
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': git_commit(),
+        'host': {'platform': platform.platform(), 'cpus': os.cpu_count(), **library_versions()},
+        'settings': {'spectra': args.spectra, 'mean_peaks': args.mean_peaks,
+                     'psms_per_spectrum': args.psms_per_spectrum, 'repeat': args.repeat, 'seed': args.seed},
+        'results': results,
+        'profiles': profile_results
+    }
+    output = args.output or os.path.join('benchmarks', 'results', f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    logger.info(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
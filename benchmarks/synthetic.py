@@ -0,0 +1,123 @@
+import logging
+import os
+import numpy as np
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+amino_acids = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+sage_columns = ['psm_id', 'peptide', 'proteins', 'scannr', 'label', 'matched_peaks', 'peptide_q', 'protein_q', 'charge',
+                'predicted_rt', 'ion_mobility', 'delta_rt_model', 'sage_discriminant_score', 'spectrum_q', 'filename']
+pin_columns = ['SpecId', 'Label', 'ScanNr', 'ExpMass', 'retentiontime', 'rank', 'isotope_errors', 'hyperscore',
+               'delta_hyperscore', 'matched_ion_num', 'ion_series', 'unweighted_spectral_entropy', 'delta_RT_loess',
+               'Peptide', 'Proteins']
+
+
+def random_peptides(rng, count, sage_style):
+    """Tryptic-looking peptides with the modifications each search engine writes."""
+    peptides = []
+    for length in rng.integers(7, 35, count):
+        peptide = ''.join(rng.choice(amino_acids, length)) + rng.choice(['K', 'R'])
+        if sage_style:
+            peptide = peptide.replace('C', 'C[+57.0216]').replace('M', 'M[+15.9949]', 1)
+            if rng.random() < 0.2:
+                peptide = '[+42]-' + peptide
+        else:
+            peptide = peptide.replace('C', 'C[57.0215]').replace('M', 'M[15.9949]', 1)
+            if rng.random() < 0.2:
+                peptide = 'n[42.0106]' + peptide
+        peptides.append(peptide)
+    return peptides
+
+
+def peak_counts(rng, spectra, mean_peaks):
+    return np.maximum(1, rng.poisson(mean_peaks, spectra))
+
+
+def write_rawspectrum(path, rng, spectra, mean_peaks):
+    """Rawspectrum TSV as written by linux_mzml_rawspectrum: one MS2 spectrum per row, comma-joined peaks."""
+    counts = peak_counts(rng, spectra, mean_peaks)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    mz = rng.uniform(100, 2000, offsets[-1]).tolist()
+    intensity = rng.uniform(1, 1e6, offsets[-1]).tolist()
+    precursor_mz = rng.uniform(300, 1500, spectra)
+    rt = np.sort(rng.uniform(0, 120, spectra))
+    charge = rng.integers(2, 5, spectra)
+    with open(path, 'w', buffering=1 << 20) as f:
+        f.write('scan\tprecursor_mz\tcharge\trt\tmz_array\tintensity_array\n')
+        for i in range(spectra):
+            first, last = offsets[i], offsets[i + 1]
+            f.write(f"{i + 1}\t{precursor_mz[i]:.5f}\t{charge[i]}\t{rt[i]:.4f}\t"
+                    f"{('%.4f,' * (last - first))[:-1] % tuple(sorted(mz[first:last]))}\t"
+                    f"{('%.1f,' * (last - first))[:-1] % tuple(intensity[first:last])}\n")
+
+
+def write_sage_results(path, rng, spectra, psms_per_spectrum):
+    """results.sage.tsv with several candidate PSMs per scan, about a third of them decoys."""
+    psms = int(spectra * psms_per_spectrum)
+    peptides = random_peptides(rng, max(1, psms // 2), sage_style=True)
+    scans = rng.integers(1, spectra + 1, psms)
+    labels = np.where(rng.random(psms) < 0.7, 1, -1)
+    with open(path, 'w', buffering=1 << 20) as f:
+        f.write('\t'.join(sage_columns) + '\n')
+        for i in range(psms):
+            f.write(f"{i}\t{peptides[rng.integers(len(peptides))]}\tsp|P{i % 5000}|PROT_HUMAN\t"
+                    f"controllerType=0 controllerNumber=1 scan={scans[i]}\t{labels[i]}\t{rng.integers(1, 40)}\t"
+                    f"{rng.random() / 50:.6f}\t{rng.random() / 50:.6f}\t{rng.integers(1, 7)}\t{rng.random():.6f}\t"
+                    f"\t{rng.random():.6f}\t{rng.normal():.6f}\t{rng.random() / 50:.6f}\tsynthetic.mzML\n")
+
+
+def write_fragpipe_pin(path, rng, spectra, identified_fraction):
+    """FragPipe _edited.pin with at most one PSM per scan."""
+    scans = np.sort(rng.choice(np.arange(1, spectra + 1), int(spectra * identified_fraction), replace=False))
+    peptides = random_peptides(rng, len(scans), sage_style=False)
+    with open(path, 'w', buffering=1 << 20) as f:
+        f.write('\t'.join(pin_columns) + '\n')
+        for scan, peptide in zip(scans, peptides):
+            charge = rng.integers(2, 5)
+            f.write(f"synthetic.{scan}.{scan}.{charge}_1\t{rng.choice([1, -1])}\t{scan}\t{rng.uniform(500, 4000):.4f}\t"
+                    f"{rng.uniform(0, 7200):.2f}\t1\t0\t{rng.uniform(0, 60):.3f}\t{rng.random():.4f}\t{rng.integers(1, 40)}\t"
+                    f"2\t{rng.random():.4f}\t{rng.random():.4f}\tK.{peptide}.R\tsp|P{scan % 5000}|PROT_HUMAN\n")
+
+
+def write_mgf(path, rng, spectra, mean_peaks):
+    counts = peak_counts(rng, spectra, mean_peaks)
+    with open(path, 'w', buffering=1 << 20) as f:
+        f.write('COM=synthetic benchmark\n')
+        for i, count in enumerate(counts, start=1):
+            peaks = np.empty(2 * count)
+            peaks[0::2] = np.sort(rng.uniform(100, 2000, count))
+            peaks[1::2] = rng.uniform(1, 1e6, count)
+            f.write(f"BEGIN IONS\nTITLE=synthetic.{i}.{i}.2\nPEPMASS={rng.uniform(300, 1500):.5f} {rng.uniform(1, 1e7):.1f}\n"
+                    f"CHARGE={rng.integers(1, 5)}+\nRTINSECONDS={rng.uniform(0, 7200):.3f}\nSCANS={i}\n")
+            f.write(("%.5f %.2f\n" * count) % tuple(peaks.tolist()))
+            f.write("END IONS\n\n")
+
+
+def generate_inputs(out_dir, spectra=20000, mean_peaks=150, psms_per_spectrum=1.5, identified_fraction=0.5, seed=0):
+    """
+    Write a synthetic run into out_dir and return the paths of its files.
+    Files that already exist for the same settings are reused.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tag = f"{spectra}_{mean_peaks}_{seed}"
+    paths = {
+        'rawspectrum': os.path.join(out_dir, f"synthetic_{tag}_rawspectrum.tsv"),
+        'sage': os.path.join(out_dir, f"synthetic_{tag}_{psms_per_spectrum}_results.sage.tsv"),
+        'fragpipe': os.path.join(out_dir, f"synthetic_{tag}_{identified_fraction}_edited.pin"),
+        'mgf': os.path.join(out_dir, f"synthetic_{tag}.mgf")
+    }
+    writers = {
+        'rawspectrum': lambda path, rng: write_rawspectrum(path, rng, spectra, mean_peaks),
+        'sage': lambda path, rng: write_sage_results(path, rng, spectra, psms_per_spectrum),
+        'fragpipe': lambda path, rng: write_fragpipe_pin(path, rng, spectra, identified_fraction),
+        'mgf': lambda path, rng: write_mgf(path, rng, spectra, mean_peaks)
+    }
+    for i, (name, path) in enumerate(paths.items()):
+        if os.path.exists(path):
+            continue
+        logger.info(f"Generating {path}")
+        temp_path = path + '.tmp'
+        writers[name](temp_path, np.random.default_rng([seed, i]))
+        os.replace(temp_path, path)
+    return paths
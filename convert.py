@@ -7,12 +7,15 @@ import numpy as np
 import re
 import json
 import logging
+import time
 
 from scripts.generate_rawspectrum import generate_rawspectrum_fn
-from scripts.generate_msdt import generate_msdt_fn
+from scripts.generate_msdt import generate_msdt_fn, collect_runs, convert_run, configure_writer
 from scripts.mgf2parquet import mgf_to_parquet
-from scripts.search_engine import generate_sage_search_result_fn, generate_fp_search_result_fn
+from scripts.search_engine import generate_sage_search_result_fn, generate_fp_search_result_fn, sage_output_path
 from scripts.msdt2mgf import msdt2mgf
+from scripts import step_cache, rawspectrum_reader, telemetry, pipeline, scan_join, msdt_dataset, work_queue
+from scripts.scheduler import Step, link_steps, split_threads, run_steps
 
 
 # Configure logging
@@ -24,6 +27,7 @@ logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-config', type=str, default="", help="convert config json")
+parser.add_argument('-worker', action='store_true', help="claim the generate_msdt batch runs from a work queue shared with other workers")
 args = parser.parse_args()
 
 def load_config(config_path: str):
@@ -59,7 +63,9 @@ def parse_config(cfg: dict):
         steps["generate_rawspectrum"] = {
             "data_type": cfg["generate_rawspectrum"]["data_type"],
             "input": cfg["generate_rawspectrum"]["data_path"],
-            "output": cfg["generate_rawspectrum"]["output"]
+            "output": cfg["generate_rawspectrum"]["output"],
+            "fused": cfg["generate_rawspectrum"].get("fused", False),
+            "keep_tsv": cfg["generate_rawspectrum"].get("keep_tsv", False)
         }
 
     # Step 2_1: generate sage search result
@@ -67,7 +73,8 @@ def parse_config(cfg: dict):
         steps['generate_sage_search_result'] = {
             'workdir': cfg["generate_sage_search_result"]['workdir'],
             'fasta': cfg["generate_sage_search_result"]['fasta'],
-            'data_path': cfg["generate_sage_search_result"]['data_path'],
+            'data_path': cfg["generate_sage_search_result"].get('data_path'),
+            'data_paths': cfg["generate_sage_search_result"].get('data_paths', []),
             'config_path': cfg["generate_sage_search_result"]['config_path']
         }
 
@@ -78,9 +85,12 @@ def parse_config(cfg: dict):
     # Step 3: generate_msdt
     if cfg.get("generate_msdt", {}).get("need", False) == True:
         steps["generate_msdt"] = {
-            "tims": cfg["generate_msdt"]["tims"],
-            "mzml": cfg["generate_msdt"]["mzml"],
-            "wiff": cfg["generate_msdt"]["wiff"]
+            "tims": cfg["generate_msdt"].get("tims", {}),
+            "mzml": cfg["generate_msdt"].get("mzml", {}),
+            "wiff": cfg["generate_msdt"].get("wiff", {}),
+            "batch": cfg["generate_msdt"].get("batch", {}),
+            "writer": cfg["generate_msdt"].get("writer", {}),
+            "join": cfg["generate_msdt"].get("join", {})
         }
 
     # Step 4: convert_2_msdt
@@ -93,14 +103,137 @@ def parse_config(cfg: dict):
     if cfg.get("msdt_2_mgf", {}).get("need", False) == True:
         steps["msdt2mgf"] = {
             "msdt_path": cfg["msdt_2_mgf"]["msdt_path"],
-            "output_path": cfg["msdt_2_mgf"]["output_path"]
+            "output_path": cfg["msdt_2_mgf"]["output_path"],
+            "workers": cfg["msdt_2_mgf"].get("workers", 1),
+            "batch_size": cfg["msdt_2_mgf"].get("batch_size", 4096)
         }
 
     return steps
 
+def build_step_graph(steps):
+    """
+    Turn the configured steps into scheduler steps with their input and output paths.
+    generate_msdt is split per data type / search engine so each MSDT file starts
+    as soon as its own rawspectrum and search result are ready.
+    """
+    graph = []
+    if "generate_rawspectrum" in steps and not steps["generate_rawspectrum"]["fused"]:
+        param = steps["generate_rawspectrum"]
+        graph.append(Step("generate_rawspectrum", generate_rawspectrum_fn, param,
+                          inputs=[param["input"]], outputs=[param["output"]]))
+
+    if "generate_sage_search_result" in steps:
+        param = steps["generate_sage_search_result"]
+        # data_paths searches several runs in one Sage invocation
+        data_paths = param["data_paths"] or [param["data_path"]]
+        graph.append(Step("generate_sage_search_result", generate_sage_search_result_fn, param,
+                          inputs=data_paths + [param["fasta"], param["config_path"]],
+                          outputs=[sage_output_path(param["workdir"], path) for path in data_paths], threaded=True))
+
+    if "generate_fragpipe_search_result" in steps:
+        param = steps["generate_fragpipe_search_result"]
+        # data_paths searches several runs in one FragPipe invocation
+        graph.append(Step("generate_fragpipe_search_result", generate_fp_search_result_fn, param,
+                          inputs=(param.get("data_paths") or [param["data_path"]]) + [param["workflow_path"]],
+                          outputs=[param["workdir"]], threaded=True))
+
+    if "generate_msdt" in steps:
+        param = steps["generate_msdt"]
+        tims, mzml, wiff = param["tims"], param["mzml"], param["wiff"]
+        # in fused mode the MSDT steps reading the rawspectrum output run the extractor instead of reading the TSV
+        rawspectrum = steps.get("generate_rawspectrum", {})
+        if rawspectrum.get("fused"):
+            fused = rawspectrum_reader.fused_spec(rawspectrum["data_type"], rawspectrum["input"], rawspectrum["keep_tsv"])
+            tims, mzml, wiff = [{**section, "fused": fused}
+                                if os.path.normpath(section.get("rawspectrum_path") or "") == os.path.normpath(rawspectrum["output"])
+                                else section for section in (tims, mzml, wiff)]
+        # every MSDT step gets the shared writer and scan join settings
+        shared = {"writer": param["writer"], "join": param["join"]}
+        if tims.get("need_tims"):
+            graph.append(Step("generate_msdt:tims", generate_msdt_fn, {"tims": tims, **shared},
+                              inputs=[rawspectrum_reader.source_path(tims["rawspectrum_path"], tims.get("fused")),
+                                      tims["sage_search_result_path"]],
+                              outputs=[tims["output"]]))
+        if mzml.get("need_mzml") and mzml.get("need_sage"):
+            graph.append(Step("generate_msdt:mzml_sage", generate_msdt_fn, {"mzml": {**mzml, "need_fragpipe": False}, **shared},
+                              inputs=[rawspectrum_reader.source_path(mzml["rawspectrum_path"], mzml.get("fused")),
+                                      mzml["sage_search_result_path"]],
+                              outputs=[mzml["sage_output"]]))
+        if mzml.get("need_mzml") and mzml.get("need_fragpipe"):
+            graph.append(Step("generate_msdt:mzml_fragpipe", generate_msdt_fn, {"mzml": {**mzml, "need_sage": False}, **shared},
+                              inputs=[rawspectrum_reader.source_path(mzml["rawspectrum_path"], mzml.get("fused")),
+                                      mzml["fp_pin_path"]],
+                              outputs=[mzml["fp_output"]]))
+        if wiff.get("need_wiff"):
+            graph.append(Step("generate_msdt:wiff", generate_msdt_fn, {"wiff": wiff, **shared},
+                              inputs=[rawspectrum_reader.source_path(wiff["rawspectrum_path"], wiff.get("fused")),
+                                      wiff["wiff_mzml_path"], wiff["sage_search_result_path"]],
+                              outputs=[wiff["output"]]))
+        if param.get("batch"):
+            graph.append(Step("generate_msdt:batch", generate_msdt_fn, {"batch": param["batch"], **shared}))
+
+    if "convert_2_msdt" in steps:
+        param = steps["convert_2_msdt"]["mgf"]
+        graph.append(Step("convert_2_msdt", mgf_to_parquet, param,
+                          inputs=[param["mgf_path"]], outputs=[param["output_path"]]))
+
+    if "msdt2mgf" in steps:
+        param = steps["msdt2mgf"]
+        graph.append(Step("msdt2mgf", msdt2mgf, param,
+                          inputs=[param["msdt_path"]], outputs=[param["output_path"]]))
+    return link_steps(graph)
+
+def run_worker(cfg, config_path):
+    """
+    Worker mode: convert the generate_msdt batch runs claimed from a queue directory on a shared filesystem.
+    Start any number of workers, on one or several nodes, with the same config; each converts one run at a time.
+    Return values:
+        0: Every run generated or already existed
+        -1: At least one run failed or missed its input
+    """
+    msdt_cfg = cfg.get("generate_msdt", {})
+    runs = collect_runs(msdt_cfg.get("batch", {}))
+    if not runs:
+        logger.info("No msdt runs in batch")
+        return 0
+    configure_writer(msdt_cfg.get("writer"))
+    scan_join.configure(msdt_cfg.get("join"))
+    work_queue.configure(cfg.get("work_queue", {}))
+    queue_dir = work_queue.options["dir"] or os.path.splitext(config_path)[0] + "_queue"
+
+    def convert(run):
+        output = run.get("output", "")
+        step = telemetry.instrument(f"generate_msdt:{os.path.basename(output)}", convert_run, outputs=[output])
+        return step(run)
+
+    run_start = time.perf_counter()
+    states = work_queue.work(runs, convert, queue_dir)
+    for run, state in zip(runs, states):
+        if state in (0, 1):
+            logger.info(f"    [{state}] {run.get('output')}")
+        else:
+            logger.error(f"    [{state}] {run.get('output')}")
+    succeeded = sum(state in (0, 1) for state in states)
+    logger.info(f"msdt worker {work_queue.worker_id()} finished: {succeeded}/{len(runs)} runs succeeded")
+    batch = msdt_cfg.get("batch", {})
+    if msdt_cfg.get("writer", {}).get("dataset") and batch.get("dataset_root"):
+        # every run is finished once a worker gets here, and the summary is replaced whole
+        msdt_dataset.summarize_dataset(batch["dataset_root"])
+
+    # one report per worker, next to the report of a normal run
+    report_path = cfg.get("telemetry", {}).get("report") or os.path.splitext(config_path)[0] + "_report.json"
+    report_path = f"{os.path.splitext(report_path)[0]}.{work_queue.worker_id()}.json"
+    telemetry.write_report(report_path, config_path, time.perf_counter() - run_start)
+    return 0 if succeeded == len(runs) else -1
+
 
 if __name__ == "__main__":
     cfg = load_config(args.config)
+    if args.worker:
+        step_cache.configure(cfg.get("step_cache", {}))
+        rawspectrum_reader.configure(cfg.get("rawspectrum_cache", {}))
+        pipeline.configure(cfg.get("pipeline", {}))
+        raise SystemExit(0 if run_worker(cfg, args.config) == 0 else 1)
     steps = parse_config(cfg)
     if steps == {}:
         logger.info("No steps to execute.")
@@ -109,31 +242,25 @@ if __name__ == "__main__":
         for k, v in params.items():
             logger.info(f"    {k}: {v}")
 
-    # call functions according to configured steps
-    if "generate_rawspectrum" in steps:
-        # do_generate_rawspectrum(steps["generate_rawspectrum"])
-        logger.info("Calling generate_rawspectrum function")
-        rawspectrum_state = generate_rawspectrum_fn(steps['generate_rawspectrum'])
+    step_cache.configure(cfg.get("step_cache", {}))
+    rawspectrum_reader.configure(cfg.get("rawspectrum_cache", {}))
+    pipeline.configure(cfg.get("pipeline", {}))
 
-    if "generate_sage_search_result" in steps:
-        # do_generate_sage_search_result(steps["generate_sage_search_result"])
-        logger.info("Calling generate_sage_search_result function")
-        sage_state = generate_sage_search_result_fn(steps['generate_sage_search_result'])
+    # run the configured steps as a dependency graph
+    graph = build_step_graph(steps)
+    for step in graph:
+        if step.deps:
+            logger.info(f"{step.name} waits for: {', '.join(sorted(step.deps))}")
+    for step in graph:
+        step.fn = telemetry.instrument(step.name, step.fn, step.inputs, step.outputs)
+    scheduler_cfg = cfg.get("scheduler", {})
+    split_threads(graph, int(scheduler_cfg.get("threads", os.cpu_count() or 1)))
+    run_start = time.perf_counter()
+    step_states = run_steps(graph, int(scheduler_cfg.get("max_parallel", len(graph) or 1)))
 
-    if "generate_fragpipe_search_result" in steps:
-        sage_state = generate_fp_search_result_fn(steps['generate_fragpipe_search_result'])
-
-    if "generate_msdt" in steps:
-        # do_generate_msdt(steps["generate_msdt"])
-        logger.info("Calling generate_msdt function")
-        msdt_state = generate_msdt_fn(steps['generate_msdt'])
-
-    if "convert_2_msdt" in steps:
-        # do_convert_2_msdt(steps["convert_2_msdt"])
-        logger.info("Calling convert_2_msdt function")
-        convert_msdt_state = mgf_to_parquet(steps['convert_2_msdt']['mgf'])
-    
-    if "msdt2mgf" in steps:
-        # do_msdt2mgf(steps["msdt2mgf"])
-        logger.info("Calling msdt2mgf function")
-        msdt2mgf_state = msdt2mgf(steps["msdt2mgf"])
\ No newline at end of file
+    # machine readable run report: per step state, time, memory, bytes and row counts
+    for record in telemetry.records:
+        logger.info(f"{record['name']}: state {record['state']}, {record['wall_s']:.2f}s wall, {record['cpu_s']:.2f}s cpu, "
+                    f"{record['process_peak_rss_mb']:.0f} MB peak process RSS")
+    report_path = cfg.get("telemetry", {}).get("report") or os.path.splitext(args.config)[0] + "_report.json"
+    telemetry.write_report(report_path, args.config, time.perf_counter() - run_start)
@@ -1,9 +1,23 @@
 import os
+import glob
 import logging
-import subprocess
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import re
+import json
+from xml.etree import ElementTree
+
+from scripts import step_cache, telemetry, pipeline
+from scripts import rawspectrum_reader, search_results, scan_join, peak_processing
+from scripts import msdt_index, msdt_dataset, parquet_profiles
+from scripts.rawspectrum_reader import load_rawspectrum, PEAK_COLUMNS, RAW_ROW
+from scripts.search_engine import find_pin_files
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -11,6 +25,20 @@ logger = logging.getLogger(__name__)
 deal_mzml_rawspectrum = "./linux_mzml_rawspectrum"
 deal_tims_rawspectrum = "./linux_d_rawspectrum"
 deal_wiff_rawspectrum = "./wiff_mzml_rawspecturm"
+ms_level_accession = 'MS:1000511'
+
+# row_group_size: spectra per Parquet row group, rows are sorted by scan
+# index: write the <msdt>.index.arrow sidecar used by msdt_index.get_spectra
+# dataset: None writes one file per run; {'target_shard_mb', 'partition_by'} writes a sharded dataset directory
+# peaks: None keeps every peak; otherwise the peak_processing stages applied before writing
+# profile: None uses pyarrow's default encodings; otherwise a parquet_profiles profile name
+writer_options = {
+    'row_group_size': 4096,
+    'index': True,
+    'dataset': None,
+    'peaks': None,
+    'profile': None
+}
 
 residues_sage = {
     'C[+57.0216]': 'C[57.02]',
@@ -33,281 +61,607 @@ residues_frag = {
     'Q[0.9800]': 'Q[.98]'
 }
 
-def keep_uppercase(s: str) -> str:
-    """Remove all characters in the string that are not capital letters."""
-    return re.sub(r'[^A-Z]', '', s)
+# element types of the per-scan PSM list columns in Sage MSDT files
+sage_list_types = {
+    'precursor_sequence': pa.string(),
+    'proteins': pa.string(),
+    'label': pa.int8(),
+    'charge': pa.int8(),
+    'matched_peaks': pa.int32(),
+    'peptide_q': pa.float32(),
+    'protein_q': pa.float32(),
+    'predicted_rt': pa.float32(),
+    'ion_mobility': pa.float32(),
+    'delta_rt': pa.float32(),
+    'spectrum_q': pa.float32(),
+    'sage_discriminant_score': pa.float32()
+}
+
+PSM_ROW = 'psm_row'
 
-def clean_psm_func(peptide, residues_dict):
+non_uppercase_pattern = re.compile(r'[^A-Z]')
+trailing_numbers_pattern = re.compile(r'\d+$')
+
+def residue_pattern(residues_dict):
+    """One alternation over all residue spellings, longest first so overlapping keys resolve like str.replace."""
+    keys = sorted(residues_dict, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(k) for k in keys))
+
+def unify_residues(peptide, residues_dict, pattern):
+    """
+    Rewrite residue spellings of one peptide in a single regex pass.
+    A spelling is only rewritten when its unified form is not already in the peptide,
+    and only the first spelling (in dict order) of each unified form is applied,
+    which is what replacing the keys one after another did.
+    """
+    if pattern.search(peptide) is None:
+        return peptide
+    replacements = {}
     for key, value in residues_dict.items():
-        if value not in peptide:
-            peptide = peptide.replace(key, value)
-    return peptide
+        if value in peptide or value in replacements.values():
+            continue
+        if key in peptide:
+            replacements[key] = value
+    return pattern.sub(lambda m: replacements.get(m.group(0), m.group(0)), peptide)
+
+def unify_peptides(peptides, residues_dict=None, strip_flanks=False, strip_trailing_numbers=False):
+    """
+    Rewrite every distinct peptide once and map the results back onto the PSM rows.
+    strip_flanks drops the FragPipe flanking residues (Peptide[2:-2]).
+    Returns the precursor sequences and the lengths of their uppercase-only (cleaned) sequences.
+    """
+    codes, uniques = pd.factorize(peptides)
+    pattern = residue_pattern(residues_dict) if residues_dict else None
+    sequences = []
+    lengths = np.zeros(len(uniques), dtype=np.int64)
+    for i, peptide in enumerate(uniques):
+        if strip_flanks:
+            peptide = peptide[2:-2]
+        if pattern is not None:
+            peptide = unify_residues(peptide, residues_dict, pattern)
+        if strip_trailing_numbers:
+            peptide = trailing_numbers_pattern.sub('', peptide)
+        sequences.append(peptide)
+        lengths[i] = len(non_uppercase_pattern.sub('', peptide))
+    precursor_sequence = pd.Series(sequences).take(codes)
+    precursor_sequence.index = peptides.index
+    return precursor_sequence, pd.Series(lengths[codes], index=peptides.index)
     
-def change_wiff_scan(right_scan_path, wrong_scan_path):
-    right_df = pd.read_csv(right_scan_path, sep='\t')
-    wrong_df = pd.read_csv(wrong_scan_path, sep='\t', usecols=['scan'])
-    right_df['scan_sr'] = list(wrong_df['scan'])
+def read_mzml_scan_ids(mzml_path):
+    """Ids of the MS2 spectra in file order, read from the mzML without decoding any peaks."""
+    scan_ids = []
+    spectrum_id, ms_level = None, None
+    for event, elem in ElementTree.iterparse(mzml_path, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if tag == 'spectrum':
+                spectrum_id, ms_level = elem.get('id'), None
+            elif tag == 'cvParam' and spectrum_id is not None and ms_level is None and elem.get('accession') == ms_level_accession:
+                ms_level = elem.get('value')
+        elif tag == 'spectrum':
+            if ms_level == '2':
+                scan_ids.append(spectrum_id)
+            spectrum_id = None
+            elem.clear()
+    return scan_ids
+
+def wiff_scan_index(wiff_mzml_path, index_path):
+    """Write (or reuse) the scan index of a wiff mzML: one row per MS2 spectrum with the scan id the search engine reports."""
+    index_key = step_cache.step_key([wiff_mzml_path], {'step': 'wiff_scan_index'})
+    if not step_cache.is_cached(index_path, index_key):
+        step_cache.invalidate(index_path)
+        temp = step_cache.temp_path(index_path)
+        pd.DataFrame({'scan': read_mzml_scan_ids(wiff_mzml_path)}).to_csv(temp, sep='\t', index=False)
+        os.replace(temp, index_path)
+        step_cache.store(index_path, index_key)
+        logger.info(f"Wrote wiff scan index {index_path}")
+    return index_path
+
+def wiff_scan_frame(spectra, wiff_mzml_path, output_path, search_scans):
+    """
+    Rawspectrum metadata with the search-engine scan of every spectrum as scan_sr, mapped through
+    the cached scan index of the mzML. Every search scan must be an MS2 spectrum of the index;
+    otherwise the mzML does not belong to the search result and a ValueError fails the run.
+    """
+    output_dir = os.path.dirname(output_path)
+    wiff_fn = os.path.basename(wiff_mzml_path)[:-5]
+    os.makedirs(output_dir, exist_ok=True)
+    index_scans = pd.read_csv(wiff_scan_index(wiff_mzml_path, f"{output_dir}/{wiff_fn}_scan_index.tsv"), sep='\t')['scan']
+    unmapped = pd.unique(np.asarray(search_scans)[~pd.Series(search_scans).isin(index_scans).to_numpy()])
+    if len(unmapped):
+        raise ValueError(f"{len(unmapped)} of {len(pd.unique(np.asarray(search_scans)))} search result scans are not "
+                         f"MS2 spectra of {wiff_mzml_path}, e.g. {list(unmapped[:10])}")
+    return change_wiff_scan(spectra, index_scans)
+
+def change_wiff_scan(spectra, index_scans):
+    """Rawspectrum metadata with scan_sr, the scan id of the mzML spectrum (index_scans, in file order) of every row."""
+    right_df = spectra.meta_frame()
+    if len(index_scans) != spectra.num_source_rows:
+        raise ValueError(f"the scan index has {len(index_scans)} MS2 spectra, the rawspectrum {spectra.num_source_rows}")
+    right_df['scan_sr'] = np.asarray(index_scans)[spectra.source_row]
     return right_df
- 
-def gen_mzml_tims_sage_msdt(raw_data_path, search_result_path, output_path, unify_residue):
+
+def group_psms_by_scan(psm_df, key, list_types):
+    """
+    Collapse PSM rows into one row per scan with typed Arrow list columns.
+    Scans come out in ascending order and PSMs keep their input order within a scan,
+    like groupby(key).agg(list).
+    """
+    order = np.argsort(psm_df[key].to_numpy(), kind='stable')
+    keys = psm_df[key].to_numpy()[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    offsets = pa.array(np.append(starts, len(keys)).astype(np.int32))
+    take = pa.array(order)
+    columns = {key: pa.array(keys[starts])}
+    for col, value_type in list_types.items():
+        values = pa.array(psm_df[col], from_pandas=True)
+        # Arrow-backed pandas columns (e.g. strings) can come back chunked
+        if isinstance(values, pa.ChunkedArray):
+            values = values.combine_chunks()
+        columns[col] = pa.ListArray.from_arrays(offsets, pc.cast(values.take(take), value_type))
+    return pa.table(columns)
+
+def configure_writer(options):
+    writer_options.update(options or {})
+    peak_processing.check_config(writer_options['peaks'])
+    parquet_profiles.check_profile(writer_options['profile'])
+
+def write_msdt(parquet_df, spectra, output_path, psm_table=None, partition=None):
+    """
+    Attach the gathered peak arrays to the merged metadata and write the MSDT parquet,
+    sorted by scan in row groups of writer_options['row_group_size'] spectra.
+    Peaks are gathered per row group as they are written, but parquet_df and spectra cover the whole run.
+    When psm_table is given, its list columns replace the PSM_ROW column of parquet_df.
+    In dataset mode output_path is a directory of shards, partitioned by the keys of
+    partition (data_type, engine) and the columns named in partition_by.
+    """
+    parquet_df = parquet_df.iloc[np.argsort(parquet_df['scan'].to_numpy(), kind='stable')].reset_index(drop=True)
+    rows = parquet_df[RAW_ROW].to_numpy()
+    table = pa.Table.from_pandas(parquet_df.drop(columns=RAW_ROW))
+    if psm_table is not None:
+        position = table.column_names.index(PSM_ROW)
+        psm_table = psm_table.take(pa.array(parquet_df[PSM_ROW].to_numpy()))
+        table = table.remove_column(position)
+        for name in psm_table.column_names[1:]:
+            column_name = name
+            # same suffixes as a pandas merge when a rawspectrum column shares the name
+            if name in table.column_names:
+                table = table.rename_columns([f"{c}_y" if c == name else c for c in table.column_names])
+                column_name = f"{name}_x"
+            table = table.add_column(position, column_name, psm_table[name])
+            position += 1
+    precursor_mz = parquet_df['precursor_mz'].to_numpy() if 'precursor_mz' in parquet_df else None
+    telemetry.count_rows('write', table.num_rows)
+    on_shard = msdt_index.write_index if writer_options['index'] else None
+    dataset = writer_options['dataset']
+    # written under a temp path and renamed into place, so a partial output is never mistaken for a finished one
+    temp = step_cache.temp_path(output_path)
     try:
-        raw_df = pd.read_csv(raw_data_path, sep='\t', usecols=['scan','precursor_mz','rt','mz_array','intensity_array'])
-        raw_df = raw_df.dropna(subset=['scan', 'mz_array','intensity_array'])
-        raw_df['scan'] = raw_df['scan'].astype(int)
-        raw_df['mz_array'] = raw_df['mz_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
-        raw_df['intensity_array'] = raw_df['intensity_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
-        
-        sage_df = pd.read_csv(search_result_path,sep='\t',usecols=['peptide','scannr','label','matched_peaks','peptide_q','protein_q','charge','predicted_rt','ion_mobility','delta_rt_model','sage_discriminant_score','spectrum_q','proteins'])
-        sage_df = sage_df.dropna(subset=['scannr'])
+        if dataset:
+            # partitioning splits the rows by column values, so the dataset writer gets the whole table
+            table = add_peak_columns(table, spectra, rows, precursor_mz)
+            partition_by = dataset.get('partition_by', [])
+            os.makedirs(temp, exist_ok=True)
+            msdt_dataset.write_dataset(table, temp,
+                                       partition={k: v for k, v in (partition or {}).items() if k in partition_by},
+                                       partition_by=partition_by,
+                                       target_shard_mb=dataset.get('target_shard_mb', msdt_dataset.DEFAULT_SHARD_MB),
+                                       row_group_size=writer_options['row_group_size'], on_shard=on_shard,
+                                       profile=writer_options['profile'])
+            step_cache.commit(temp, output_path)
+            return
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        write_row_groups(table, spectra, rows, precursor_mz, temp)
+        step_cache.commit(temp, output_path)
+    finally:
+        step_cache.discard(temp)
+    if on_shard is not None:
+        on_shard(output_path)
+
+def add_peak_columns(table, spectra, rows, precursor_mz=None):
+    """Gather the peaks of rows, apply the writer's peak processing and insert them into table."""
+    peak_columns = spectra.peak_arrays(rows)
+    if writer_options['peaks']:
+        peak_columns = peak_processing.process_list_columns(*peak_columns, writer_options['peaks'], precursor_mz)
+    # peak columns keep their position relative to the rawspectrum columns
+    for name, column in zip(PEAK_COLUMNS, peak_columns):
+        before = spectra.columns[:spectra.columns.index(name)]
+        previous = [c for c in before if c in table.column_names]
+        position = table.column_names.index(previous[-1]) + 1 if previous else table.num_columns
+        table = table.add_column(position, name, column)
+    return table
+
+def write_row_groups(table, spectra, rows, precursor_mz, output_path):
+    """
+    Write the MSDT file one row group at a time as a pipeline: the peaks of the next row groups
+    are gathered and processed on the pipeline threads while a writer thread encodes and writes
+    the previous ones, so only the row groups in flight hold gathered peaks.
+    """
+    size = writer_options['row_group_size']
+    profile = writer_options['profile']
+    state = {'writer': None}
+
+    def row_group(offset):
+        chunk_rows = rows[offset:offset + size]
+        chunk_precursor_mz = None if precursor_mz is None else precursor_mz[offset:offset + size]
+        return add_peak_columns(table.slice(offset, len(chunk_rows)), spectra, chunk_rows, chunk_precursor_mz)
+
+    def write(chunk):
+        if state['writer'] is None:
+            schema = parquet_profiles.with_profile_metadata(chunk.schema, profile)
+            state['writer'] = pq.ParquetWriter(output_path, schema, **parquet_profiles.writer_kwargs(profile, schema))
+        state['writer'].write_table(chunk.replace_schema_metadata(state['writer'].schema.metadata), row_group_size=size)
+
+    writer = pipeline.BackgroundWriter(write)
+    try:
+        for chunk in pipeline.ordered_map(row_group, range(0, max(len(rows), 1), size)):
+            writer.put(chunk)
+    finally:
         try:
-            sage_df['scannr'] = sage_df['scannr'].astype(int)
-        except:
-            sage_df['scannr'] = sage_df['scannr'].apply(lambda x: x.split('=')[-1]).astype(int)
-        decoy_df = sage_df[sage_df['label']==-1]
-        target_df = sage_df[sage_df['label']==1]
-        identify_target_df = target_df[target_df['spectrum_q']<=0.01]
-        sage_df_need = pd.concat([identify_target_df, decoy_df], axis=0, ignore_index=True)
+            # also stops the writer thread when a row group failed
+            writer.close()
+        finally:
+            if state['writer'] is not None:
+                state['writer'].close()
+ 
+def gen_mzml_tims_sage_msdt(raw_data_path, search_result_path, output_path, unify_residue, partition=None, fused=None, spectra=None):
+    try:
+        # the search results are read on a background thread while the spectra are parsed
+        # (identified targets then decoys, charge 2-5; the q-value, label and charge filters run while reading)
+        search = pipeline.Background(search_results.read_sage_results, search_result_path)
+        if spectra is None:
+            spectra = load_rawspectrum(raw_data_path, fused=fused)
+        raw_df = spectra.meta_frame()
+        sage_df_need = search.result()
+        telemetry.count_rows('read', len(spectra))
         sage_df_need = sage_df_need.rename(columns={'scannr':'scan','delta_rt_model':'delta_rt'})
-        if unify_residue:
-            sage_df_need['precursor_sequence'] = sage_df_need['peptide'].apply(lambda x: clean_psm_func(x,residues_sage))
-        else:
-            sage_df_need['precursor_sequence'] = sage_df_need['peptide']
-        sage_df_need['cleaned_sequence'] = sage_df_need['precursor_sequence'].apply(lambda x: keep_uppercase(x))
-        # sage_df_need['cleaned_sequence'] = sage_df_need['precursor_sequence'].str.replace('n[42]', '').str.replace('N[.98]', 'N').str.replace('Q[.98]', 'Q').str.replace('M[15.99]', 'M').str.replace('C[57.02]', 'C')
-        sage_df_need['sequence_len'] = sage_df_need['cleaned_sequence'].apply(len)
+        sage_df_need['precursor_sequence'], sage_df_need['sequence_len'] = unify_peptides(
+            sage_df_need['peptide'], residues_sage if unify_residue else None)
         sage_df_need = sage_df_need[(sage_df_need['sequence_len']<=50)&(sage_df_need['sequence_len']>=7)]
-        sage_df_need = sage_df_need[(sage_df_need['charge']<=5)&(sage_df_need['charge']>=2)]
         sage_df_need['label'] = sage_df_need['label'].replace(-1, 0)
         sage_df_need['ion_mobility'] = sage_df_need['ion_mobility'].fillna(0)
         sage_df_need = sage_df_need[['scan','precursor_sequence','proteins','label','matched_peaks','peptide_q','protein_q','charge','predicted_rt','ion_mobility','delta_rt','spectrum_q','sage_discriminant_score']]
-        resultdf_grouped = sage_df_need.groupby('scan').agg({
-                'precursor_sequence': lambda x: list(x),
-                'proteins': lambda x: list(x),
-                'label': lambda x: list(x),
-                'charge': lambda x: list(x),
-                'matched_peaks': lambda x: list(x),
-                'peptide_q': lambda x: list(x),
-                'protein_q': lambda x: list(x),
-                'predicted_rt': lambda x: list(x),
-                'ion_mobility': lambda x: list(x),
-                'delta_rt': lambda x: list(x),
-                'spectrum_q': lambda x: list(x),
-                'sage_discriminant_score': lambda x: list(x)
-            }).reset_index()
-        resultdf_grouped['spectrum_q'] = resultdf_grouped['spectrum_q'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['sage_discriminant_score'] = resultdf_grouped['sage_discriminant_score'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['label'] = resultdf_grouped['label'].apply(lambda x: [np.int8(i) for i in x])
-        resultdf_grouped['charge'] = resultdf_grouped['charge'].apply(lambda x: [np.int8(i) for i in x])
-        resultdf_grouped['matched_peaks'] = resultdf_grouped['matched_peaks'].apply(lambda x: [np.int32(i) for i in x])
-        resultdf_grouped['peptide_q'] = resultdf_grouped['peptide_q'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['protein_q'] = resultdf_grouped['protein_q'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['predicted_rt'] = resultdf_grouped['predicted_rt'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['ion_mobility'] = resultdf_grouped['ion_mobility'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['delta_rt'] = resultdf_grouped['delta_rt'].apply(lambda x: [np.float32(i) for i in x])
-
-        parquet_df = resultdf_grouped.merge(raw_df, on='scan', how='inner')
-        assert len(parquet_df) == len(resultdf_grouped)
+        telemetry.count_rows('filter', len(sage_df_need))
+        resultdf_grouped = group_psms_by_scan(sage_df_need, 'scan', sage_list_types)
+        telemetry.count_rows('group', resultdf_grouped.num_rows)
+        scan_df = pd.DataFrame({'scan': resultdf_grouped['scan'].to_numpy(), PSM_ROW: np.arange(resultdf_grouped.num_rows)})
 
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        parquet_df.to_parquet(output_path)
+        parquet_df = scan_join.join_spectra(scan_df, raw_df, 'scan', output_path)
+        telemetry.count_rows('join', len(parquet_df))
+
+        write_msdt(parquet_df, spectra, output_path, psm_table=resultdf_grouped, partition=partition)
         return 0
     except Exception as e:
         logger.error(f"Error occurs when generate {output_path}: {e}")
         return -1
     
-def gen_mzml_fragpipe_msdt(raw_data_path, fp_pin_path, output_path, unify_residue):
+def gen_mzml_fragpipe_msdt(raw_data_path, fp_pin_path, output_path, unify_residue, partition=None, fused=None, spectra=None):
     try:
-        raw_df = pd.read_csv(raw_data_path, sep='\t', usecols=['scan','precursor_mz','rt','mz_array','intensity_array'])
-        raw_df = raw_df.dropna(subset=['scan', 'mz_array','intensity_array'])
-        raw_df['scan'] = raw_df['scan'].astype(int)
-        raw_df['mz_array'] = raw_df['mz_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
-        raw_df['intensity_array'] = raw_df['intensity_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
-
-        # read fp_sr decoy
-        need_cols = ['SpecId', 'Label', 'ScanNr', 'ExpMass', 'retentiontime', 'rank', 'isotope_errors', 'hyperscore', 'delta_hyperscore', 'matched_ion_num', 'ion_series', 'unweighted_spectral_entropy', 'delta_RT_loess', 'Peptide', 'Proteins']
-        fp_sr_df = pd.read_csv(fp_pin_path, sep='\t',usecols=need_cols)
+        # read fp_sr decoy while the spectra are parsed
+        search = pipeline.Background(search_results.read_pin, fp_pin_path)
+        if spectra is None:
+            spectra = load_rawspectrum(raw_data_path, fused=fused)
+        raw_df = spectra.meta_frame()
+        fp_sr_df = search.result()
+        telemetry.count_rows('read', len(spectra))
         fp_sr_df = fp_sr_df.rename(columns={'ScanNr': 'scan', 'Label':'label', 'Proteins': 'proteins'})
-        assert len(fp_sr_df) == len(set(fp_sr_df['scan'])), ""
         fp_sr_df['label'] = fp_sr_df['label'].replace(-1, 0)
-        fp_sr_df['charge'] = fp_sr_df['SpecId'].apply(lambda x: int(x.split('.')[-1].split('_')[0]))
-        
-        def remove_trailing_numbers(s):
-            return re.sub(r'\d+$', '', s)
-        
-        if unify_residue:
-            fp_sr_df['precursor_sequence'] = fp_sr_df['Peptide'].apply(lambda x: clean_psm_func(x[2:-2], residues_frag))
-        else:
-            fp_sr_df['precursor_sequence'] = fp_sr_df['Peptide'].apply(lambda x: remove_trailing_numbers(x[2:-2]))
+        fp_sr_df['precursor_sequence'], _ = unify_peptides(
+            fp_sr_df['Peptide'], residues_frag if unify_residue else None,
+            strip_flanks=True, strip_trailing_numbers=not unify_residue)
         fp_sr_df = fp_sr_df[['scan', 'label', 'charge', 'ExpMass', 'retentiontime', 'rank', 'isotope_errors', 'hyperscore', 'delta_hyperscore', 'matched_ion_num', 'ion_series', 'unweighted_spectral_entropy', 'delta_RT_loess', 'precursor_sequence', 'proteins']]
 
-        fp_parquet_df = fp_sr_df.merge(raw_df, on='scan', how='inner')
-        assert len(fp_parquet_df) == len(fp_sr_df)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        fp_parquet_df.to_parquet(output_path)
+        fp_parquet_df = scan_join.join_spectra(fp_sr_df, raw_df, 'scan', output_path)
+        telemetry.count_rows('join', len(fp_parquet_df))
+        write_msdt(fp_parquet_df, spectra, output_path, partition=partition)
         return 0
     except Exception as e:
         logger.error(f"Error occurs when generate {output_path}: {e}")
         return -1
     
-def gen_wiff_sage_msdt(raw_data_path, wiff_mzml_path, search_result_path, output_path, unify_residue):
+def gen_wiff_sage_msdt(raw_data_path, wiff_mzml_path, search_result_path, output_path, unify_residue, partition=None, fused=None):
     try:
-        wiff_fn = wiff_mzml_path.split('/')[-1][:-5]
-        wrong_temp_raw = f"{'/'.join(output_path.split('/')[:-1])}/{wiff_fn}_temp_raw.tsv"
-        cmd = [deal_mzml_rawspectrum, wiff_mzml_path, wrong_temp_raw]
-        subprocess.run(cmd, capture_output=True, text=True)
-        
-        if os.path.exists(wrong_temp_raw):
-            raw_df = change_wiff_scan(raw_data_path, wrong_temp_raw)
-            raw_df = raw_df.dropna(subset=['scan', 'mz_array','intensity_array'])
-            raw_df['scan'] = raw_df['scan'].astype(int)
-            raw_df['mz_array'] = raw_df['mz_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
-            raw_df['intensity_array'] = raw_df['intensity_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
-        else:
-            logger.error(f"fail to generate wiff temp rawspectrum: {wrong_temp_raw}")
-            return -1
-
-        sage_df = pd.read_csv(search_result_path,sep='\t',usecols=['peptide','scannr','label','matched_peaks','peptide_q','protein_q','charge','predicted_rt','ion_mobility','delta_rt_model','sage_discriminant_score','spectrum_q','proteins'])
-        sage_df = sage_df.dropna(subset=['scannr'])
-        decoy_df = sage_df[sage_df['label']==-1]
-        target_df = sage_df[sage_df['label']==1]
-        identify_target_df = target_df[target_df['spectrum_q']<=0.01]
-        sage_df_need = pd.concat([identify_target_df, decoy_df], axis=0, ignore_index=True)
+        # wiff scan ids are matched as reported, so they are not parsed into numbers
+        search = pipeline.Background(search_results.read_sage_results, search_result_path, False)
+        spectra = load_rawspectrum(raw_data_path, meta_columns=None, fused=fused)
+        sage_df_need = search.result()
+        telemetry.count_rows('read', len(spectra))
 
         sage_df_need = sage_df_need.rename(columns={'scannr':'scan_sr','delta_rt_model':'delta_rt'})
-        if unify_residue:
-            sage_df_need['precursor_sequence'] = sage_df_need['peptide'].apply(lambda x: clean_psm_func(x,residues_sage))
-        else:
-            sage_df_need['precursor_sequence'] = sage_df_need['peptide']
-        sage_df_need['cleaned_sequence'] = sage_df_need['precursor_sequence'].apply(lambda x: keep_uppercase(x))
-        sage_df_need['sequence_len'] = sage_df_need['cleaned_sequence'].apply(len)
+        sage_df_need['precursor_sequence'], sage_df_need['sequence_len'] = unify_peptides(
+            sage_df_need['peptide'], residues_sage if unify_residue else None)
         sage_df_need = sage_df_need[(sage_df_need['sequence_len']<=50)&(sage_df_need['sequence_len']>=7)]
-        sage_df_need = sage_df_need[(sage_df_need['charge']<=5)&(sage_df_need['charge']>=2)]
         sage_df_need['label'] = sage_df_need['label'].replace(-1, 0)
         sage_df_need['ion_mobility'] = sage_df_need['ion_mobility'].fillna(0)
         sage_df_need = sage_df_need[['scan_sr','precursor_sequence','proteins','label','matched_peaks','peptide_q','protein_q','charge','predicted_rt','ion_mobility','delta_rt','spectrum_q','sage_discriminant_score']]
-        resultdf_grouped = sage_df_need.groupby('scan_sr').agg({
-                'precursor_sequence': lambda x: list(x),
-                'proteins': lambda x: list(x),
-                'label': lambda x: list(x),
-                'charge': lambda x: list(x),
-                'matched_peaks': lambda x: list(x),
-                'peptide_q': lambda x: list(x),
-                'protein_q': lambda x: list(x),
-                'predicted_rt': lambda x: list(x),
-                'ion_mobility': lambda x: list(x),
-                'delta_rt': lambda x: list(x),
-                'spectrum_q': lambda x: list(x),
-                'sage_discriminant_score': lambda x: list(x)
-            }).reset_index()
-        resultdf_grouped['spectrum_q'] = resultdf_grouped['spectrum_q'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['sage_discriminant_score'] = resultdf_grouped['sage_discriminant_score'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['label'] = resultdf_grouped['label'].apply(lambda x: [np.int8(i) for i in x])
-        resultdf_grouped['charge'] = resultdf_grouped['charge'].apply(lambda x: [np.int8(i) for i in x])
-        resultdf_grouped['matched_peaks'] = resultdf_grouped['matched_peaks'].apply(lambda x: [np.int32(i) for i in x])
-        resultdf_grouped['peptide_q'] = resultdf_grouped['peptide_q'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['protein_q'] = resultdf_grouped['protein_q'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['predicted_rt'] = resultdf_grouped['predicted_rt'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['ion_mobility'] = resultdf_grouped['ion_mobility'].apply(lambda x: [np.float32(i) for i in x])
-        resultdf_grouped['delta_rt'] = resultdf_grouped['delta_rt'].apply(lambda x: [np.float32(i) for i in x])
-
-        parquet_df = resultdf_grouped.merge(raw_df, on='scan_sr', how='inner')
+        telemetry.count_rows('filter', len(sage_df_need))
+        resultdf_grouped = group_psms_by_scan(sage_df_need, 'scan_sr', sage_list_types)
+        telemetry.count_rows('group', resultdf_grouped.num_rows)
+        scan_df = pd.DataFrame({'scan_sr': resultdf_grouped['scan_sr'].to_numpy(), PSM_ROW: np.arange(resultdf_grouped.num_rows)})
+        raw_df = wiff_scan_frame(spectra, wiff_mzml_path, output_path, scan_df['scan_sr'])
+
+        parquet_df = scan_join.join_spectra(scan_df, raw_df, 'scan_sr', output_path)
         parquet_df = parquet_df.drop('scan_sr', axis=1)
-        assert len(parquet_df) == len(resultdf_grouped)
+        telemetry.count_rows('join', len(parquet_df))
 
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        parquet_df.to_parquet(output_path)
+        write_msdt(parquet_df, spectra, output_path, psm_table=resultdf_grouped, partition=partition)
         return 0
     except Exception as e:
         logger.error(f"Error occurs when generate {output_path}: {e}")
         return -1
     
+def msdt_cache_key(inputs, engine, unify_residue):
+    return step_cache.step_key(inputs, {'step': 'generate_msdt', 'engine': engine, 'unify_residue': unify_residue,
+                                        # the resolved writer settings, so a changed default regenerates the output
+                                        'writer': {**writer_options, 'peaks': peak_processing.check_config(writer_options['peaks'])},
+                                        'join': dict(scan_join.options)})
+
+def generate_cached(output, cache_key, gen_fn, *args, **kwargs):
+    """Regenerate a stale MSDT file and record its cache manifest on success."""
+    step_cache.invalidate(output)
+    state = gen_fn(*args, **kwargs)
+    if state == 0:
+        step_cache.store(output, cache_key)
+    return state
+
+def convert_run(run):
+    """
+    Convert one cohort run entry into an MSDT file.
+    Return values:
+        0: Successfully generated
+        1: Already exists, no need to generate
+        2: Input file does not exist
+        -1: Generation failed
+    """
+    data_type = run.get('data_type', 'mzml')
+    engine = run.get('engine', 'sage')
+    rawspectrum_path = run.get('rawspectrum_path', '')
+    search_result_path = run.get('search_result_path', '')
+    unify_residue = run.get('unify_residue', True)
+    output = run.get('output', '')
+    fused = None
+    if run.get('raw_data_path'):
+        # stream the spectra from the extractor instead of reading the rawspectrum TSV
+        fused = rawspectrum_reader.fused_spec({'wiff': 'wiff2mzml'}.get(data_type, data_type),
+                                              run['raw_data_path'], run.get('keep_tsv', False))
+    inputs = [rawspectrum_reader.source_path(rawspectrum_path, fused), search_result_path]
+    if data_type == 'wiff':
+        inputs.append(run.get('wiff_mzml_path', ''))
+    cache_key = msdt_cache_key(inputs, engine, unify_residue)
+    if step_cache.is_cached(output, cache_key):
+        logger.info(f"{output} already done, skip")
+        return 1
+    for path in inputs:
+        if not path or not os.path.exists(path):
+            logger.error(f"miss input of {output}: {path}")
+            return 2
+
+    if data_type == 'wiff' and engine == 'sage':
+        return generate_cached(output, cache_key, gen_wiff_sage_msdt, rawspectrum_path, run['wiff_mzml_path'], search_result_path, output, unify_residue, {'data_type': data_type, 'engine': engine}, fused=fused)
+    elif data_type in ('tims', 'mzml') and engine == 'sage':
+        return generate_cached(output, cache_key, gen_mzml_tims_sage_msdt, rawspectrum_path, search_result_path, output, unify_residue, {'data_type': data_type, 'engine': engine}, fused=fused)
+    elif data_type == 'mzml' and engine == 'fragpipe':
+        return generate_cached(output, cache_key, gen_mzml_fragpipe_msdt, rawspectrum_path, search_result_path, output, unify_residue, {'data_type': data_type, 'engine': engine}, fused=fused)
+    logger.error(f"Unsupported run: data_type={data_type}, engine={engine}")
+    return -1
+
+def read_run_manifest(manifest_path):
+    """Run entries from a .json list or a TSV with one run per line and run-entry keys as header."""
+    if manifest_path.endswith('.json'):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    manifest_df = pd.read_csv(manifest_path, sep='\t', dtype=str, keep_default_na=False)
+    runs = manifest_df.to_dict('records')
+    for run in runs:
+        if 'unify_residue' in run:
+            run['unify_residue'] = run['unify_residue'].strip().lower() not in ('false', '0', 'no')
+    return runs
+
+def glob_runs(spec):
+    """
+    Pair rawspectrum files matched by rawspectrum_glob with their search results by file name:
+    <fn>_rawspectrum.tsv -> <fn>_search_result.tsv (sage) or <fn>_edited.pin (fragpipe, searched recursively).
+    """
+    data_type = spec.get('data_type', 'mzml')
+    engine = spec.get('engine', 'sage')
+    search_result_dir = spec.get('search_result_dir', '')
+    # one walk over the FragPipe workdir instead of a recursive glob per run
+    pin_files = find_pin_files(search_result_dir) if engine == 'fragpipe' else {}
+    runs = []
+    for rawspectrum_path in sorted(glob.glob(spec['rawspectrum_glob'])):
+        fn = os.path.basename(rawspectrum_path)
+        fn = fn[:-len('_rawspectrum.tsv')] if fn.endswith('_rawspectrum.tsv') else os.path.splitext(fn)[0]
+        if engine == 'fragpipe':
+            search_result_path = pin_files.get(fn, '')
+            output = os.path.join(spec['output_dir'], f'{fn}_fp_msdt.parquet')
+        else:
+            search_result_path = os.path.join(search_result_dir, f'{fn}_search_result.tsv')
+            output = os.path.join(spec['output_dir'], f'{fn}_sage_msdt.parquet')
+        run = {
+            'data_type': data_type,
+            'engine': engine,
+            'rawspectrum_path': rawspectrum_path,
+            'search_result_path': search_result_path,
+            'unify_residue': spec.get('unify_residue', True),
+            'output': output
+        }
+        if data_type == 'wiff':
+            run['wiff_mzml_path'] = os.path.join(spec.get('wiff_mzml_dir', ''), f'{fn}.mzML')
+        runs.append(run)
+    return runs
+
+def collect_runs(batch):
+    runs = list(batch.get('runs', []))
+    if batch.get('manifest'):
+        runs += read_run_manifest(batch['manifest'])
+    if batch.get('glob'):
+        runs += glob_runs(batch['glob'])
+    return runs
+
+def _init_batch_worker(memory_budget, cache_options, rawspectrum_options, msdt_writer_options, join_options, pipeline_options):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    step_cache.configure(cache_options)
+    rawspectrum_reader.configure(rawspectrum_options)
+    configure_writer(msdt_writer_options)
+    scan_join.configure(join_options)
+    pipeline.configure(pipeline_options)
+    if memory_budget:
+        # allocations beyond the budget raise MemoryError inside the run instead of starving other workers
+        resource.setrlimit(resource.RLIMIT_AS, (memory_budget, memory_budget))
+
+def generate_msdt_batch_fn(batch):
+    """
+    Convert many runs across a process pool.
+    Each worker process converts one run and is then replaced, so memory is returned between runs.
+    Return values:
+        0: Every run generated or already existed
+        -1: At least one run failed or missed its input
+    """
+    runs = collect_runs(batch)
+    if not runs:
+        logger.info("No msdt runs in batch")
+        return 0
+    memory_budget = int(float(batch.get('worker_memory_gb', 0)) * (1 << 30))
+    workers = int(batch.get('workers', os.cpu_count() or 1))
+    if memory_budget:
+        total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        workers = min(workers, max(1, total_memory // memory_budget))
+    workers = max(1, min(workers, len(runs)))
+    logger.info(f"Converting {len(runs)} msdt runs with {workers} workers")
+
+    states = [-1] * len(runs)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_batch_worker, initargs=(memory_budget, dict(step_cache.options), dict(rawspectrum_reader.options), dict(writer_options), dict(scan_join.options),
+                                       dict(pipeline.options)),
+                             max_tasks_per_child=1) as pool:
+        futures = {pool.submit(convert_run, run): i for i, run in enumerate(runs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                states[i] = future.result()
+            except Exception as e:
+                logger.error(f"Error occurs when generate {runs[i].get('output')}: {e}")
+                states[i] = -1
+
+    for run, state in zip(runs, states):
+        if state in (0, 1):
+            logger.info(f"    [{state}] {run.get('output')}")
+        else:
+            logger.error(f"    [{state}] {run.get('output')}")
+    succeeded = sum(state in (0, 1) for state in states)
+    logger.info(f"msdt batch finished: {succeeded}/{len(runs)} runs succeeded")
+    if writer_options['dataset'] and batch.get('dataset_root'):
+        # one _metadata over the shards of every run below the cohort root
+        msdt_dataset.summarize_dataset(batch['dataset_root'])
+    return 0 if succeeded == len(runs) else -1
+
 def generate_msdt_fn(param):
     """
-    Generate a rawspectrum file.
+    Generate the MSDT files of the configured tims, mzml and wiff runs and of the cohort batch.
     Return values:
         0: Successfully generated
         1: Already exists, no need to generate
         2: Input file does not exist
         -1: Generation failed
     """
+    configure_writer(param.get('writer'))
+    scan_join.configure(param.get('join'))
+
+    # cohort batch
+    batch_state = generate_msdt_batch_fn(param['batch']) if param.get('batch') else 0
+
     # tims
-    tims_need = param.get('tims')['need_tims']
-    tims_rawspectrum_path = param.get('tims')['rawspectrum_path']
-    tims_sage_search_result_path = param.get('tims')['sage_search_result_path']
-    tims_unify_residue = param.get('tims')['unify_residue']
-    tims_output = param.get('tims')['output']
+    tims_need = param.get('tims', {}).get('need_tims')
+    # a rawspectrum_reader.fused_spec when the spectra are streamed from the extractor (generate_rawspectrum.fused)
+    tims_fused = param.get('tims', {}).get('fused')
+    tims_rawspectrum_path = param.get('tims', {}).get('rawspectrum_path')
+    tims_sage_search_result_path = param.get('tims', {}).get('sage_search_result_path')
+    tims_unify_residue = param.get('tims', {}).get('unify_residue')
+    tims_output = param.get('tims', {}).get('output')
     tims_state = -1
     if tims_need:
-        if os.path.exists(tims_output):
+        tims_key = msdt_cache_key([rawspectrum_reader.source_path(tims_rawspectrum_path, tims_fused), tims_sage_search_result_path], 'sage', tims_unify_residue)
+        if step_cache.is_cached(tims_output, tims_key):
             logger.info(f"tims_output already done: {tims_output}, skip")
             tims_state = 1
         elif not os.path.exists(tims_sage_search_result_path):
             logger.error(f"miss tims_sage_search_result_path: {tims_sage_search_result_path}")
             tims_state = 2
-        elif not os.path.exists(tims_rawspectrum_path):
+        elif not os.path.exists(rawspectrum_reader.source_path(tims_rawspectrum_path, tims_fused)):
             logger.error(f"miss tims_rawspectrum_path: {tims_rawspectrum_path}")
             tims_state = 2
         else:
-            tims_state = gen_mzml_tims_sage_msdt(tims_rawspectrum_path, tims_sage_search_result_path, tims_output, tims_unify_residue)
+            tims_state = generate_cached(tims_output, tims_key, gen_mzml_tims_sage_msdt, tims_rawspectrum_path, tims_sage_search_result_path, tims_output, tims_unify_residue, {'data_type': 'tims', 'engine': 'sage'}, fused=tims_fused)
         
     # mzml
-    mzml_need = param.get('mzml')['need_mzml']
-    mzml_need_sage = param.get('mzml')['need_sage']
-    mzml_need_fragpipe = param.get('mzml')['need_fragpipe']
-    mzml_rawspectrum_path = param.get('mzml')['rawspectrum_path']
-    mzml_sage_search_result_path = param.get('mzml')['sage_search_result_path']
-    mzml_fp_pin_path = param.get('mzml')['fp_pin_path']
-    mzml_sage_unify_residue = param.get('mzml')['sage_unify_residue']
-    mzml_fp_unify_residue = param.get('mzml')['fp_unify_residue']
-    mzml_sage_output = param.get('mzml')['sage_output']
-    mzml_fp_output = param.get('mzml')['fp_output']
+    mzml_need = param.get('mzml', {}).get('need_mzml')
+    mzml_fused = param.get('mzml', {}).get('fused')
+    mzml_need_sage = param.get('mzml', {}).get('need_sage')
+    mzml_need_fragpipe = param.get('mzml', {}).get('need_fragpipe')
+    mzml_rawspectrum_path = param.get('mzml', {}).get('rawspectrum_path')
+    mzml_sage_search_result_path = param.get('mzml', {}).get('sage_search_result_path')
+    mzml_fp_pin_path = param.get('mzml', {}).get('fp_pin_path')
+    mzml_sage_unify_residue = param.get('mzml', {}).get('sage_unify_residue')
+    mzml_fp_unify_residue = param.get('mzml', {}).get('fp_unify_residue')
+    mzml_sage_output = param.get('mzml', {}).get('sage_output')
+    mzml_fp_output = param.get('mzml', {}).get('fp_output')
     mzml_sage_state = -1
     mzml_fp_state = -1
+    mzml_spectra = None
     if mzml_need:
         if mzml_need_sage:
-            if os.path.exists(mzml_sage_output):
+            mzml_sage_key = msdt_cache_key([rawspectrum_reader.source_path(mzml_rawspectrum_path, mzml_fused), mzml_sage_search_result_path], 'sage', mzml_sage_unify_residue)
+            if step_cache.is_cached(mzml_sage_output, mzml_sage_key):
                 logger.info(f"mzml_sage_output already done: {mzml_sage_output}, skip")
                 mzml_sage_state = 1
-            elif not os.path.exists(mzml_rawspectrum_path):
+            elif not os.path.exists(rawspectrum_reader.source_path(mzml_rawspectrum_path, mzml_fused)):
                 logger.error(f"miss mzml_rawspectrum_path: {mzml_rawspectrum_path}")
                 mzml_sage_state = 2
             elif not os.path.exists(mzml_sage_search_result_path):
                 logger.error(f"miss mzml_sage_search_result_path: {mzml_sage_search_result_path}")
                 mzml_sage_state = 2
             else:
-                mzml_sage_state = gen_mzml_tims_sage_msdt(mzml_rawspectrum_path, mzml_sage_search_result_path, mzml_sage_output, mzml_sage_unify_residue)
+                if mzml_need_fragpipe:
+                    # parsed once for the Sage and FragPipe outputs and released when this call returns
+                    try:
+                        mzml_spectra = load_rawspectrum(mzml_rawspectrum_path, fused=mzml_fused)
+                    except Exception as e:
+                        logger.error(f"Error occurs when read {mzml_rawspectrum_path}: {e}")
+                mzml_sage_state = generate_cached(mzml_sage_output, mzml_sage_key, gen_mzml_tims_sage_msdt, mzml_rawspectrum_path, mzml_sage_search_result_path, mzml_sage_output, mzml_sage_unify_residue, {'data_type': 'mzml', 'engine': 'sage'}, fused=mzml_fused, spectra=mzml_spectra)
         else:
             mzml_sage_state = 0
                 
         if mzml_need_fragpipe:
-            
-            if os.path.exists(mzml_fp_output):
+            mzml_fp_key = msdt_cache_key([rawspectrum_reader.source_path(mzml_rawspectrum_path, mzml_fused), mzml_fp_pin_path], 'fragpipe', mzml_fp_unify_residue)
+            if step_cache.is_cached(mzml_fp_output, mzml_fp_key):
                 logger.info(f"mzml_fp_output already done: {mzml_fp_output}, skip")
                 mzml_fp_state = 1
-            elif not os.path.exists(mzml_rawspectrum_path):
+            elif not os.path.exists(rawspectrum_reader.source_path(mzml_rawspectrum_path, mzml_fused)):
                 logger.error(f"miss mzml_rawspectrum_path: {mzml_rawspectrum_path}")
                 mzml_fp_state = 2
             elif not os.path.exists(mzml_fp_pin_path):
                 logger.error(f"miss mzml_fp_pin_path: {mzml_fp_pin_path}")
                 mzml_fp_state = 2
             else:
-                mzml_fp_state = gen_mzml_fragpipe_msdt(mzml_rawspectrum_path, mzml_fp_pin_path, mzml_fp_output, mzml_fp_unify_residue)
+                mzml_fp_state = generate_cached(mzml_fp_output, mzml_fp_key, gen_mzml_fragpipe_msdt, mzml_rawspectrum_path, mzml_fp_pin_path, mzml_fp_output, mzml_fp_unify_residue, {'data_type': 'mzml', 'engine': 'fragpipe'}, fused=mzml_fused, spectra=mzml_spectra)
         else:
             mzml_fp_state = 0
     
     # wiff
-    wiff_need = param.get('wiff')['need_wiff']
-    wiff_mzml_path = param.get('wiff')['wiff_mzml_path']
-    wiff_rawspectrum_path = param.get('wiff')['rawspectrum_path']
-    wiff_sage_search_result_path = param.get('wiff')['sage_search_result_path']
-    wiff_unify_residue = param.get('wiff')['unify_residue']
-    wiff_output = param.get('wiff')['output']
+    wiff_need = param.get('wiff', {}).get('need_wiff')
+    wiff_fused = param.get('wiff', {}).get('fused')
+    wiff_mzml_path = param.get('wiff', {}).get('wiff_mzml_path')
+    wiff_rawspectrum_path = param.get('wiff', {}).get('rawspectrum_path')
+    wiff_sage_search_result_path = param.get('wiff', {}).get('sage_search_result_path')
+    wiff_unify_residue = param.get('wiff', {}).get('unify_residue')
+    wiff_output = param.get('wiff', {}).get('output')
     wiff_state = -1
     if wiff_need:
-        if os.path.exists(wiff_output):
+        wiff_key = msdt_cache_key([rawspectrum_reader.source_path(wiff_rawspectrum_path, wiff_fused), wiff_sage_search_result_path, wiff_mzml_path], 'sage', wiff_unify_residue)
+        if step_cache.is_cached(wiff_output, wiff_key):
             logger.info(f"wiff_output already done: {wiff_output}, skip")
             wiff_state = 1
-        elif not os.path.exists(wiff_rawspectrum_path):
+        elif not os.path.exists(rawspectrum_reader.source_path(wiff_rawspectrum_path, wiff_fused)):
             logger.error(f"miss wiff_rawspectrum_path: {wiff_rawspectrum_path}")
             wiff_state = 2
         elif not os.path.exists(wiff_mzml_path):
@@ -317,10 +671,12 @@ def generate_msdt_fn(param):
             logger.error(f"miss wiff_sage_search_result_path: {wiff_sage_search_result_path}")
             wiff_state = 2
         else:
-            wiff_state = gen_wiff_sage_msdt(wiff_rawspectrum_path, wiff_mzml_path, wiff_sage_search_result_path, wiff_output, wiff_unify_residue)
+            wiff_state = generate_cached(wiff_output, wiff_key, gen_wiff_sage_msdt, wiff_rawspectrum_path, wiff_mzml_path, wiff_sage_search_result_path, wiff_output, wiff_unify_residue, {'data_type': 'wiff', 'engine': 'sage'}, fused=wiff_fused)
     
     result_state = 0
     done_parquet_list = []
+    if batch_state != 0:
+        result_state = -1
     if mzml_need:
         if mzml_sage_state != 0 or mzml_fp_state != 0:
             result_state = -1
@@ -2,12 +2,20 @@ import os
 import logging
 import subprocess
 
+from scripts import step_cache, telemetry
+
 # Configure logger (accessible by caller)
 logger = logging.getLogger(__name__)
 
 deal_mzml_rawspectrum = "./linux_mzml_rawspectrum"
 deal_tims_rawspectrum = "./linux_d_rawspectrum"
 deal_wiff_rawspectrum = "./wiff_mzml_rawspecturm"
+# extractor of every data type; each is called as <tool> <input> <output tsv>
+rawspectrum_tools = {
+    'mzml': deal_mzml_rawspectrum,
+    'tims': deal_tims_rawspectrum,
+    'wiff2mzml': deal_wiff_rawspectrum
+}
 
 
 def generate_rawspectrum_fn(param):
@@ -22,46 +30,54 @@ def generate_rawspectrum_fn(param):
     data_type = param.get('data_type')
     raw_data_path = param.get('input')
     output_path = param.get('output')
+    # the extractor writes under a temp path that is renamed into place once it succeeded
+    temp = step_cache.temp_path(output_path)
 
     if not os.path.exists(raw_data_path):
         logger.error(f"Input file does not exist: {raw_data_path}")
         return 2
 
-    if os.path.exists(output_path):
-        logger.info(f"Output already exists, skipping: {output_path}")
-        return 1
-    
-    # Create the output directory if it does not exist
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
     if data_type == 'mzml':
         if not raw_data_path.endswith('.mzML'):
             logger.error(f"Input file extension is not .mzML: {raw_data_path}")
             return 2
-        cmd = [deal_mzml_rawspectrum, raw_data_path, output_path]
+        cmd = [deal_mzml_rawspectrum, raw_data_path, temp]
     elif data_type == 'tims':
         if not raw_data_path.endswith('.d'):
             logger.error(f"Input file extension is not .tims: {raw_data_path}")
             return 2
-        cmd = [deal_tims_rawspectrum, raw_data_path, output_path]
+        cmd = [deal_tims_rawspectrum, raw_data_path, temp]
     elif data_type == 'wiff2mzml':
         if not raw_data_path.endswith('.mzML'):
             logger.error(f"Input file extension is not .mzML: {raw_data_path}")
             return 2
-        cmd = [deal_wiff_rawspectrum, raw_data_path, output_path]
+        cmd = [deal_wiff_rawspectrum, raw_data_path, temp]
     else:
         logger.error(f"Unknown data type: {data_type}")
         return -1
 
+    cache_key = step_cache.step_key([raw_data_path], {'data_type': data_type}, step_cache.tool_version(cmd[0]))
+    if step_cache.is_cached(output_path, cache_key):
+        logger.info(f"Output already exists, skipping: {output_path}")
+        return 1
+    step_cache.invalidate(output_path)
+
+    # Create the output directory if it does not exist
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
     try:
         logger.info(f"Generating: {output_path}")
         logger.info(f"Executing command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        result = telemetry.run_command(cmd, check=True, capture_output=True, text=True)
+        step_cache.commit(temp, output_path)
         logger.info(f"Successfully generated: {output_path}")
+        step_cache.store(output_path, cache_key)
         return 0
     except subprocess.CalledProcessError as e:
         logger.error(f"Generation failed: {e.stderr}")
         return -1
     except Exception as e:
         logger.exception(f"Unexpected error: {e}")
-        return -1
\ No newline at end of file
+        return -1
+    finally:
+        step_cache.discard(temp)
\ No newline at end of file
@@ -1,89 +1,283 @@
 import logging
+import mmap
+import multiprocessing
 import os
-import pandas as pd
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scripts import step_cache, msdt_dataset, telemetry, peak_processing, parquet_profiles
 
 # Configure logger (accessible by caller)
 logger = logging.getLogger(__name__)
 
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_CHUNK_SIZE_MB = 64
+field_types = {'int': pa.int64(), 'float': pa.float64(), 'string': pa.string()}
+peak_type = pa.list_(pa.float32())
+# every line holds exactly two whitespace separated tokens
+peak_block_pattern = re.compile(r'(?:\S+[^\S\n]+\S+\n)*')
+
+
+def mgf_schema(field_config):
+    """Peak lists first, then one column per configured field; unknown types are stored as strings."""
+    fields = [pa.field('mz', peak_type), pa.field('intensity', peak_type)]
+    fields += [pa.field(key, field_types.get(dtype, pa.string())) for key, dtype in field_config.items()]
+    return pa.schema(fields)
+
+
+def parse_field(current, key, value, field_config, strict_charge=True):
+    """
+    Store one metadata value of the current spectrum, converted to its configured type.
+    An unparsable integer CHARGE raises ValueError, or is stored as null when strict_charge is off.
+    """
+    if key == "CHARGE" and field_config[key] == 'int':
+        val = value.strip()
+        try:
+            if val.endswith("+") or val.endswith("-"):
+                current[key] = int(val[:-1]) * (1 if val.endswith("+") else -1)
+            else:
+                current[key] = int(val)  # Handle unsigned case as well
+        except ValueError:
+            if strict_charge:
+                raise ValueError(f"Unparsable charge {val!r}") from None
+            logger.warning(f"Unparsable charge {val!r}, stored as null")
+    # Convert to the specified data type
+    else:
+        dtype = field_config[key]
+        if dtype == "int":
+            try:
+                current[key] = int(value)
+            except ValueError:
+                pass
+        elif dtype == "float":
+            try:
+                current[key] = float(value.split()[0])  # e.g., "380.18 12345"
+            except ValueError:
+                pass
+        else:  # Default to string
+            current[key] = value.strip()
+
+
+def decode_peaks(peak_lines):
+    """
+    Decode "mz intensity" lines in one pass.
+    Falls back to line by line parsing when a line is malformed; such lines are skipped.
+    Returns mz, intensity and a mask of the lines that were kept.
+    """
+    if not peak_lines:
+        return np.empty(0), np.empty(0), np.ones(0, dtype=bool)
+    text = '\n'.join(peak_lines) + '\n'
+    if peak_block_pattern.fullmatch(text):
+        try:
+            values = np.array(text.split(), dtype=np.float64).reshape(-1, 2)
+            return values[:, 0], values[:, 1], np.ones(len(peak_lines), dtype=bool)
+        except ValueError:
+            pass
+    mz, intensity, keep = [], [], []
+    for line in peak_lines:
+        try:
+            m, i = map(float, line.split())
+            mz.append(m)
+            intensity.append(i)
+            keep.append(True)
+        except ValueError:
+            keep.append(False)  # Skip malformed lines
+    return np.array(mz, dtype=np.float64), np.array(intensity, dtype=np.float64), np.array(keep, dtype=bool)
+
+
+def new_batch(field_config):
+    return {'line_offsets': [0], 'peak_lines': [], 'fields': {key: [] for key in field_config}}
+
+
+def build_batch(batch, schema, peak_config=None):
+    """
+    Turn the buffered spectra into one record batch; fields missing from a spectrum are null.
+    peak_config selects the peak_processing stages, with PEPMASS as precursor m/z when it is parsed.
+    """
+    mz, intensity, keep = decode_peaks(batch['peak_lines'])
+    kept = np.concatenate([[0], np.cumsum(keep)])
+    offsets = kept[batch['line_offsets']]
+    if peak_config:
+        precursor_mz = batch['fields'].get('PEPMASS')
+        if precursor_mz is not None:
+            precursor_mz = np.array([np.nan if value is None else value for value in precursor_mz], dtype=np.float64)
+        offsets, mz, intensity = peak_processing.process_peaks(offsets, mz, intensity, peak_config, precursor_mz)
+    offsets = pa.array(offsets, pa.int32())
+    columns = [
+        pa.ListArray.from_arrays(offsets, pa.array(mz, pa.float32())),
+        pa.ListArray.from_arrays(offsets, pa.array(intensity, pa.float32()))
+    ]
+    for field in list(schema)[2:]:
+        columns.append(pa.array(batch['fields'][field.name], field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def spectrum_batches(lines, field_config, batch_size, peak_config=None, strict_charge=True):
+    """Parse MGF lines into record batches of at most batch_size spectra."""
+    schema = mgf_schema(field_config)
+    batch = new_batch(field_config)
+    current = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("COM="):
+            # Global comment, ignore
+            continue
+
+        if line == "BEGIN IONS":
+            current = {}
+            peak_lines = []
+            continue
+
+        if line == "END IONS":
+            if current is not None:
+                batch['peak_lines'].extend(peak_lines)
+                batch['line_offsets'].append(len(batch['peak_lines']))
+                for key, values in batch['fields'].items():
+                    values.append(current.get(key))
+                current = None
+                if len(batch['line_offsets']) > batch_size:
+                    yield build_batch(batch, schema, peak_config)
+                    batch = new_batch(field_config)
+            continue
+
+        if current is None:
+            continue
+
+        if "=" in line:  # Metadata line
+            key, value = line.split("=", 1)
+            key = key.strip().upper()
+            if key in field_config:
+                parse_field(current, key, value, field_config, strict_charge)
+        else:  # mz-intensity line
+            peak_lines.append(line)
+
+    if len(batch['line_offsets']) > 1:
+        yield build_batch(batch, schema, peak_config)
+
+
+def split_mgf(mgf_path, chunk_bytes):
+    """Byte ranges of roughly chunk_bytes, each starting at a "BEGIN IONS" line."""
+    size = os.path.getsize(mgf_path)
+    if size == 0:
+        return [(0, 0)]
+    bounds = [0]
+    with open(mgf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = chunk_bytes
+        while pos < size:
+            pos = mm.find(b'\nBEGIN IONS', pos)
+            if pos < 0:
+                break
+            line_end = mm.find(b'\n', pos + 1)
+            line_end = size if line_end < 0 else line_end
+            if mm[pos + 1:line_end].strip() == b'BEGIN IONS':
+                bounds.append(pos + 1)
+                pos = bounds[-1] + chunk_bytes
+            else:
+                pos = line_end
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_chunk(mgf_path, start, end, field_config, batch_size, peak_config=None, strict_charge=True):
+    """Parse one byte range of the MGF file (runs in a worker process)."""
+    if end <= start:
+        return []
+    with open(mgf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode('utf-8')
+    # same line endings as reading the file in text mode
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return list(spectrum_batches(lines, field_config, batch_size, peak_config, strict_charge))
+
+
+def parallel_batches(mgf_path, field_config, batch_size, workers, chunk_bytes, peak_config=None, strict_charge=True):
+    """Parse the chunks in worker processes and hand back their batches in spectrum order."""
+    chunks = split_mgf(mgf_path, chunk_bytes)
+    logger.info(f"Parsing {mgf_path} in {len(chunks)} chunks with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        in_flight = deque()
+        for start, end in chunks:
+            in_flight.append(pool.submit(parse_chunk, mgf_path, start, end, field_config, batch_size, peak_config, strict_charge))
+            if len(in_flight) >= 2 * workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
 def mgf_to_parquet(param):
-    if os.path.exists(param['output_path']):
+    """
+    Convert an MGF file to Parquet, or to a sharded dataset directory when param['dataset'] is set.
+    Return values:
+        0: Successfully generated
+        1: Already exists, no need to generate
+        2: Input file does not exist
+        -1: Generation failed
+    """
+    dataset = param.get('dataset')
+    peak_config = peak_processing.check_config(param.get('peaks'))
+    profile = parquet_profiles.check_profile(param.get('profile'))
+    strict_charge = bool(param.get('strict_charge', True))
+    cache_config = {'field_type_dict': param['field_type_dict'], 'dataset': dataset, 'peaks': peak_config, 'profile': profile,
+                    'strict_charge': strict_charge}
+    cache_key = step_cache.step_key([param['mgf_path']], cache_config)
+    if step_cache.is_cached(param['output_path'], cache_key):
         logger.info(f"{param['output_path']} already exists")
         return 1
     if not os.path.exists(param['mgf_path']):
         logger.error(f"Missing {param['mgf_path']}")
         return 2
+    output_path = param['output_path']
+    field_config = param['field_type_dict']
+    batch_size = int(param.get('batch_size', DEFAULT_BATCH_SIZE))
+    workers = int(param.get('workers', 1))
+    chunk_bytes = int(param.get('chunk_size_mb', DEFAULT_CHUNK_SIZE_MB)) << 20
+    step_cache.invalidate(output_path)
+    # written under a temp path and renamed into place once complete
+    temp = step_cache.temp_path(output_path)
+    writer = None
     try:
-        records = []
-        current = None
-        field_config = param['field_type_dict']
-        with open(param['mgf_path'], "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-
-                if line.startswith("COM="):
-                    # Global comment, ignore
-                    continue
-
-                if line == "BEGIN IONS":
-                    current = {"mz": [], "intensity": []}
-                    continue
-
-                if line == "END IONS":
-                    if current:
-                        # Ensure mz/intensity are at least empty lists
-                        for k in ["mz", "intensity"]:
-                            current[k] = current[k] if current[k] else []
-                        records.append(current)
-                        current = None
-                    continue
-
-                if current is None:
-                    continue
-
-                if "=" in line:  # Metadata line
-                    key, value = line.split("=", 1)
-                    key = key.strip().upper()
-                    if key in field_config:
-                        if key == "CHARGE" and field_config[key] == 'int':
-                            val = value.strip()
-                            try:
-                                if val.endswith("+") or val.endswith("-"):
-                                    current[key] = int(val[:-1]) * (1 if val.endswith("+") else -1)
-                                else:
-                                    current[key] = int(val)  # Handle unsigned case as well
-                            except ValueError:
-                                current[key] = val
-                        # Convert to the specified data type
-                        else:
-                            dtype = field_config[key]
-                            if dtype == "int":
-                                try:
-                                    current[key] = int(value)
-                                except ValueError:
-                                    pass
-                            elif dtype == "float":
-                                try:
-                                    current[key] = float(value.split()[0])  # e.g., "380.18 12345"
-                                except ValueError:
-                                    pass
-                            else:  # Default to string
-                                current[key] = value.strip()
-                else:  # mz-intensity line
-                    try:
-                        mz, intensity = map(float, line.split())
-                        current["mz"].append(mz)
-                        current["intensity"].append(intensity)
-                    except ValueError:
-                        pass  # Skip malformed lines
-
-        # Build DataFrame
-        df = pd.DataFrame(records)
-        # Convert to Parquet
-        df.to_parquet(param['output_path'])
-        logger.info(f"{param['output_path']} has been successfully generated")
+        schema = mgf_schema(field_config)
+        if dataset:
+            os.makedirs(temp, exist_ok=True)
+            writer = msdt_dataset.ShardWriter(msdt_dataset.partition_dir(temp, dataset.get('partition')), schema,
+                                              target_shard_mb=dataset.get('target_shard_mb', msdt_dataset.DEFAULT_SHARD_MB),
+                                              row_group_size=dataset.get('row_group_size', msdt_dataset.DEFAULT_ROW_GROUP_SIZE),
+                                              profile=profile)
+            write_batch = lambda batch: writer.write(pa.Table.from_batches([batch]))
+        else:
+            schema = parquet_profiles.with_profile_metadata(schema, profile)
+            writer = pq.ParquetWriter(temp, schema, **parquet_profiles.writer_kwargs(profile, schema))
+            write_batch = writer.write_batch
+        if workers > 1:
+            for batch in parallel_batches(param['mgf_path'], field_config, batch_size, workers, chunk_bytes, peak_config, strict_charge):
+                telemetry.count_rows('read', batch.num_rows)
+                write_batch(batch)
+        else:
+            with open(param['mgf_path'], "r") as f:
+                for batch in spectrum_batches(f, field_config, batch_size, peak_config, strict_charge):
+                    telemetry.count_rows('read', batch.num_rows)
+                    write_batch(batch)
+        if dataset:
+            msdt_dataset.write_metadata(temp, writer.close())
+        else:
+            writer.close()
+        step_cache.commit(temp, output_path)
+        logger.info(f"{output_path} has been successfully generated")
+        step_cache.store(output_path, cache_key)
         return 0
     except Exception as e:
         logger.exception(f"Unexpected error: {e}")
+        # Do not leave a partial output behind
+        if dataset:
+            if writer is not None:
+                writer.abort()
+        elif writer is not None:
+            writer.close()
+        step_cache.discard(temp)
         return -1
@@ -1,15 +1,21 @@
 import os
 import logging
+import multiprocessing
 import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import pandas as pd
-import sys
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from scripts import step_cache, telemetry
 
 # Configure logger (accessible by caller)
 logger = logging.getLogger(__name__)
 
-# mgf template
-mgf_template = """BEGIN IONS
+# mgf template, the peak lines and "END IONS" follow each header
+mgf_header_template = """BEGIN IONS
 TITLE={title}
 PEPMASS={pepmass}
 CHARGE={charge}
@@ -18,10 +24,66 @@ RTINSECONDS={rt}
 SEQ={seq}
 LABEL={label}
 PROTEIN={protein}
-{spectrum}
-END IONS
-
 """
+mgf_end = "END IONS\n\n"
+peak_line = "%.4f %.2f\n"  # control output precision
+
+msdt_columns = ['scan', 'precursor_mz', 'charge', 'rt', 'label', 'mz_array', 'intensity_array', 'precursor_sequence', 'proteins']
+# per-PSM columns, stored as lists in Sage MSDT files (one entry per PSM of the scan)
+psm_columns = ['precursor_sequence', 'proteins', 'charge', 'label']
+
+DEFAULT_BATCH_SIZE = 4096
+
+
+def format_peak_blocks(mz_array, intensity_array):
+    """Render the peak lines of every spectrum in a batch; numbers are converted to Python floats in one pass."""
+    offsets = mz_array.offsets.to_numpy()
+    mz = pc.list_flatten(mz_array).to_numpy(zero_copy_only=False)
+    intensity = pc.list_flatten(intensity_array).to_numpy(zero_copy_only=False)
+    start = offsets[0]
+    values = np.empty(2 * len(mz), dtype=np.float64)
+    values[0::2] = mz
+    values[1::2] = intensity
+    values = values.tolist()
+    blocks = []
+    for first, last in zip(offsets[:-1] - start, offsets[1:] - start):
+        if last > first:
+            blocks.append((peak_line * int(last - first)) % tuple(values[2 * first:2 * last]))
+        else:
+            blocks.append("\n")
+    return blocks
+
+
+def format_batch(batch, title):
+    """Render one record batch of an MSDT file as MGF text, one entry per PSM."""
+    batch = batch.filter(pc.and_(pc.is_valid(batch['mz_array']), pc.is_valid(batch['intensity_array'])))
+    blocks = format_peak_blocks(batch['mz_array'], batch['intensity_array'])
+    if pa.types.is_list(batch.schema.field('label').type):
+        rows = pc.list_parent_indices(batch['label']).to_numpy()
+        psm = {c: pc.list_flatten(batch[c]).to_pylist() for c in psm_columns}
+    else:
+        rows = np.arange(batch.num_rows)
+        psm = {c: batch[c].to_pylist() for c in psm_columns}
+    scan = batch['scan'].to_pylist()
+    pepmass = batch['precursor_mz'].to_pylist()
+    rt = pc.multiply(batch['rt'], 60).to_pylist()  # minutes to seconds
+
+    parts = []
+    for i, row in enumerate(rows.tolist()):
+        parts.append(mgf_header_template.format(
+            title=title,
+            pepmass=pepmass[row],
+            charge=str(int(psm['charge'][i])) + '+',
+            scan=scan[row],
+            rt=rt[row],
+            seq=psm['precursor_sequence'][i],
+            label=psm['label'][i],
+            protein=psm['proteins'][i]
+        ))
+        parts.append(blocks[row])
+        parts.append(mgf_end)
+    return ''.join(parts)
+
 
 def msdt2mgf(param):
     """
@@ -34,52 +96,45 @@ def msdt2mgf(param):
     """
     msdt_path = param.get('msdt_path')
     output_path = param.get('output_path')
+    workers = int(param.get('workers', 1))
+    batch_size = int(param.get('batch_size', DEFAULT_BATCH_SIZE))
 
     if not os.path.exists(msdt_path):
         logger.error(f"Input file does not exist: {msdt_path}")
         return 2
 
-    if os.path.exists(output_path):
+    cache_key = step_cache.step_key([msdt_path])
+    if step_cache.is_cached(output_path, cache_key):
         logger.info(f"Output already exists, skipping: {output_path}")
         return 1
-    
+    step_cache.invalidate(output_path)
+
     # Create the output directory if it does not exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
+    # written under a temp path and renamed into place once complete
+    temp = step_cache.temp_path(output_path)
     try:
-        spec_df = pd.read_parquet(msdt_path)
-        spec_df = spec_df[['scan','precursor_mz','charge','rt','label','mz_array','intensity_array','precursor_sequence','proteins']]
-        if isinstance(spec_df['label'][0], np.ndarray):
-            spec_df = spec_df.explode(['precursor_sequence','proteins','charge','label'])
-        spec_df = spec_df.dropna(subset=['mz_array','intensity_array'])
-
-        mgf_lines = []
-        for _, row in spec_df.iterrows():
-            try:
-                mgf_lines.append(mgf_template.format(
-                    title=msdt_path,
-                    pepmass=row['precursor_mz'],
-                    charge=str(int(row['charge'])) + '+',
-                    scan=row['scan'],
-                    rt=row['rt'] * 60,  # minutes to seconds
-                    seq=row['precursor_sequence'],
-                    label=row['label'],
-                    protein=row['proteins'],
-                    spectrum="\n".join(
-                        f"{mz:.4f} {intensity:.2f}"  # control output precision
-                        for mz, intensity in zip(
-                            row['mz_array'], 
-                            row['intensity_array']
-                        )
-                    )
-                ))
-            except Exception as e:
-                print(f"Error processing row: {e}")
-                sys.exit(1)
-        
-        with open(output_path, 'w') as f:
-            f.writelines(mgf_lines)
+        batches = pq.ParquetFile(msdt_path).iter_batches(batch_size=batch_size, columns=msdt_columns)
+        with open(temp, 'w', buffering=1 << 20) as f:
+            if workers <= 1:
+                for batch in batches:
+                    telemetry.count_rows('read', batch.num_rows)
+                    f.write(format_batch(batch, msdt_path))
+            else:
+                # keep a bounded window of batches in flight and write them back in input order
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    in_flight = deque()
+                    for batch in batches:
+                        telemetry.count_rows('read', batch.num_rows)
+                        in_flight.append(pool.submit(format_batch, batch, msdt_path))
+                        if len(in_flight) >= 2 * workers:
+                            f.write(in_flight.popleft().result())
+                    while in_flight:
+                        f.write(in_flight.popleft().result())
+        os.replace(temp, output_path)
         logger.info(f"Successfully generated: {output_path}")
+        step_cache.store(output_path, cache_key)
         return 0
 
     except subprocess.CalledProcessError as e:
@@ -87,4 +142,5 @@ def msdt2mgf(param):
         return -1
     except Exception as e:
         logger.exception(f"Unexpected error: {e}")
+        step_cache.discard(temp)
         return -1
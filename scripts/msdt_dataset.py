@@ -0,0 +1,169 @@
+import glob
+import logging
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from scripts import parquet_profiles, step_cache
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+SHARD_PREFIX = 'part-'
+METADATA_FILE = '_metadata'
+COMMON_METADATA_FILE = '_common_metadata'
+DEFAULT_SHARD_MB = 256
+DEFAULT_ROW_GROUP_SIZE = 4096
+
+
+def partition_dir(root, partition):
+    """Hive style directory of a partition, e.g. root/data_type=mzml/engine=sage."""
+    return os.path.join(root, *[f"{key}={value}" for key, value in (partition or {}).items()])
+
+
+class ShardWriter:
+    """
+    Write tables into shards of about target_shard_mb on disk (part-00000.parquet, ...)
+    with row groups of row_group_size rows, encoded with a parquet_profiles profile.
+    on_shard is called with the path of every finished shard.
+    """
+
+    def __init__(self, directory, schema, target_shard_mb=DEFAULT_SHARD_MB, row_group_size=DEFAULT_ROW_GROUP_SIZE, on_shard=None,
+                 profile=None):
+        self.directory = directory
+        self.schema = parquet_profiles.with_profile_metadata(schema, profile)
+        self.profile = profile
+        self.target_bytes = int(float(target_shard_mb) * (1 << 20))
+        self.row_group_size = int(row_group_size)
+        self.on_shard = on_shard
+        self.paths = []
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+
+    def _write_row_group(self, table):
+        if self.writer is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.paths.append(os.path.join(self.directory, f"{SHARD_PREFIX}{len(self.paths):05d}.parquet"))
+            self.writer = pq.ParquetWriter(self.paths[-1], self.schema, **parquet_profiles.writer_kwargs(self.profile, self.schema))
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        if os.path.getsize(self.paths[-1]) >= self.target_bytes:
+            self._close_shard()
+
+    def _close_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.on_shard is not None:
+                self.on_shard(self.paths[-1])
+
+    def write(self, table):
+        self.pending.append(table)
+        self.pending_rows += table.num_rows
+        if self.pending_rows >= self.row_group_size:
+            buffered = pa.concat_tables(self.pending)
+            full = buffered.num_rows - buffered.num_rows % self.row_group_size
+            for offset in range(0, full, self.row_group_size):
+                self._write_row_group(buffered.slice(offset, self.row_group_size))
+            self.pending = [buffered.slice(full)]
+            self.pending_rows = buffered.num_rows - full
+
+    def abort(self):
+        """Stop writing after an error; the caller removes the partial shards."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def close(self):
+        """Write the remaining rows and return the shard paths."""
+        if self.pending_rows or not self.paths:
+            self._write_row_group(pa.concat_tables(self.pending) if self.pending else self.schema.empty_table())
+        self.pending, self.pending_rows = [], 0
+        self._close_shard()
+        return self.paths
+
+
+def clear_dataset(root):
+    """Remove the shards and summary files of an earlier write to root; other files are left alone."""
+    if not os.path.isdir(root):
+        return
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            if name.startswith(SHARD_PREFIX) or name in (METADATA_FILE, COMMON_METADATA_FILE):
+                os.remove(os.path.join(dirpath, name))
+
+
+def write_metadata(root, shard_paths):
+    """
+    Write the dataset-level _metadata (row group footers of every shard, with paths relative to root)
+    and _common_metadata. Shards whose schema differs from the first one are left out.
+    """
+    if not shard_paths:
+        return
+    schema = pq.read_schema(shard_paths[0])
+    collector = []
+    for path in shard_paths:
+        metadata = pq.read_metadata(path)
+        if not metadata.schema.to_arrow_schema().equals(schema, check_metadata=False):
+            logger.warning(f"{path} has another schema, left out of {root}/{METADATA_FILE}")
+            continue
+        metadata.set_file_path(os.path.relpath(path, root))
+        collector.append(metadata)
+    # summaries are replaced whole, so several workers may summarize one cohort root
+    for name, kwargs in ((METADATA_FILE, {'metadata_collector': collector}), (COMMON_METADATA_FILE, {})):
+        temp = step_cache.temp_path(os.path.join(root, name))
+        pq.write_metadata(schema, temp, **kwargs)
+        os.replace(temp, os.path.join(root, name))
+    logger.info(f"Wrote {root}/{METADATA_FILE} for {len(collector)} shards")
+
+
+def summarize_dataset(root):
+    """(Re)write root/_metadata over every shard below root, e.g. after several runs wrote into sub-directories."""
+    shard_paths = sorted(glob.glob(os.path.join(root, '**', f'{SHARD_PREFIX}*.parquet'), recursive=True))
+    # leave out runs that are still being written (or were abandoned) under a temp directory
+    shard_paths = [path for path in shard_paths
+                   if not any(step_cache.is_temp(part) for part in os.path.relpath(path, root).split(os.sep))]
+    write_metadata(root, shard_paths)
+
+
+def _split_by_columns(table, columns, values=None):
+    """Yield ({column: value}, rows without the columns) for every combination of partition column values."""
+    values = values or {}
+    if not columns:
+        yield values, table
+        return
+    column = columns[0]
+    for value in pc.unique(table[column]).to_pylist():
+        mask = pc.is_null(table[column]) if value is None else pc.equal(table[column], value)
+        part = table.filter(mask)
+        yield from _split_by_columns(part.drop_columns([column]), columns[1:], {**values, column: value})
+
+
+def write_dataset(table, root, partition=None, partition_by=(), target_shard_mb=DEFAULT_SHARD_MB,
+                  row_group_size=DEFAULT_ROW_GROUP_SIZE, on_shard=None, profile=None):
+    """
+    Write table as a sharded dataset below root, keeping its row order inside every partition.
+    partition holds constant keys (e.g. data_type, engine), partition_by names columns whose values
+    split the rows into directories; list columns (Sage PSM lists) cannot be used and are skipped.
+    Returns the shard paths.
+    """
+    columns = []
+    for column in partition_by:
+        if column not in table.column_names:
+            continue
+        if pa.types.is_list(table.schema.field(column).type):
+            logger.warning(f"Cannot partition by the list column {column}, skipped")
+            continue
+        columns.append(column)
+
+    clear_dataset(root)
+    shard_paths = []
+    for values, part in _split_by_columns(table, columns):
+        writer = ShardWriter(partition_dir(root, {**(partition or {}), **values}), part.schema,
+                             target_shard_mb=target_shard_mb, row_group_size=row_group_size, on_shard=on_shard,
+                             profile=profile)
+        writer.write(part)
+        shard_paths += writer.close()
+    write_metadata(root, shard_paths)
+    return shard_paths
@@ -0,0 +1,111 @@
+import logging
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from scripts import step_cache
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.index.arrow'
+SCAN = 'scan'
+PEPTIDE = 'precursor_sequence'
+
+
+def index_path(msdt_path):
+    return msdt_path + INDEX_SUFFIX
+
+
+def write_index(msdt_path):
+    """
+    Write the sidecar index of an MSDT file sorted by scan:
+    one row per spectrum with its scan, row group, row within the row group and peptides.
+    """
+    parquet_file = pq.ParquetFile(msdt_path)
+    group_rows = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+    columns = [c for c in (SCAN, PEPTIDE) if c in parquet_file.schema_arrow.names]
+    table = parquet_file.read(columns=columns)
+    index = {
+        SCAN: table[SCAN],
+        'row_group': pa.array(np.repeat(np.arange(len(group_rows), dtype=np.int32), group_rows)),
+        'row': pa.array(np.concatenate([np.arange(n, dtype=np.int32) for n in group_rows]) if group_rows else np.zeros(0, dtype=np.int32))
+    }
+    if PEPTIDE in columns:
+        peptides = table[PEPTIDE].combine_chunks()
+        # FragPipe MSDT files hold one peptide per scan, Sage files a list per scan
+        if not pa.types.is_list(peptides.type):
+            offsets = pa.array(np.arange(len(peptides) + 1, dtype=np.int32))
+            peptides = pa.ListArray.from_arrays(offsets, peptides.cast(pa.string()))
+        index['peptides'] = peptides
+    index = pa.table(index).replace_schema_metadata({'msdt_size': str(os.path.getsize(msdt_path))})
+    temp = step_cache.temp_path(index_path(msdt_path))
+    feather.write_feather(index, temp, compression='zstd')
+    os.replace(temp, index_path(msdt_path))
+    logger.info(f"Wrote scan index {index_path(msdt_path)}")
+
+
+def read_index(msdt_path):
+    """The sidecar index of msdt_path, or None when it is missing or was written for another version of the file."""
+    path = index_path(msdt_path)
+    if not os.path.exists(path):
+        return None
+    index = feather.read_table(path)
+    if (index.schema.metadata or {}).get(b'msdt_size', b'').decode() != str(os.path.getsize(msdt_path)):
+        logger.warning(f"{path} does not match {msdt_path}, ignoring it")
+        return None
+    return index
+
+
+def scans_of_peptides(index, peptides):
+    """Scans whose PSMs include any of the peptides."""
+    flat = pc.list_flatten(index['peptides'])
+    parents = pc.list_parent_indices(index['peptides'])
+    hits = pc.filter(parents, pc.is_in(flat, value_set=pa.array(peptides, pa.string())))
+    return np.unique(index[SCAN].take(hits).to_numpy())
+
+
+def _row_groups_by_statistics(parquet_file, scans):
+    """Row groups whose scan min/max statistics may contain one of the scans."""
+    position = parquet_file.schema_arrow.get_field_index(SCAN)
+    groups = []
+    for i in range(parquet_file.num_row_groups):
+        statistics = parquet_file.metadata.row_group(i).column(position).statistics
+        if statistics is None or not statistics.has_min_max:
+            groups.append(i)
+        elif np.any((scans >= statistics.min) & (scans <= statistics.max)):
+            groups.append(i)
+    return groups
+
+
+def get_spectra(msdt_path, scans=None, peptides=None, columns=None):
+    """
+    Read the spectra of the given scans and/or peptides from an MSDT file, touching only
+    the row groups that hold them. Rows come back in scan order.
+    """
+    parquet_file = pq.ParquetFile(msdt_path)
+    index = read_index(msdt_path)
+    wanted = np.unique(np.asarray(scans if scans is not None else [], dtype=np.int64))
+    if peptides is not None:
+        if index is None or 'peptides' not in index.column_names:
+            raise ValueError(f"Looking up peptides needs the scan index of {msdt_path}")
+        wanted = np.union1d(wanted, scans_of_peptides(index, peptides))
+
+    if index is not None:
+        hits = index.filter(pc.is_in(index[SCAN], value_set=pa.array(wanted, index.schema.field(SCAN).type)))
+        row_groups = np.unique(hits['row_group'].to_numpy()).tolist()
+        table = parquet_file.read_row_groups(row_groups, columns=columns)
+        group_start = dict(zip(row_groups, np.cumsum([0] + [parquet_file.metadata.row_group(g).num_rows for g in row_groups[:-1]])))
+        rows = [group_start[g] + r for g, r in zip(hits['row_group'].to_pylist(), hits['row'].to_pylist())]
+        return table.take(pa.array(rows, pa.int64()))
+
+    # without an index, prune row groups by their scan statistics and filter the rest
+    row_groups = _row_groups_by_statistics(parquet_file, wanted)
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + [SCAN]))
+    table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+    table = table.filter(pc.is_in(table[SCAN], value_set=pa.array(wanted, table.schema.field(SCAN).type)))
+    table = table.take(pc.sort_indices(table, [(SCAN, 'ascending')]))
+    return table if columns is None else table.select(list(columns))
@@ -0,0 +1,273 @@
+import glob
+import logging
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scripts import msdt_dataset
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+try:
+    import torch
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    # the dataset then yields NumPy arrays
+    torch = None
+    IterableDataset = object
+    get_worker_info = lambda: None
+
+# MSDT files name their peak lists mz_array / intensity_array, mgf_to_parquet outputs mz / intensity
+PEAK_COLUMN_NAMES = [('mz_array', 'intensity_array'), ('mz', 'intensity')]
+DEFAULT_BATCH_SIZE = 256
+
+
+class SpectrumBatch:
+    """
+    Spectra held as flat peak buffers: the peaks of spectrum i are mz[offsets[i]:offsets[i + 1]].
+    Buffers of a record batch or a single chunk column are views on the Arrow data, so no peak is copied;
+    see to_spectrum_batch for when a copy happens. meta is an Arrow table with the other requested columns,
+    one row per spectrum.
+    """
+
+    def __init__(self, offsets, mz, intensity, meta):
+        self.offsets = offsets
+        self.mz = mz
+        self.intensity = intensity
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def spectrum(self, i):
+        """m/z and intensity of spectrum i as NumPy views."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mz[start:end], self.intensity[start:end]
+
+    def take(self, rows):
+        """A new batch with the given spectra (copies their peaks into compact buffers)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return SpectrumBatch(offsets, self.mz[index], self.intensity[index], self.meta.take(pa.array(rows)))
+
+    def padded(self, max_peaks=None, pad_value=0):
+        """
+        Peaks as [spectra, peaks] arrays padded with pad_value, plus the number of peaks of every spectrum.
+        Spectra with more than max_peaks peaks are cut after the first max_peaks (in m/z order).
+        """
+        lengths = self.lengths
+        if max_peaks is not None:
+            lengths = np.minimum(lengths, max_peaks)
+        width = int(max_peaks if max_peaks is not None else (lengths.max() if len(lengths) else 0))
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        columns = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        index = self.offsets[:-1][rows] + columns
+        mz = np.full((len(lengths), width), pad_value, dtype=self.mz.dtype)
+        intensity = np.full((len(lengths), width), pad_value, dtype=self.intensity.dtype)
+        mz[rows, columns] = self.mz[index]
+        intensity[rows, columns] = self.intensity[index]
+        return mz, intensity, lengths
+
+    def ragged(self):
+        """Peaks as zero based offsets and flat buffers covering just these spectra."""
+        start, end = self.offsets[0], self.offsets[-1]
+        return self.offsets - start, self.mz[start:end], self.intensity[start:end]
+
+
+def concat_batches(batches):
+    """One SpectrumBatch from several (copies the peaks)."""
+    batches = [batch for batch in batches if len(batch)]
+    if not batches:
+        return None
+    if len(batches) == 1:
+        return batches[0]
+    offsets, mz, intensity = [np.zeros(1, dtype=np.int64)], [], []
+    for batch in batches:
+        batch_offsets, batch_mz, batch_intensity = batch.ragged()
+        offsets.append(batch_offsets[1:] + offsets[-1][-1])
+        mz.append(batch_mz)
+        intensity.append(batch_intensity)
+    return SpectrumBatch(np.concatenate(offsets), np.concatenate(mz), np.concatenate(intensity),
+                         pa.concat_tables([batch.meta for batch in batches]))
+
+
+def peak_columns(schema):
+    """Names of the m/z and intensity list columns of an MSDT or MGF Parquet schema."""
+    for names in PEAK_COLUMN_NAMES:
+        if all(name in schema.names for name in names):
+            return names
+    raise ValueError(f"No peak list columns in schema with columns {schema.names}")
+
+
+def _list_buffers(column):
+    """
+    Offsets (as int64) and values of a list column, the values as a NumPy view of the whole chunk.
+    A column of several chunks is combined first, and values with nulls are converted, which both copy.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+    if column.null_count:
+        raise ValueError("Peak lists with nulls cannot be read as flat buffers")
+    values = column.values
+    return column.offsets.to_numpy().astype(np.int64), values.to_numpy(zero_copy_only=values.null_count == 0)
+
+
+def to_spectrum_batch(table_or_batch, peak_names=None):
+    """
+    SpectrumBatch over a table or record batch read from an MSDT or MGF Parquet file.
+    The peaks are views on the Arrow data unless a peak column comes in several chunks (e.g. a table
+    read over several row groups) or its values hold nulls; then that column is copied once.
+    """
+    peak_names = peak_names or peak_columns(table_or_batch.schema)
+    offsets, mz = _list_buffers(table_or_batch[peak_names[0]])
+    intensity_offsets, intensity = _list_buffers(table_or_batch[peak_names[1]])
+    if not np.array_equal(offsets - offsets[0], intensity_offsets - intensity_offsets[0]):
+        raise ValueError("m/z and intensity lists differ in length")
+    # both lists may start at different positions of their value buffers: slice both views to start at 0
+    mz, intensity = mz[offsets[0]:], intensity[intensity_offsets[0]:]
+    offsets = offsets - offsets[0]
+    meta_names = [name for name in table_or_batch.schema.names if name not in peak_names]
+    meta = pa.Table.from_batches([table_or_batch]) if isinstance(table_or_batch, pa.RecordBatch) else table_or_batch
+    return SpectrumBatch(offsets, mz, intensity, meta.select(meta_names))
+
+
+def expand_paths(paths):
+    """MSDT files plus the shards below every dataset directory, in a stable order."""
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '**', f'{msdt_dataset.SHARD_PREFIX}*.parquet'), recursive=True))
+        else:
+            files.append(os.fspath(path))
+    return files
+
+
+def read_msdt(path, columns=None, memory_map=True, row_groups=None):
+    """
+    Read an MSDT file (or some of its row groups) as one SpectrumBatch. With memory_map the file
+    is read through a memory map instead of buffered reads. The peak buffers are views on the decoded
+    Arrow columns when a single row group is read; the chunks of several row groups are combined,
+    which copies the peaks once. columns selects the metadata columns (None reads all of them).
+    """
+    parquet_file = pq.ParquetFile(path, memory_map=memory_map)
+    peak_names = peak_columns(parquet_file.schema_arrow)
+    read_columns = None if columns is None else list(peak_names) + [c for c in columns if c not in peak_names]
+    if row_groups is None:
+        table = parquet_file.read(columns=read_columns)
+    else:
+        table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+    return to_spectrum_batch(table, peak_names)
+
+
+def iter_msdt(paths, batch_size=DEFAULT_BATCH_SIZE, columns=None, memory_map=True):
+    """Stream SpectrumBatches of at most batch_size spectra over MSDT files and dataset directories."""
+    for path in expand_paths(paths):
+        parquet_file = pq.ParquetFile(path, memory_map=memory_map)
+        peak_names = peak_columns(parquet_file.schema_arrow)
+        read_columns = None if columns is None else list(peak_names) + [c for c in columns if c not in peak_names]
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=read_columns):
+            yield to_spectrum_batch(batch, peak_names)
+
+
+class MsdtIterableDataset(IterableDataset):
+    """
+    Iterable dataset over MSDT files and dataset directories for training loaders.
+    Yields dicts of batch_size spectra: 'mz', 'intensity' and 'lengths' ([spectra, peaks] padded arrays)
+    or, with padded=False, 'mz', 'intensity' and 'offsets' (flat buffers), plus the metadata columns.
+    Row groups are split between distributed ranks (rank / world_size) and DataLoader workers.
+    With shuffle_buffer > 0 the row group order and the spectra within a buffer of that many
+    spectra are shuffled; call set_epoch to get another order each epoch.
+    Returns torch tensors when torch is installed, NumPy arrays otherwise.
+    """
+
+    def __init__(self, paths, batch_size=DEFAULT_BATCH_SIZE, columns=None, padded=True, max_peaks=None,
+                 shuffle_buffer=0, seed=0, rank=0, world_size=1, memory_map=True, drop_last=False):
+        self.paths = expand_paths(paths)
+        self.batch_size = int(batch_size)
+        self.columns = columns
+        self.padded = padded
+        self.max_peaks = max_peaks
+        self.shuffle_buffer = int(shuffle_buffer)
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.memory_map = memory_map
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.units = [(path, row_group) for path in self.paths
+                      for row_group in range(pq.ParquetFile(path).num_row_groups)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _my_units(self):
+        """Row groups of this rank and DataLoader worker."""
+        units = list(self.units)
+        if self.shuffle_buffer:
+            np.random.default_rng([self.seed, self.epoch]).shuffle(units)
+        worker = get_worker_info()
+        workers, worker_id = (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        shard, shards = self.rank * workers + worker_id, self.world_size * workers
+        return units[shard::shards]
+
+    def _read_units(self):
+        for path, row_group in self._my_units():
+            yield read_msdt(path, columns=self.columns, memory_map=self.memory_map, row_groups=[row_group])
+
+    def _batches(self):
+        """Batches of batch_size spectra, shuffled through the buffer when enabled."""
+        worker = get_worker_info()
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker.id if worker is not None else 0])
+        pool = None
+        for spectra in self._read_units():
+            pool = concat_batches([pool, spectra] if pool is not None else [spectra])
+            if pool is None:
+                continue
+            threshold = max(self.shuffle_buffer, self.batch_size)
+            if len(pool) < threshold:
+                continue
+            order = rng.permutation(len(pool)) if self.shuffle_buffer else np.arange(len(pool))
+            # hand out full batches and keep the rest (about half the buffer when shuffling) for mixing
+            keep = self.shuffle_buffer // 2 if self.shuffle_buffer else 0
+            emit = (len(pool) - keep) // self.batch_size * self.batch_size
+            for start in range(0, emit, self.batch_size):
+                yield pool.take(order[start:start + self.batch_size])
+            pool = pool.take(order[emit:])
+        if pool is not None and len(pool):
+            order = rng.permutation(len(pool)) if self.shuffle_buffer else np.arange(len(pool))
+            for start in range(0, len(pool), self.batch_size):
+                rows = order[start:start + self.batch_size]
+                if len(rows) == self.batch_size or not self.drop_last:
+                    yield pool.take(rows)
+
+    def _to_output(self, batch):
+        if self.padded:
+            mz, intensity, lengths = batch.padded(self.max_peaks)
+            output = {'mz': mz, 'intensity': intensity, 'lengths': lengths}
+        else:
+            offsets, mz, intensity = batch.ragged()
+            output = {'mz': mz, 'intensity': intensity, 'offsets': offsets}
+        for name in batch.meta.column_names:
+            column = batch.meta[name]
+            if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+                output[name] = column.to_numpy()
+            else:
+                output[name] = column.to_pylist()
+        if torch is not None:
+            output = {k: torch.from_numpy(np.ascontiguousarray(v)) if isinstance(v, np.ndarray) else v for k, v in output.items()}
+        return output
+
+    def __iter__(self):
+        for batch in self._batches():
+            yield self._to_output(batch)
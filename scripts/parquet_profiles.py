@@ -0,0 +1,96 @@
+import json
+import logging
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+METADATA_KEY = 'msdt_write_profile'
+DICTIONARY_COLUMNS = ('precursor_sequence', 'proteins')
+
+# compression / compression_level: Parquet codec of every column
+# dictionary: columns to dictionary encode; pyarrow's default also tries it on the peak lists, which only costs time
+# byte_stream_split: BYTE_STREAM_SPLIT for the float32 peak lists, which compresses floats far better
+# delta: integer columns stored DELTA_BINARY_PACKED; only worth it for sorted columns such as scan
+PROFILES = {
+    'fast-write': {
+        'compression': 'lz4',
+        'compression_level': None,
+        'dictionary': list(DICTIONARY_COLUMNS),
+        'byte_stream_split': False,
+        'delta': []
+    },
+    'small': {
+        'compression': 'zstd',
+        'compression_level': 9,
+        'dictionary': list(DICTIONARY_COLUMNS),
+        'byte_stream_split': True,
+        'delta': ['scan']
+    },
+    'training-read': {
+        'compression': 'lz4',
+        'compression_level': None,
+        'dictionary': list(DICTIONARY_COLUMNS),
+        'byte_stream_split': True,
+        'delta': ['scan']
+    }
+}
+
+
+def check_profile(profile):
+    """Validate a profile name; None keeps pyarrow's defaults."""
+    if profile is not None and profile not in PROFILES:
+        raise ValueError(f"Unknown Parquet write profile {profile!r}, use one of {', '.join(PROFILES)}")
+    return profile
+
+
+def _leaf_path(field):
+    """Parquet column path of a top-level field, e.g. mz_array.list.element for a list column."""
+    if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+        return f"{field.name}.list.element"
+    return field.name
+
+
+def _value_type(field):
+    if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+        return field.type.value_type
+    return field.type
+
+
+def writer_kwargs(profile, schema):
+    """
+    Keyword arguments of pq.write_table / pq.ParquetWriter for a profile and the schema written with it.
+    pyarrow updates the column_encoding dict it is given, so every call builds a new one.
+    """
+    if profile is None:
+        return {}
+    settings = PROFILES[check_profile(profile)]
+    kwargs = {'compression': settings['compression']}
+    if settings['compression_level'] is not None:
+        kwargs['compression_level'] = settings['compression_level']
+    column_encoding = {}
+    for field in schema:
+        if field.name in settings['delta'] and pa.types.is_integer(field.type):
+            column_encoding[field.name] = 'DELTA_BINARY_PACKED'
+        elif settings['byte_stream_split'] and _leaf_path(field) != field.name and pa.types.is_float32(_value_type(field)):
+            column_encoding[_leaf_path(field)] = 'BYTE_STREAM_SPLIT'
+    kwargs['use_dictionary'] = [_leaf_path(field) for field in schema if field.name in settings['dictionary']]
+    if column_encoding:
+        kwargs['column_encoding'] = column_encoding
+    return kwargs
+
+
+def with_profile_metadata(schema, profile):
+    """Record the profile and its settings in the schema metadata, which ends up in the file footer."""
+    if profile is None:
+        return schema
+    metadata = dict(schema.metadata or {})
+    metadata[METADATA_KEY.encode()] = json.dumps({'profile': profile, **PROFILES[profile]}).encode()
+    return schema.with_metadata(metadata)
+
+
+def read_profile(path):
+    """The write profile recorded in a Parquet file, or None for files written with the defaults."""
+    value = (pq.read_schema(path).metadata or {}).get(METADATA_KEY.encode())
+    return json.loads(value) if value else None
@@ -0,0 +1,111 @@
+import logging
+import numpy as np
+import pyarrow as pa
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+# mz_min / mz_max: keep peaks inside the m/z window
+# remove_precursor_da: drop peaks within this many Da of the precursor m/z
+# min_relative_intensity: drop peaks below this fraction of the base peak
+# top_n: keep the N most intense peaks of every spectrum (ties keep the lower m/z)
+# normalize: 'base_peak' (base peak = 1), 'sqrt' (square root, then base peak = 1) or 'sum' (intensities sum to 1)
+STAGES = ('mz_min', 'mz_max', 'remove_precursor_da', 'min_relative_intensity', 'top_n', 'normalize')
+NORMALIZATIONS = ('base_peak', 'sqrt', 'sum')
+
+
+def check_config(peak_config):
+    """Validate a peak processing config; an empty or missing config keeps every peak unchanged."""
+    peak_config = {k: v for k, v in (peak_config or {}).items() if v is not None}
+    unknown = set(peak_config) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown peak processing settings: {', '.join(sorted(unknown))}")
+    if peak_config.get('normalize') not in (None,) + NORMALIZATIONS:
+        raise ValueError(f"Unknown peak normalization {peak_config['normalize']!r}, use one of {', '.join(NORMALIZATIONS)}")
+    if 'top_n' in peak_config and int(peak_config['top_n']) < 1:
+        raise ValueError(f"top_n must be at least 1, got {peak_config['top_n']}")
+    return peak_config
+
+
+def _segment_reduce(ufunc, values, offsets, empty):
+    """ufunc.reduceat over the spectra; spectra without peaks get empty."""
+    counts = np.diff(offsets)
+    result = np.full(len(counts), empty, dtype=values.dtype if len(values) else np.float32)
+    filled = counts > 0
+    if filled.any():
+        result[filled] = ufunc.reduceat(values, offsets[:-1][filled])
+    return result
+
+
+def process_peaks(offsets, mz, intensity, peak_config, precursor_mz=None):
+    """
+    Apply the configured stages to flat peak buffers, where the peaks of spectrum i are
+    mz[offsets[i]:offsets[i + 1]]. Peaks keep their order. Returns new offsets, mz and intensity.
+    """
+    peak_config = check_config(peak_config)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if not peak_config:
+        return offsets, mz, intensity
+    counts = np.diff(offsets)
+    spectrum = np.repeat(np.arange(len(counts)), counts)
+    keep = np.ones(len(mz), dtype=bool)
+
+    if 'mz_min' in peak_config:
+        keep &= mz >= peak_config['mz_min']
+    if 'mz_max' in peak_config:
+        keep &= mz <= peak_config['mz_max']
+    if 'remove_precursor_da' in peak_config:
+        if precursor_mz is None:
+            logger.warning("No precursor m/z available, precursor peaks are kept")
+        else:
+            precursor = np.asarray(precursor_mz, dtype=np.float64)[spectrum]
+            # spectra without a precursor m/z (NaN) keep their peaks
+            keep &= ~(np.abs(mz - precursor) <= peak_config['remove_precursor_da'])
+    if 'min_relative_intensity' in peak_config:
+        base = _segment_reduce(np.maximum, np.where(keep, intensity, 0), offsets, 0)
+        keep &= intensity >= peak_config['min_relative_intensity'] * base[spectrum]
+    if 'top_n' in peak_config:
+        kept = np.flatnonzero(keep)
+        # most intense first within every spectrum; lexsort is stable, so ties keep the lower m/z
+        order = kept[np.lexsort((-intensity[kept], spectrum[kept]))]
+        starts = np.searchsorted(spectrum[order], spectrum[order], side='left')
+        keep[:] = False
+        keep[order[np.arange(len(order)) - starts < int(peak_config['top_n'])]] = True
+
+    mz, intensity, spectrum = mz[keep], intensity[keep], spectrum[keep]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(spectrum, minlength=len(counts)))]).astype(np.int64)
+
+    normalize = peak_config.get('normalize')
+    if normalize == 'sqrt':
+        intensity = np.sqrt(intensity)
+    if normalize in ('base_peak', 'sqrt'):
+        scale = _segment_reduce(np.maximum, intensity, offsets, 1)
+    elif normalize == 'sum':
+        scale = _segment_reduce(np.add, intensity, offsets, 1)
+    if normalize:
+        scale[scale == 0] = 1
+        intensity = (intensity / scale[spectrum]).astype(intensity.dtype)
+    return offsets, mz, intensity
+
+
+def process_list_columns(mz_column, intensity_column, peak_config, precursor_mz=None):
+    """
+    process_peaks for Arrow list<float> peak columns chunked alike (as RawSpectra.peak_arrays returns them).
+    precursor_mz is aligned with the rows. Returns the processed columns as chunked arrays.
+    """
+    if not check_config(peak_config):
+        return mz_column, intensity_column
+    mz_chunks, intensity_chunks = [], []
+    first = 0
+    for mz_chunk, intensity_chunk in zip(mz_column.chunks, intensity_column.chunks):
+        start = mz_chunk.offsets[0].as_py()
+        offsets = mz_chunk.offsets.to_numpy() - start
+        mz = mz_chunk.values.slice(start, offsets[-1]).to_numpy()
+        intensity = intensity_chunk.values.slice(intensity_chunk.offsets[0].as_py(), offsets[-1]).to_numpy()
+        precursor = None if precursor_mz is None else precursor_mz[first:first + len(mz_chunk)]
+        offsets, mz, intensity = process_peaks(offsets, mz, intensity, peak_config, precursor)
+        list_offsets = pa.array(offsets.astype(np.int32))
+        mz_chunks.append(pa.ListArray.from_arrays(list_offsets, pa.array(mz)))
+        intensity_chunks.append(pa.ListArray.from_arrays(list_offsets, pa.array(intensity)))
+        first += len(mz_chunk)
+    return pa.chunked_array(mz_chunks, mz_column.type), pa.chunked_array(intensity_chunks, intensity_column.type)
@@ -0,0 +1,124 @@
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts import telemetry
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+# threads: worker threads of the CPU bound stages (peak decoding, peak gathering); 1 runs them inline
+# queue_size: batches buffered between two stages, which bounds the memory held in flight (not that of the whole run)
+options = {
+    'threads': min(4, os.cpu_count() or 1),
+    'queue_size': 4
+}
+
+
+def configure(pipeline_options):
+    options.update({k: v for k, v in (pipeline_options or {}).items() if v is not None})
+
+
+def _bound(fn, record):
+    """fn running under the telemetry record of the submitting step, so its row counts are kept."""
+    def run(*args):
+        telemetry.attach(record)
+        try:
+            return fn(*args)
+        finally:
+            telemetry.attach(None)
+    return run
+
+
+def ordered_map(fn, items, threads=None, window=None):
+    """
+    Yield fn(item) for every item in input order, computed on a thread pool.
+    items is consumed lazily and at most window results are in flight, so a slow consumer
+    holds the producer back. Meant for Arrow and NumPy work, which releases the GIL.
+    """
+    threads = int(threads or options['threads'])
+    window = int(window or options['queue_size'] + threads)
+    if threads <= 1:
+        yield from map(fn, items)
+        return
+    fn = _bound(fn, telemetry.current())
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='pipeline') as pool:
+        in_flight = deque()
+        try:
+            for item in items:
+                in_flight.append(pool.submit(fn, item))
+                if len(in_flight) >= window:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+class Background:
+    """Run fn(*args) on its own thread; result() waits for it and re-raises its error."""
+
+    def __init__(self, fn, *args):
+        self._result, self._error = None, None
+        self._thread = threading.Thread(target=self._run, args=(_bound(fn, telemetry.current()),) + args, daemon=True)
+        self._thread.start()
+
+    def _run(self, fn, *args):
+        try:
+            self._result = fn(*args)
+        except BaseException as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class BackgroundWriter:
+    """
+    Hand items to write(item) on a writer thread through a bounded queue, so encoding and
+    disk writes overlap with producing the next item. put() blocks while the queue is full
+    and re-raises an error of the writer thread; close() waits for the queue to drain.
+    """
+
+    _DONE = object()
+
+    def __init__(self, write, queue_size=None):
+        self.write = write
+        self.queue = queue.Queue(maxsize=int(queue_size or options['queue_size']))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(telemetry.current(),), daemon=True)
+        self.thread.start()
+
+    def _run(self, record):
+        telemetry.attach(record)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._DONE:
+                    return
+                if self.error is None:
+                    try:
+                        self.write(item)
+                    except BaseException as e:
+                        # keep draining so a blocked put() returns and sees the error
+                        self.error = e
+        finally:
+            telemetry.attach(None)
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(self._DONE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,354 @@
+import io
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+
+from scripts import pipeline, step_cache, telemetry
+from scripts.generate_rawspectrum import rawspectrum_tools
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+RAWSPECTRUM_COLUMNS = ['scan', 'precursor_mz', 'rt', 'mz_array', 'intensity_array']
+PEAK_COLUMNS = ['mz_array', 'intensity_array']
+RAW_ROW = 'raw_row'
+DEFAULT_BLOCK_SIZE = 64 << 20
+# Arrow list arrays use int32 offsets, so gathered peaks are emitted in chunks below this size
+MAX_LIST_VALUES = (1 << 31) - 1
+SOURCE_ROW = 'source_row'
+SIDECAR_SUFFIX = '.spectra.arrow'
+DEFAULT_META_COLUMNS = ('scan', 'precursor_mz', 'rt')
+
+# sidecar: store parsed spectra as an Arrow IPC file next to the TSV (or in sidecar_dir)
+options = {
+    'sidecar': False,
+    'sidecar_dir': None
+}
+
+
+def configure(cache_options):
+    options.update(cache_options or {})
+
+
+def fused_spec(data_type, input_path, keep_tsv=False):
+    """
+    Stream the spectra from the rawspectrum extractor run on input_path instead of reading the TSV;
+    the TSV itself is only written when keep_tsv is set. Passed as fused to load_rawspectrum.
+    """
+    return {'data_type': data_type, 'input': input_path, 'keep_tsv': keep_tsv}
+
+
+def source_path(raw_data_path, fused=None):
+    """The file the spectra of raw_data_path come from: the raw data itself in fused mode."""
+    return fused['input'] if fused else raw_data_path
+
+
+class RawSpectra:
+    """
+    Spectra of one rawspectrum TSV held as flat peak buffers.
+    The peaks of spectrum i are mz_values[offsets[i]:offsets[i + 1]] and
+    intensity_values[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, meta, offsets, mz_values, intensity_values, source_row, columns, num_source_rows):
+        self.meta = meta
+        self.offsets = offsets
+        self.mz_values = mz_values
+        self.intensity_values = intensity_values
+        self.source_row = source_row
+        self.columns = columns
+        self.num_source_rows = num_source_rows
+
+    def __len__(self):
+        return len(self.meta)
+
+    def meta_frame(self):
+        """Per-spectrum columns plus the row position used to gather peaks after a merge."""
+        raw_df = self.meta.copy()
+        raw_df[RAW_ROW] = np.arange(len(raw_df), dtype=np.int64)
+        return raw_df
+
+    def peak_arrays(self, rows=None):
+        """
+        Return mz_array / intensity_array as Arrow list<float> columns, gathered by row position.
+        Rows of -1 (search results kept without a spectrum) get empty peak lists.
+        """
+        if rows is None:
+            rows = np.arange(len(self), dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        if len(rows) and rows.min() < 0:
+            lengths = np.where(rows < 0, 0, lengths)
+        bounds = np.concatenate([[0], np.cumsum(lengths)])
+        edges = [0]
+        while edges[-1] < len(rows):
+            last = int(np.searchsorted(bounds, bounds[edges[-1]] + MAX_LIST_VALUES, side='right')) - 1
+            edges.append(max(last, edges[-1] + 1))
+        if len(edges) == 1:
+            edges.append(0)
+
+        mz_chunks, intensity_chunks = [], []
+        for first, last in zip(edges[:-1], edges[1:]):
+            chunk_offsets = bounds[first:last + 1] - bounds[first]
+            take = np.repeat(starts[first:last] - chunk_offsets[:-1], lengths[first:last]) + np.arange(chunk_offsets[-1])
+            list_offsets = pa.array(chunk_offsets.astype(np.int32))
+            mz_chunks.append(pa.ListArray.from_arrays(list_offsets, pa.array(self.mz_values[take])))
+            intensity_chunks.append(pa.ListArray.from_arrays(list_offsets, pa.array(self.intensity_values[take])))
+        return pa.chunked_array(mz_chunks), pa.chunked_array(intensity_chunks)
+
+
+def _parse_peak_column(column):
+    """Split comma-joined peak strings into per-spectrum counts and one flat float32 buffer."""
+    peak_lists = pc.split_pattern(column, ',')
+    counts = pc.list_value_length(peak_lists).to_numpy(zero_copy_only=False)
+    # parse through float64 so rounding matches np.array(str_list, dtype='float32')
+    values = pc.cast(pc.cast(pc.list_flatten(peak_lists), pa.float64()), pa.float32())
+    return counts, values.to_numpy(zero_copy_only=False)
+
+
+def read_rawspectrum(raw_data_path, meta_columns=DEFAULT_META_COLUMNS, block_size=DEFAULT_BLOCK_SIZE, stream=None):
+    """
+    Stream a rawspectrum TSV in blocks and parse the peak columns straight into flat buffers.
+    Blocks are decoded as they are read, but the returned buffers hold every spectrum of the file.
+    meta_columns=None keeps every non-peak column of the file.
+    Rows missing scan, mz_array or intensity_array are dropped.
+    stream is read instead of raw_data_path when given, e.g. a pipe from the extractor.
+    """
+    include_columns = [] if meta_columns is None else list(meta_columns) + PEAK_COLUMNS
+    reader = csv.open_csv(
+        raw_data_path if stream is None else stream,
+        read_options=csv.ReadOptions(block_size=block_size),
+        parse_options=csv.ParseOptions(delimiter='\t'),
+        convert_options=csv.ConvertOptions(
+            include_columns=include_columns,
+            column_types={'scan': pa.float64(), 'mz_array': pa.string(), 'intensity_array': pa.string()},
+            strings_can_be_null=True
+        )
+    )
+    columns = reader.schema.names
+    meta_names = [c for c in columns if c not in PEAK_COLUMNS]
+
+    def decode(batch):
+        """Keep the complete rows of a block and parse its peak strings; runs on the pipeline threads."""
+        valid = pc.and_(pc.is_valid(batch['scan']),
+                        pc.and_(pc.is_valid(batch['mz_array']), pc.is_valid(batch['intensity_array'])))
+        rows = np.flatnonzero(valid.to_numpy(zero_copy_only=False))
+        batch = batch.filter(valid)
+        mz_counts, mz = _parse_peak_column(batch['mz_array'])
+        intensity_counts, intensity = _parse_peak_column(batch['intensity_array'])
+        if not np.array_equal(mz_counts, intensity_counts):
+            raise ValueError(f"mz_array and intensity_array lengths differ in {raw_data_path}")
+        return rows, len(valid), batch.select(meta_names), mz_counts, mz, intensity
+
+    meta_batches, counts, mz_values, intensity_values, source_row = [], [], [], [], []
+    num_source_rows = 0
+    # blocks are read on this thread and decoded on the pipeline threads, in order
+    for rows, block_rows, meta_batch, mz_counts, mz, intensity in pipeline.ordered_map(decode, reader):
+        source_row.append(rows + num_source_rows)
+        num_source_rows += block_rows
+        meta_batches.append(meta_batch)
+        counts.append(mz_counts)
+        mz_values.append(mz)
+        intensity_values.append(intensity)
+
+    meta_schema = pa.schema([reader.schema.field(c) for c in meta_names])
+    meta = pa.Table.from_batches(meta_batches, schema=meta_schema).to_pandas()
+    meta['scan'] = meta['scan'].astype(int)
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+    logger.info(f"Read {len(meta)} spectra ({offsets[-1]} peaks) from {raw_data_path}")
+    return RawSpectra(
+        meta=meta,
+        offsets=offsets,
+        mz_values=np.concatenate(mz_values) if mz_values else np.zeros(0, dtype=np.float32),
+        intensity_values=np.concatenate(intensity_values) if intensity_values else np.zeros(0, dtype=np.float32),
+        source_row=np.concatenate(source_row) if source_row else np.zeros(0, dtype=np.int64),
+        columns=columns,
+        num_source_rows=num_source_rows
+    )
+
+
+class _TeeReader(io.RawIOBase):
+    """Read from source and copy everything read into copy."""
+
+    def __init__(self, source, copy):
+        self.source = source
+        self.copy = copy
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.source.readinto(buffer)
+        if size:
+            self.copy.write(memoryview(buffer)[:size])
+        return size
+
+
+def _release_on_exit(process, hold_fd):
+    """
+    Close our own write end of the FIFO once the extractor has exited, so the reader sees EOF
+    even when the extractor failed before opening the FIFO.
+    """
+    try:
+        # WNOWAIT leaves the child to be reaped (with its resource usage) by the caller
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:
+        pass
+    os.close(hold_fd)
+
+
+def extract_rawspectrum(raw_data_path, fused, meta_columns=DEFAULT_META_COLUMNS):
+    """
+    Run the rawspectrum extractor with a FIFO as its output and parse the spectra while it writes,
+    so the text TSV never touches the disk. With keep_tsv the stream is also copied to raw_data_path,
+    which gets the same cache manifest as a TSV written by generate_rawspectrum.
+    """
+    tool = rawspectrum_tools[fused['data_type']]
+    tsv_key = step_cache.step_key([fused['input']], {'data_type': fused['data_type']}, step_cache.tool_version(tool))
+    if fused['keep_tsv'] and step_cache.is_cached(raw_data_path, tsv_key):
+        return read_rawspectrum(raw_data_path, meta_columns=meta_columns)
+
+    fifo_dir = tempfile.mkdtemp(prefix='rawspectrum_')
+    fifo_path = os.path.join(fifo_dir, 'rawspectrum.tsv')
+    temp_tsv = step_cache.temp_path(raw_data_path)
+    cmd = [tool, fused['input'], fifo_path]
+    process, fifo, copy, hold_fd = None, None, None, None
+    try:
+        os.mkfifo(fifo_path)
+        # open both ends up front so neither side blocks in open() if the other never shows up
+        fifo = os.fdopen(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK), 'rb')
+        os.set_blocking(fifo.fileno(), True)
+        hold_fd = os.open(fifo_path, os.O_WRONLY)
+        logger.info(f"Streaming {raw_data_path}: {' '.join(cmd)}")
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        threading.Thread(target=_release_on_exit, args=(process, hold_fd), daemon=True).start()
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        drain.start()
+        with fifo:
+            stream = fifo
+            if fused['keep_tsv']:
+                os.makedirs(os.path.dirname(os.path.abspath(raw_data_path)), exist_ok=True)
+                copy = open(temp_tsv, 'wb')
+                stream = io.BufferedReader(_TeeReader(fifo, copy), 1 << 20)
+            spectra = read_rawspectrum(raw_data_path, meta_columns=meta_columns, stream=stream)
+        telemetry.reap(process, cmd)
+        drain.join()
+        if process.returncode != 0:
+            raise RuntimeError(f"{tool} failed with exit code {process.returncode}: {b''.join(stderr).decode(errors='replace')}")
+        if copy is not None:
+            copy.close()
+            step_cache.invalidate(raw_data_path)
+            os.replace(temp_tsv, raw_data_path)
+            step_cache.store(raw_data_path, tsv_key)
+        return spectra
+    except Exception as e:
+        if process is not None and process.returncode is None:
+            # the reader stopped early; Popen.kill would reap the child before its resource usage is read
+            os.kill(process.pid, signal.SIGKILL)
+            telemetry.reap(process, cmd)
+            drain.join()
+            if process.returncode > 0:
+                raise RuntimeError(f"{tool} failed with exit code {process.returncode}: {b''.join(stderr).decode(errors='replace')}") from e
+        raise
+    finally:
+        # without a process (e.g. Popen raised) no thread took over our write end
+        if process is None and hold_fd is not None:
+            os.close(hold_fd)
+        if process is not None:
+            process.stderr.close()
+        if fifo is not None:
+            fifo.close()
+        if copy is not None and not copy.closed:
+            copy.close()
+        if os.path.exists(temp_tsv):
+            os.remove(temp_tsv)
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+
+
+def sidecar_path(raw_data_path):
+    if options['sidecar_dir']:
+        return os.path.join(options['sidecar_dir'], os.path.basename(raw_data_path) + SIDECAR_SUFFIX)
+    return raw_data_path + SIDECAR_SUFFIX
+
+
+def write_sidecar(spectra, path, source_key):
+    """Store parsed spectra as an Arrow IPC file; peaks use 64-bit offsets so one file holds any run."""
+    offsets = pa.array(spectra.offsets, pa.int64())
+    table = pa.Table.from_pandas(spectra.meta, preserve_index=False)
+    table = table.append_column('mz_array', pa.LargeListArray.from_arrays(offsets, pa.array(spectra.mz_values)))
+    table = table.append_column('intensity_array', pa.LargeListArray.from_arrays(offsets, pa.array(spectra.intensity_values)))
+    table = table.append_column(SOURCE_ROW, pa.array(spectra.source_row, pa.int64()))
+    table = table.replace_schema_metadata({
+        'source_key': source_key,
+        'columns': json.dumps(spectra.columns),
+        'num_source_rows': str(spectra.num_source_rows)
+    })
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = step_cache.temp_path(path)
+    with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temp_path, path)
+    logger.info(f"Wrote rawspectrum sidecar {path}")
+
+
+def read_sidecar(path, source_key):
+    """Memory-map a sidecar written for source_key; None when it is missing or stale."""
+    if not os.path.exists(path):
+        return None
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    metadata = table.schema.metadata or {}
+    if metadata.get(b'source_key', b'').decode() != source_key:
+        logger.info(f"Rawspectrum sidecar {path} is stale")
+        return None
+    mz_array = table['mz_array'].combine_chunks()
+    intensity_array = table['intensity_array'].combine_chunks()
+    meta_names = [c for c in table.column_names if c not in PEAK_COLUMNS and c != SOURCE_ROW]
+    logger.info(f"Read {table.num_rows} spectra from sidecar {path}")
+    return RawSpectra(
+        meta=table.select(meta_names).to_pandas(),
+        offsets=mz_array.offsets.to_numpy(),
+        mz_values=mz_array.values.to_numpy(),
+        intensity_values=intensity_array.values.to_numpy(),
+        source_row=table[SOURCE_ROW].to_numpy(),
+        columns=json.loads(metadata[b'columns']),
+        num_source_rows=int(metadata[b'num_source_rows'])
+    )
+
+
+def load_rawspectrum(raw_data_path, meta_columns=DEFAULT_META_COLUMNS, fused=None):
+    """
+    read_rawspectrum, or extract_rawspectrum when a fused_spec is given.
+    When enabled, the parsed spectra are also stored in an Arrow IPC sidecar keyed to the TSV fingerprint,
+    so later conversions of the run, in this or another process, skip the parsing.
+    """
+    source_key = None
+    if options['sidecar']:
+        if fused:
+            tool = rawspectrum_tools[fused['data_type']]
+            fingerprint = {'input': step_cache.fingerprint(fused['input']), 'data_type': fused['data_type'],
+                           'tool': step_cache.tool_version(tool)}
+        else:
+            fingerprint = step_cache.fingerprint(raw_data_path)
+        source_key = json.dumps({'tsv': fingerprint, 'meta_columns': meta_columns}, sort_keys=True)
+        spectra = read_sidecar(sidecar_path(raw_data_path), source_key)
+        if spectra is not None:
+            return spectra
+
+    if fused:
+        spectra = extract_rawspectrum(raw_data_path, fused, meta_columns=meta_columns)
+    else:
+        spectra = read_rawspectrum(raw_data_path, meta_columns=meta_columns)
+    if options['sidecar']:
+        write_sidecar(spectra, sidecar_path(raw_data_path), source_key)
+    return spectra
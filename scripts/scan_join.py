@@ -0,0 +1,148 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from scripts import telemetry
+from scripts.rawspectrum_reader import RAW_ROW
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+# on_missing: search rows whose scan has no spectrum
+#   'error' fails the run, 'drop' leaves them out, 'keep' writes them with empty peaks and null spectrum columns
+# on_duplicate: scans found more than once among the search rows or the spectra
+#   'error' fails the run, 'drop' leaves out the search rows of those scans, 'keep' joins every pair like a merge
+options = {
+    'on_missing': 'error',
+    'on_duplicate': 'error'
+}
+ACTIONS = ('error', 'drop', 'keep')
+# scans listed in the diagnostics and error messages
+EXAMPLES = 10
+# integer scans spanning more than this many slots per spectrum are factorized instead of looked up densely
+MAX_SPAN_PER_ROW = 16
+
+
+def configure(join_options):
+    options.update({k: v for k, v in (join_options or {}).items() if v is not None})
+    for name in ('on_missing', 'on_duplicate'):
+        if options[name] not in ACTIONS:
+            raise ValueError(f"Unknown {name} action {options[name]!r}, use one of {', '.join(ACTIONS)}")
+
+
+class ScanLookup:
+    """
+    Dense scan -> spectrum row lookup of one run, built once. Scans are mapped to slots
+    (scan - first scan for integer scans, factorized codes otherwise); the rows of slot s are
+    order[starts[s]:starts[s] + counts[s]], in spectrum order.
+    """
+
+    def __init__(self, scans):
+        scans = np.asarray(scans)
+        self.uniques = None
+        if np.issubdtype(scans.dtype, np.integer) and len(scans) and \
+                int(scans.max()) - int(scans.min()) < MAX_SPAN_PER_ROW * len(scans) + 1024:
+            self.first = int(scans.min())
+            slots = scans.astype(np.int64) - self.first
+            size = int(slots.max()) + 1
+        else:
+            self.first = 0
+            slots, self.uniques = pd.factorize(scans)
+            size = len(self.uniques)
+        self.counts = np.bincount(slots, minlength=size)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+        self.order = np.argsort(slots, kind='stable')
+
+    def slots(self, scans):
+        """Slot of every scan, -1 for scans without a spectrum."""
+        scans = np.asarray(scans)
+        if self.uniques is not None:
+            return pd.Index(self.uniques).get_indexer(scans).astype(np.int64)
+        if not np.issubdtype(scans.dtype, np.integer):
+            return np.full(len(scans), -1, dtype=np.int64)
+        slots = scans.astype(np.int64) - self.first
+        inside = (slots >= 0) & (slots < len(self.counts))
+        slots[~inside] = -1
+        slots[inside & (self.counts[np.where(inside, slots, 0)] == 0)] = -1
+        return slots
+
+
+def _examples(scans):
+    return [scan.item() if hasattr(scan, 'item') else scan for scan in scans[:EXAMPLES]]
+
+
+def join_spectra(search_df, raw_df, key, name='', on_missing=None, on_duplicate=None):
+    """
+    Join search rows to the spectra of raw_df (a RawSpectra.meta_frame) on key, like an inner
+    pandas merge: the search columns, then the spectrum columns except key, in search row order.
+    Only the spectrum metadata is gathered; the peaks follow through the RAW_ROW column.
+    Missing and duplicate scans are handled per on_missing / on_duplicate (default: options)
+    and reported as diagnostics on the log and the telemetry record of the step.
+    """
+    on_missing = on_missing or options['on_missing']
+    on_duplicate = on_duplicate or options['on_duplicate']
+    search_scans = search_df[key].to_numpy()
+    lookup = ScanLookup(raw_df[key].to_numpy())
+    slots = lookup.slots(search_scans)
+    counts = np.where(slots >= 0, lookup.counts[np.maximum(slots, 0)], 0)
+
+    missing = slots < 0
+    search_counts = pd.Series(search_scans).value_counts()
+    duplicate_search = search_counts.index[search_counts.to_numpy() > 1].to_numpy()
+    duplicate_spectra = counts > 1
+    duplicate = duplicate_spectra | pd.Series(search_scans).isin(duplicate_search).to_numpy()
+    diagnostics = {
+        'name': name,
+        'key': key,
+        'search_rows': len(search_df),
+        'spectra': len(raw_df),
+        'missing_scans': int(missing.sum()),
+        'missing_examples': _examples(search_scans[missing]),
+        'duplicate_search_scans': len(duplicate_search),
+        'duplicate_spectrum_scans': int(len(np.unique(search_scans[duplicate_spectra]))),
+        'duplicate_examples': _examples(np.unique(search_scans[duplicate])),
+        'on_missing': on_missing,
+        'on_duplicate': on_duplicate,
+        'dropped_rows': 0
+    }
+
+    problems = []
+    if missing.any() and on_missing == 'error':
+        problems.append(f"{diagnostics['missing_scans']} search rows without a spectrum, e.g. {diagnostics['missing_examples']}")
+    if duplicate.any() and on_duplicate == 'error':
+        problems.append(f"{diagnostics['duplicate_search_scans']} duplicate scans in the search results and "
+                        f"{diagnostics['duplicate_spectrum_scans']} matched more than one spectrum, e.g. {diagnostics['duplicate_examples']}")
+    record = telemetry.current()
+    if record is not None:
+        record.setdefault('joins', []).append(diagnostics)
+    if problems:
+        raise ValueError(f"Scan join of {name or key} failed: {'; '.join(problems)}")
+
+    keep = np.ones(len(search_df), dtype=bool)
+    if on_missing == 'drop':
+        keep &= ~missing
+    if on_duplicate == 'drop':
+        keep &= ~duplicate
+    diagnostics['dropped_rows'] = int((~keep).sum())
+
+    # one output row per matching spectrum; kept rows without a spectrum get one row with RAW_ROW -1
+    repeats = np.where(keep, np.maximum(counts, missing.astype(np.int64)), 0)
+    search_rows = np.repeat(np.arange(len(search_df)), repeats)
+    within = np.arange(len(search_rows)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    row_slots = slots[search_rows]
+    spectrum_rows = np.where(row_slots >= 0, lookup.order[lookup.starts[np.maximum(row_slots, 0)] + within], -1)
+
+    joined = search_df.iloc[search_rows].reset_index(drop=True)
+    # spectrum_rows are positions in raw_df; on a RangeIndex the -1 slots select no label and come back as NaN
+    spectra = raw_df.drop(columns=[key]).reset_index(drop=True).reindex(spectrum_rows).reset_index(drop=True)
+    if (spectrum_rows < 0).any():
+        spectra[RAW_ROW] = spectrum_rows
+    joined = pd.concat([joined, spectra], axis=1)
+
+    if missing.any() or duplicate.any():
+        logger.warning(f"Scan join of {name or key}: {diagnostics['missing_scans']} search rows without a spectrum "
+                       f"({on_missing}), {diagnostics['duplicate_search_scans']} duplicate search scans and "
+                       f"{diagnostics['duplicate_spectrum_scans']} scans with several spectra ({on_duplicate}), "
+                       f"{diagnostics['dropped_rows']} rows dropped, e.g. missing {diagnostics['missing_examples']}, "
+                       f"duplicate {diagnostics['duplicate_examples']}")
+    return joined
@@ -0,0 +1,85 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+
+class Step:
+    """
+    One configured conversion step.
+    inputs=None means the inputs are not known up front (e.g. globbed runs),
+    so the step waits for every step configured before it.
+    threaded steps launch multi-threaded binaries and get a share of the thread budget.
+    """
+
+    def __init__(self, name, fn, param, inputs=None, outputs=(), threaded=False):
+        self.name = name
+        self.fn = fn
+        self.param = param
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.threaded = threaded
+        self.deps = set()
+
+
+def _produces(output, path):
+    """True if path is the output itself or lies inside an output directory."""
+    output = os.path.normpath(output)
+    path = os.path.normpath(path)
+    return path == output or path.startswith(output + os.sep)
+
+
+def link_steps(steps):
+    """A step depends on every earlier step that produces one of its inputs."""
+    for i, step in enumerate(steps):
+        for other in steps[:i]:
+            if step.inputs is None or any(
+                    _produces(output, path) for output in other.outputs for path in step.inputs if output and path):
+                step.deps.add(other.name)
+    return steps
+
+
+def split_threads(steps, total_threads):
+    """Share the thread budget between the threaded steps; a configured thread_num is kept as an upper bound."""
+    threaded = [step for step in steps if step.threaded]
+    if not threaded:
+        return steps
+    share = max(1, total_threads // len(threaded))
+    for step in threaded:
+        thread_num = min(int(step.param.get('thread_num') or share), share)
+        step.param = {**step.param, 'thread_num': thread_num}
+        logger.info(f"{step.name} gets {thread_num} threads")
+    return steps
+
+
+def run_steps(steps, max_parallel):
+    """
+    Run steps as soon as the steps they depend on have finished, at most max_parallel at a time.
+    A failed dependency does not cancel its dependents; they report missing inputs themselves.
+    Returns {step name: state}.
+    """
+    pending = {step.name: step for step in steps}
+    states = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+        while pending or running:
+            for name in [n for n, step in pending.items() if step.deps.issubset(states)]:
+                if len(running) >= max_parallel:
+                    break
+                step = pending.pop(name)
+                logger.info(f"Calling {name}")
+                running[pool.submit(step.fn, step.param)] = name
+            if not running:
+                raise RuntimeError(f"Unsatisfiable step dependencies: {sorted(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    states[name] = future.result()
+                except Exception as e:
+                    logger.exception(f"{name} failed: {e}")
+                    states[name] = -1
+                logger.info(f"{name} finished with state {states[name]}")
+    return states
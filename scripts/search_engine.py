@@ -2,17 +2,81 @@ import logging
 import os
 import shutil
 import subprocess
-from pathlib import Path
+import tempfile
+import threading
 import json
 
+from scripts import step_cache, telemetry
+
 # Configure logger (accessible by caller)
 logger = logging.getLogger(__name__)
 sage_script = './linux_sage'
 
 
+def sage_output_path(workdir, data_path):
+    if data_path.endswith('.mzML'):
+        fn = data_path.split('/')[-1][:-5]
+    elif data_path.endswith('.d'):
+        fn = data_path.split('/')[-1][:-2]
+    return os.path.join(workdir, fn + '_search_result.tsv')
+
+
+def sage_search_settings(data):
+    """Sage config without the fields set per invocation (inputs, output directory, fasta path), for the cache key."""
+    search_settings = {k: v for k, v in data.items() if k not in ('mzml_paths', 'output_directory')}
+    search_settings['database'] = {k: v for k, v in data.get('database', {}).items() if k != 'fasta'}
+    return search_settings
+
+
+def write_sage_config(data, fasta, data_paths, workdir):
+    """Write the Sage config of one invocation to a temporary file in workdir; the user's config is left as is."""
+    data = {**data, 'database': {**data.get('database', {}), 'fasta': fasta},
+            'mzml_paths': list(data_paths), 'output_directory': workdir}
+    fd, run_config_path = tempfile.mkstemp(prefix='sage_config_', suffix='.json', dir=workdir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    return run_config_path
+
+
+def split_sage_results(result_path, output_paths):
+    """
+    Split a results.sage.tsv of several runs into one file per run, in one pass over the lines.
+    output_paths maps every searched data path to its output; Sage names the run in the filename column.
+    Returns the number of PSM rows written per output.
+    """
+    targets = {}
+    for data_path, output_path in output_paths.items():
+        targets[data_path] = targets[os.path.basename(os.path.normpath(data_path))] = output_path
+    handles, rows, unmatched = {}, {output_path: 0 for output_path in output_paths.values()}, 0
+    try:
+        with open(result_path, 'r', encoding='utf-8', newline='') as f:
+            header = f.readline()
+            filename_index = header.rstrip('\r\n').split('\t').index('filename')
+            for output_path in rows:
+                handles[output_path] = open(step_cache.temp_path(output_path), 'w', encoding='utf-8', newline='')
+                handles[output_path].write(header)
+            for line in f:
+                output_path = targets.get(line.split('\t', filename_index + 1)[filename_index])
+                if output_path is None:
+                    unmatched += 1
+                    continue
+                handles[output_path].write(line)
+                rows[output_path] += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+    for output_path in rows:
+        os.replace(step_cache.temp_path(output_path), output_path)
+    if unmatched:
+        logger.warning(f"{unmatched} rows of {result_path} belong to none of the searched runs")
+    return rows
+
+
 def generate_sage_search_result_fn(param):
     """
-    Generate a rawspectrum file.
+    Search one run (data_path) or several runs (data_paths) with Sage.
+    Several runs are searched in one Sage invocation, so the FASTA is digested once,
+    and the combined results are split into one output per run.
     Return values:
         0: Successfully generated
         1: Already exists, no need to generate
@@ -21,23 +85,15 @@ def generate_sage_search_result_fn(param):
     """
     workdir = param.get('workdir')
     fasta = param.get('fasta')
-    data_path = param.get('data_path')
+    data_paths = param.get('data_paths') or [param.get('data_path')]
     config_path = param.get('config_path')
-    if data_path.endswith('.mzML'):
-        fn = data_path.split('/')[-1][:-5]
-    elif data_path.endswith('.d'):
-        fn = data_path.split('/')[-1][:-2]
-    output_path = os.path.join(workdir, fn + '_search_result.tsv')
-
-    if not os.path.exists(config_path):
-        logger.error(f"Input file does not exist: {config_path}")
-        return 2
+    thread_num = param.get('thread_num')
 
-    if os.path.exists(output_path):
-        logger.info(f"Output already exists, skipping: {output_path}")
-        return 1
+    for path in [config_path] + data_paths:
+        if not os.path.exists(path):
+            logger.error(f"Input file does not exist: {path}")
+            return 2
 
-    # change sage config
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
@@ -48,27 +104,42 @@ def generate_sage_search_result_fn(param):
         logger.error(f"ERROR: wrong occurs when reading {e}")
         return -1
 
-    data['database']['fasta'] = fasta
-    data['mzml_paths'] = [data_path]
-    data['output_directory'] = workdir
-
-    with open(config_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    # every run keeps its own cache entry, so only the runs without a valid output are searched
+    search_settings = sage_search_settings(data)
+    version = step_cache.tool_version(sage_script)
+    pending = {}
+    for data_path in data_paths:
+        output_path = sage_output_path(workdir, data_path)
+        cache_key = step_cache.step_key([data_path, fasta], search_settings, version)
+        if step_cache.is_cached(output_path, cache_key):
+            logger.info(f"Output already exists, skipping: {output_path}")
+            continue
+        step_cache.invalidate(output_path)
+        pending[data_path] = (output_path, cache_key)
+    if not pending:
+        return 1
 
-    # Create the output directory if it does not exist
-    new_run_exe_path = os.path.join(workdir, 'linux_sage')
     os.makedirs(workdir, exist_ok=True)
-    shutil.copy(sage_script, new_run_exe_path)
-
-    cmd = [new_run_exe_path, config_path]
+    run_config_path = write_sage_config(data, fasta, pending, workdir)
+    cmd = [os.path.abspath(sage_script), run_config_path]
+    env = os.environ.copy()
+    if thread_num:
+        # sage runs on a rayon thread pool
+        env['RAYON_NUM_THREADS'] = str(thread_num)
     try:
-        logger.info(f"Generating: {output_path}")
+        logger.info(f"Generating: {', '.join(output_path for output_path, _ in pending.values())}")
         logger.info(f"Running command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        telemetry.run_command(cmd, check=True, capture_output=True, text=True, env=env)
         result_sage_file_path = os.path.join(workdir, 'results.sage.tsv')
-        shutil.move(result_sage_file_path, output_path)
-        logger.info(f"Successfully generated: {output_path}")
-        os.remove(new_run_exe_path)
+        if len(pending) == 1:
+            shutil.move(result_sage_file_path, next(iter(pending.values()))[0])
+        else:
+            rows = split_sage_results(result_sage_file_path, {k: v[0] for k, v in pending.items()})
+            telemetry.count_rows('read', sum(rows.values()))
+            os.remove(result_sage_file_path)
+        for output_path, cache_key in pending.values():
+            logger.info(f"Successfully generated: {output_path}")
+            step_cache.store(output_path, cache_key)
         return 0
     except subprocess.CalledProcessError as e:
         logger.error(f"Generation failed: {e.stderr}")
@@ -76,21 +147,64 @@ def generate_sage_search_result_fn(param):
     except Exception as e:
         logger.exception(f"Unexpected error: {e}")
         return -1
+    finally:
+        os.remove(run_config_path)
 
 
 fragpipe_exe_path = os.path.join(os.getcwd(), 'FragPipe-21.1', 'bin', 'fragpipe')
 
 
-def build_manifest(file_path, fragpipe_output_path):
+def build_manifest(file_paths, fragpipe_output_path):
+    """Manifest of one FragPipe invocation; several runs each get their file name as experiment."""
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
     manifest_path = os.path.join(fragpipe_output_path, 'fragpipe-files.fp-manifest')
     logger.info(f'Processing build fragpipe manifest, path is {manifest_path}')
     #
     with open(manifest_path, 'w+') as f:
-        f.write(f'{file_path}\texp\t\tDDA')
+        if len(file_paths) == 1:
+            f.write(f'{file_paths[0]}\texp\t\tDDA')
+        else:
+            f.write('\n'.join(f'{file_path}\t{run_name(file_path)}\t\tDDA' for file_path in file_paths))
     logger.info(f'Finished build fragpipe manifest')
     return manifest_path
 
 
+def run_name(data_path):
+    """File name of a run without its extension (.mzML, .d), the name FragPipe gives its pin files."""
+    return os.path.splitext(os.path.basename(os.path.normpath(data_path)))[0]
+
+
+def find_pin_files(directory):
+    """All <run>_edited.pin files below directory, found in one walk; maps run name to path (first found wins)."""
+    pin_files = {}
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith('_edited.pin'):
+                pin_files.setdefault(name[:-len('_edited.pin')], os.path.join(root, name))
+    return pin_files
+
+
+def remove_pin_files(directory, runs):
+    """Remove every <run>_edited.pin below directory of the given run names, e.g. left by an earlier search."""
+    runs = set(runs)
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith('_edited.pin') and name[:-len('_edited.pin')] in runs:
+                logger.info(f"Removing the pin file of an earlier search: {os.path.join(root, name)}")
+                os.remove(os.path.join(root, name))
+
+
+def _log_stream(stream, level):
+    """Forward the lines of a child's output stream to the log until it closes."""
+    with stream:
+        for line in iter(stream.readline, b''):
+            info_msg = line.decode('utf-8', errors='replace').rstrip()
+            if info_msg:
+                logger.log(level, info_msg)
+
+
 def run_cmd(cmd, cwd=None):
     env = os.environ.copy()
     java_bin_path = os.path.join(os.getcwd(), 'jdk-11.0.26', 'bin')
@@ -99,19 +213,15 @@ def run_cmd(cmd, cwd=None):
     env['JAVA_HOME'] = java_home
     cmd_str = ' '.join(cmd)
     logger.info(f'Run cmd: {cmd_str}')
-    p = subprocess.Popen(cmd, env=env, cwd=cwd, stdout=subprocess.PIPE)
-    stdout = p.stdout
-    while True:
-        output = stdout.readline()
-        if output == b'' or (output == '' and p.poll() is not None):
-            break
-        logger.info(output)
-        if output:
-            #
-            info_msg = output.decode('utf-8')
-            info_msg = info_msg.rstrip()
-            if len(info_msg) == 0:
-                continue
+    p = subprocess.Popen(cmd, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # drain both pipes on their own threads, so neither can fill up and block the child
+    readers = [threading.Thread(target=_log_stream, args=(p.stdout, logging.INFO), daemon=True),
+               threading.Thread(target=_log_stream, args=(p.stderr, logging.WARNING), daemon=True)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    return telemetry.reap(p, cmd)
 
 
 def run_fragpipe(manifest_path, workflow_path, fragpipe_output_path, exe_abs_path, thread_num):
@@ -124,38 +234,43 @@ def run_fragpipe(manifest_path, workflow_path, fragpipe_output_path, exe_abs_pat
     cmd = [exe_abs_path, '--headless', '--workflow', workflow_path, '--manifest',
            manifest_path, '--workdir', fragpipe_output_path,
            '--config-ionQuant', ion_quant_exe_path, '--config-msfragger', msfrag_exe_path,
-           '--config-philosopher', philosopher_exe_path, '--threads', str(thread_num)]
+           '--config-philosopher', philosopher_exe_path, '--threads', str(thread_num or os.cpu_count() or 1)]
     logger.info(f'Processing run fragpipe, command is {cmd}')
-    run_cmd(cmd)
+    returncode = run_cmd(cmd)
+    if returncode != 0:
+        logger.error(f'fragpipe exited with code {returncode}')
     logger.info(f'Finished run fragpipe, result path is {fragpipe_output_path}')
+    return returncode
 
 
 def generate_fp_search_result_fn(param):
     """
+    Search one run (data_path) or several runs (data_paths) in one headless FragPipe invocation,
+    so the JVM start and the database digestion are paid once.
     Return values:
         0: Successfully generated
         1: Already exists, no need to generate
         2: Input file does not exist
         -1: Generation failed
     """
-    file_path = param.get('data_path')
+    file_paths = param.get('data_paths') or [param.get('data_path')]
     thread_num = param.get('thread_num')
     workflow_path = param.get('workflow_path')
     workdir = param.get('workdir')
     os.makedirs(workdir, exist_ok=True)
-    manifest_path = build_manifest(file_path, workdir)
-    run_fragpipe(manifest_path, workflow_path, workdir, fragpipe_exe_path, thread_num)
-    # check bin file
-    base_file_name = os.path.basename(file_path)
-    # find _edited.pin file
-    pin_file_list = list(Path(workdir).rglob(f'{base_file_name}_edited.pin'))
-    if len(pin_file_list) > 0:
-        pin_file_path = pin_file_list[0]
-    else:
+    # pin files of an earlier search must not pass for the results of this one
+    remove_pin_files(workdir, [run_name(file_path) for file_path in file_paths])
+    manifest_path = build_manifest(file_paths, workdir)
+    returncode = run_fragpipe(manifest_path, workflow_path, workdir, fragpipe_exe_path, thread_num)
+    if returncode != 0:
+        logger.error(f"generate fragpipe fail, fragpipe exited with code {returncode}")
         return -1
-    if os.path.exists(pin_file_path):
-        logger.info(f"generate fragpipe success:")
-        return 0
-    else:
-        logger.error(f"generate fragpipe fail")
+    # find the _edited.pin file of every run
+    pin_files = find_pin_files(workdir)
+    missing = [file_path for file_path in file_paths if run_name(file_path) not in pin_files]
+    for file_path in missing:
+        logger.error(f"generate fragpipe fail, no _edited.pin for {file_path}")
+    if missing:
         return -1
+    logger.info(f"generate fragpipe success: {', '.join(pin_files[run_name(file_path)] for file_path in file_paths)}")
+    return 0
@@ -0,0 +1,105 @@
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+
+from scripts import telemetry
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+# every column gets an explicit type: inferred from the first block, a type could fail on a later block.
+# scannr is text, it is a number or a native id depending on the input format
+SAGE_COLUMN_TYPES = {
+    'peptide': pa.string(), 'scannr': pa.string(), 'label': pa.int64(), 'matched_peaks': pa.int64(),
+    'peptide_q': pa.float64(), 'protein_q': pa.float64(), 'charge': pa.int64(), 'predicted_rt': pa.float64(),
+    'ion_mobility': pa.float64(), 'delta_rt_model': pa.float64(), 'sage_discriminant_score': pa.float64(),
+    'spectrum_q': pa.float64(), 'proteins': pa.string()
+}
+PIN_COLUMN_TYPES = {
+    'SpecId': pa.string(), 'Label': pa.int64(), 'ScanNr': pa.int64(), 'ExpMass': pa.float64(),
+    'retentiontime': pa.float64(), 'rank': pa.int64(), 'isotope_errors': pa.int64(), 'hyperscore': pa.float64(),
+    'delta_hyperscore': pa.float64(), 'matched_ion_num': pa.int64(), 'ion_series': pa.int64(),
+    'unweighted_spectral_entropy': pa.float64(), 'delta_RT_loess': pa.float64(), 'Peptide': pa.string(),
+    'Proteins': pa.string()
+}
+SAGE_COLUMNS = list(SAGE_COLUMN_TYPES)
+PIN_COLUMNS = list(PIN_COLUMN_TYPES)
+
+# targets are kept up to this spectrum q-value, decoys are all kept
+MAX_SPECTRUM_Q = 0.01
+CHARGE_RANGE = (2, 5)
+# peptides shorter than this cannot reach the minimum length once modifications are stripped
+MIN_PEPTIDE_LENGTH = 7
+
+BLOCK_SIZE = 16 << 20
+
+
+def stream_csv(path, columns, batch_filter=None, column_types=None):
+    """
+    Read the columns of a tab separated file in batches with Arrow's CSV reader, keeping the
+    rows of every batch that batch_filter (batch -> boolean mask) selects. Memory is bounded
+    by the kept rows, not by the size of the file. Returns the kept rows as one table.
+    """
+    reader = pv.open_csv(
+        path,
+        read_options=pv.ReadOptions(use_threads=True, block_size=BLOCK_SIZE),
+        parse_options=pv.ParseOptions(delimiter='\t'),
+        convert_options=pv.ConvertOptions(include_columns=columns, column_types=column_types or {}))
+    kept, rows = [], 0
+    for batch in reader:
+        rows += batch.num_rows
+        kept.append(batch.filter(batch_filter(batch)) if batch_filter is not None else batch)
+    telemetry.count_rows('read', rows)
+    table = pa.Table.from_batches(kept, schema=reader.schema)
+    logger.info(f"Read {path}: kept {table.num_rows} of {rows} rows")
+    return table
+
+
+def parse_scan(scans, to_int=True):
+    """
+    Scan numbers of a string column: the text after the last '=' of a native id such as
+    'controllerType=0 controllerNumber=1 scan=42', cast to int. With to_int=False the ids
+    are only cast when every one of them is a plain integer, and kept as text otherwise.
+    """
+    if to_int:
+        return pc.cast(pc.replace_substring_regex(scans, pattern='^.*=', replacement=''), pa.int64())
+    try:
+        return pc.cast(scans, pa.int64())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return scans
+
+
+def read_sage_results(path, scan_to_int=True):
+    """
+    PSMs of a Sage results.sage.tsv: targets with spectrum_q <= MAX_SPECTRUM_Q followed by all decoys,
+    each in file order, with a scan number and a charge in CHARGE_RANGE. The exact peptide length filter
+    needs the unified sequences and stays with the caller. Returns a DataFrame with the SAGE_COLUMNS.
+    """
+    def keep(batch):
+        label, length = batch['label'], pc.utf8_length(batch['peptide'])
+        selected = pc.or_(pc.and_(pc.equal(label, 1), pc.less_equal(batch['spectrum_q'], MAX_SPECTRUM_Q)),
+                          pc.equal(label, -1))
+        for condition in (pc.is_valid(batch['scannr']),
+                          pc.greater_equal(batch['charge'], CHARGE_RANGE[0]),
+                          pc.less_equal(batch['charge'], CHARGE_RANGE[1]),
+                          pc.greater_equal(length, MIN_PEPTIDE_LENGTH)):
+            selected = pc.and_(selected, condition)
+        return pc.fill_null(selected, False)
+
+    table = stream_csv(path, SAGE_COLUMNS, keep, SAGE_COLUMN_TYPES)
+    # targets before decoys with one take, so every column stays a single chunk
+    label = table['label'].to_numpy()
+    order = np.concatenate([np.flatnonzero(label == 1), np.flatnonzero(label == -1)])
+    table = table.take(pa.array(order)).combine_chunks()
+    table = table.set_column(table.schema.get_field_index('scannr'), 'scannr', parse_scan(table['scannr'], scan_to_int))
+    return table.to_pandas()
+
+
+def read_pin(path):
+    """Rows of a FragPipe _edited.pin with the PIN_COLUMNS, plus the charge parsed from SpecId (<run>.<scan>.<scan>.<charge>_<rank>)."""
+    table = stream_csv(path, PIN_COLUMNS, column_types=PIN_COLUMN_TYPES).combine_chunks()
+    charge = pc.replace_substring_regex(pc.replace_substring_regex(table['SpecId'], pattern=r'^.*\.', replacement=''),
+                                        pattern='_.*$', replacement='')
+    return table.append_column('charge', pc.cast(charge, pa.int64())).to_pandas()
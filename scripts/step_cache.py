@@ -0,0 +1,219 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+
+from scripts import __version__
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = '.cache.json'
+TEMP_SUFFIX = '.tmp'
+HASH_BLOCK = 1 << 20
+TOOL_VERSION = f"msdt-converter {__version__}"
+
+# fast_hash: also hash the first and last MiB of every input file
+# adopt_existing: trust outputs written before the cache existed and record a manifest for them.
+#   Off by default: an output without a manifest may also be what a crash left behind
+options = {
+    'fast_hash': False,
+    'adopt_existing': False
+}
+
+
+# per thread: decides whether the running step may still put its outputs in place, e.g. while it holds a lease
+_claim = threading.local()
+
+
+def configure(cache_options):
+    options.update(cache_options or {})
+
+
+def hold(check):
+    """Let check() decide whether this thread may still commit and store outputs; None lifts the check."""
+    _claim.check = check
+
+
+def _require_claim(output):
+    check = getattr(_claim, 'check', None)
+    if check is not None and not check():
+        raise RuntimeError(f"Not putting {output} in place: the step lost its claim on it")
+
+
+def _file_fingerprint(path):
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if options['fast_hash']:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            digest.update(f.read(HASH_BLOCK))
+            if stat.st_size > 2 * HASH_BLOCK:
+                f.seek(-HASH_BLOCK, os.SEEK_END)
+                digest.update(f.read(HASH_BLOCK))
+        fingerprint['hash'] = digest.hexdigest()
+    return fingerprint
+
+
+def fingerprint(path):
+    """Fingerprint of a file, or of every file below a directory (e.g. a Bruker .d)."""
+    if os.path.isdir(path):
+        files = []
+        for root, _, names in os.walk(path):
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                files.append([os.path.relpath(file_path, path), _file_fingerprint(file_path)])
+        return {'files': sorted(files)}
+    return _file_fingerprint(path)
+
+
+def tool_version(exe_path):
+    """Version stamp of an external binary; its own fingerprint when it exists."""
+    if exe_path and os.path.exists(exe_path):
+        return f"{os.path.basename(exe_path)} {json.dumps(_file_fingerprint(exe_path), sort_keys=True)}"
+    return exe_path
+
+
+def step_key(inputs, config=None, tool=TOOL_VERSION):
+    """
+    Cache key of a step: input fingerprints, the settings that change the output, and the tool version.
+    Input paths are not part of the key, so moved inputs keep their cached outputs.
+    Returns None when an input is missing.
+    """
+    if any(not path or not os.path.exists(path) for path in inputs):
+        return None
+    detail = {
+        'inputs': [fingerprint(path) for path in inputs],
+        'config': config or {},
+        'tool': tool
+    }
+    return hashlib.sha256(json.dumps(detail, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def manifest_path(output):
+    return os.path.normpath(output) + MANIFEST_SUFFIX
+
+
+def _output_size(output):
+    if os.path.isdir(output):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(output) for name in names)
+    return os.path.getsize(output)
+
+
+def _read_manifest(output):
+    try:
+        with open(manifest_path(output), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def store(output, key):
+    """Record that output was produced for key."""
+    if key is None or not os.path.exists(output):
+        return
+    _require_claim(output)
+    manifest = {
+        'key': key,
+        'output': os.path.basename(os.path.normpath(output)),
+        'output_size': _output_size(output),
+        'tool': TOOL_VERSION,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+    temp = temp_path(manifest_path(output))
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(temp, manifest_path(output))
+
+
+def is_cached(output, key):
+    """
+    True if output exists and is still valid for key.
+    When the inputs are gone (key is None) an existing output is kept, since it cannot be rebuilt anyway.
+    """
+    if not output or not os.path.exists(output):
+        return False
+    manifest = _read_manifest(output)
+    if manifest is None:
+        if options['adopt_existing']:
+            logger.info(f"Adopting existing output without cache manifest: {output}")
+            store(output, key)
+            return True
+        return False
+    if key is None:
+        logger.warning(f"Inputs of {output} are missing, keeping the cached output")
+        return True
+    if manifest.get('key') != key:
+        logger.info(f"Inputs or settings changed since {output} was generated")
+        return False
+    if manifest.get('output_size') != _output_size(output):
+        logger.info(f"{output} does not match its cache manifest")
+        return False
+    return True
+
+
+def invalidate(output):
+    """Remove a stale output file and its manifest before it is generated again."""
+    if output and os.path.isfile(output):
+        os.remove(output)
+    if output and os.path.exists(manifest_path(output)):
+        os.remove(manifest_path(output))
+
+
+def temp_path(output):
+    """
+    Private path next to output to write it under before commit() moves it into place.
+    Host and pid keep the writers of several nodes on a shared filesystem apart.
+    """
+    return f"{os.path.normpath(output)}.{socket.gethostname()}-{os.getpid()}{TEMP_SUFFIX}"
+
+
+def is_temp(path):
+    return os.path.normpath(path).endswith(TEMP_SUFFIX)
+
+
+def commit(temp, output):
+    """
+    Move a finished temp output into place with a rename, so readers see either the old or the whole new output.
+    A directory output (a dataset) replaces the previous directory as a whole: the old one is moved aside first,
+    so it is briefly missing but never partial.
+    Raises RuntimeError instead when the step lost its claim on the output (see hold()).
+    """
+    _require_claim(output)
+    if not os.path.isdir(temp):
+        os.replace(temp, output)
+        return
+    previous = None
+    if os.path.exists(output):
+        previous = temp_path(output + '.old')
+        os.rename(output, previous)
+    os.rename(temp, output)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def discard(temp):
+    """Remove the temp output of a failed write."""
+    if os.path.isdir(temp):
+        shutil.rmtree(temp, ignore_errors=True)
+    elif os.path.exists(temp):
+        os.remove(temp)
+
+
+def relocate(src_output, dst_output):
+    """Move a cached output together with its manifest; its key does not depend on the output path."""
+    os.makedirs(os.path.dirname(os.path.abspath(dst_output)), exist_ok=True)
+    manifest = _read_manifest(src_output)
+    shutil.move(src_output, dst_output)
+    if manifest is not None:
+        manifest['output'] = os.path.basename(os.path.normpath(dst_output))
+        temp = temp_path(manifest_path(dst_output))
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(temp, manifest_path(dst_output))
+        os.remove(manifest_path(src_output))
+    logger.info(f"Relocated {src_output} -> {dst_output}")
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+RSS_SAMPLE_SECONDS = 0.5
+
+# step records of this run, in the order the steps started
+records = []
+_current = threading.local()
+_lock = threading.Lock()
+
+
+def _rss_bytes():
+    """Resident set size of this process, 0 where /proc is not available."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _path_bytes(path):
+    """Size of a file, or of every file below a directory (e.g. a Bruker .d or a dataset)."""
+    if not path or not os.path.exists(path):
+        return 0
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+def _sample_rss(record, stop):
+    """Track the highest RSS of the process while the step runs."""
+    while not stop.wait(RSS_SAMPLE_SECONDS):
+        record['process_peak_rss_mb'] = max(record['process_peak_rss_mb'], _rss_bytes() / (1 << 20))
+
+
+def current():
+    """Record of the step running on this thread, or None outside of a step."""
+    return getattr(_current, 'record', None)
+
+
+def attach(record):
+    """
+    Make record the running step of this thread, e.g. on a worker thread of the step; None detaches.
+    The CPU time of the thread while it was attached is added to the step.
+    """
+    previous = current()
+    if previous is not None:
+        with _lock:
+            previous['cpu_s'] += time.thread_time() - _current.cpu_start
+    _current.record = record
+    _current.cpu_start = time.thread_time()
+
+
+def count_rows(phase, rows):
+    """Add rows to a phase (read, filter, group, join, write) of the running step; a no-op outside of a step."""
+    record = current()
+    if record is not None:
+        with _lock:
+            record['rows'][phase] = record['rows'].get(phase, 0) + int(rows)
+
+
+def instrument(name, fn, inputs=(), outputs=()):
+    """
+    Wrap a step function so every call records its state, wall and CPU time, RSS,
+    the bytes of its inputs and outputs, phase row counts and the external commands it ran.
+    Steps run side by side on scheduler threads, so CPU time is summed over the calling thread and the
+    helper threads attached to the step, while the RSS is that of the whole process, other steps included.
+    """
+    def run(param):
+        record = {
+            'name': name,
+            'state': None,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'wall_s': 0.0,
+            'cpu_s': 0.0,
+            'process_start_rss_mb': _rss_bytes() / (1 << 20),
+            'process_peak_rss_mb': _rss_bytes() / (1 << 20),
+            'process_end_rss_mb': 0.0,
+            'input_bytes': sum(_path_bytes(path) for path in inputs or ()),
+            'output_bytes': 0,
+            'rows': {},
+            'commands': []
+        }
+        with _lock:
+            records.append(record)
+        stop = threading.Event()
+        sampler = threading.Thread(target=_sample_rss, args=(record, stop), daemon=True)
+        sampler.start()
+        attach(record)
+        wall_start = time.perf_counter()
+        try:
+            record['state'] = fn(param)
+            return record['state']
+        except Exception:
+            record['state'] = -1
+            raise
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            attach(None)
+            stop.set()
+            sampler.join()
+            record['process_end_rss_mb'] = _rss_bytes() / (1 << 20)
+            record['process_peak_rss_mb'] = max(record['process_peak_rss_mb'], record['process_end_rss_mb'])
+            record['output_bytes'] = sum(_path_bytes(path) for path in outputs or ())
+    return run
+
+
+def reap(process, cmd):
+    """
+    Wait for a child started with subprocess.Popen and record its own resource usage
+    (user and system CPU, peak RSS) on the running step. Sets process.returncode.
+    """
+    start = time.perf_counter()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record = current()
+    if record is not None:
+        record['commands'].append({
+            'cmd': [str(part) for part in cmd],
+            'returncode': process.returncode,
+            'user_s': usage.ru_utime,
+            'system_s': usage.ru_stime,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_mb': usage.ru_maxrss / 1024,
+            'wait_s': time.perf_counter() - start
+        })
+    return process.returncode
+
+
+def run_command(cmd, check=False, capture_output=False, text=False, **kwargs):
+    """subprocess.run for external binaries that also records the child's resource usage."""
+    if capture_output:
+        kwargs['stdout'] = kwargs['stderr'] = subprocess.PIPE
+    process = subprocess.Popen(cmd, text=text, **kwargs)
+    captured = {}
+
+    def drain(name, stream):
+        with stream:
+            captured[name] = stream.read()
+
+    readers = [threading.Thread(target=drain, args=(name, stream), daemon=True)
+               for name, stream in (('stdout', process.stdout), ('stderr', process.stderr)) if stream is not None]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    reap(process, cmd)
+    result = subprocess.CompletedProcess(cmd, process.returncode, captured.get('stdout'), captured.get('stderr'))
+    if check:
+        result.check_returncode()
+    return result
+
+
+def write_report(report_path, config_path=None, wall_s=None):
+    """Write the step records of this run as JSON, with host details and the CPU of every reaped child process."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'config': config_path,
+        'host': {'node': platform.node(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                 'python': platform.python_version()},
+        'wall_s': wall_s,
+        'process': {
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'cpu_s': time.process_time(),
+            # every child waited for, including process pool workers of the python steps
+            'children_cpu_s': children.ru_utime + children.ru_stime,
+            'children_peak_rss_mb': children.ru_maxrss / 1024
+        },
+        'steps': records
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    logger.info(f"Run report written to {report_path}")
+    return report
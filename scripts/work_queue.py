@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from scripts import step_cache
+
+# Configure logger (accessible by caller)
+logger = logging.getLogger(__name__)
+
+LEASE_SUFFIX = '.lease'
+FAILED_SUFFIX = '.failed'
+
+# dir: queue directory on the shared filesystem; every worker of one cohort points at the same one
+# lease_seconds: a lease that was not renewed for this long is abandoned and another worker takes the run over
+# poll_seconds: wait between passes while other workers hold the leases of the remaining runs
+# max_attempts: failed conversions of a run before the workers give up on it
+options = {
+    'dir': None,
+    'lease_seconds': 600,
+    'poll_seconds': 10,
+    'max_attempts': 2
+}
+
+
+def configure(queue_options):
+    options.update({k: v for k, v in (queue_options or {}).items() if v is not None})
+
+
+def worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def run_key(run):
+    """File name of a run in the queue directory: its output name plus a hash of the output path."""
+    output = os.path.normpath(os.path.abspath(run.get('output', '')))
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(output))
+    return f"{name}-{hashlib.sha1(output.encode('utf-8')).hexdigest()[:12]}"
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _write_json(path, content):
+    temp = step_cache.temp_path(path)
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(content, f, indent=4)
+    os.replace(temp, path)
+
+
+def _expired(path):
+    """True if the lease at path was not renewed within lease_seconds (False when it is gone)."""
+    try:
+        return time.time() - os.stat(path).st_mtime > options['lease_seconds']
+    except FileNotFoundError:
+        return False
+
+
+class Lease:
+    """
+    A worker's claim on one run. A heartbeat thread renews the lease file (its mtime) until
+    release(); lost is set when another worker took the lease over or the lease file is gone.
+    """
+
+    def __init__(self, path, worker):
+        self.path = path
+        self.worker = worker
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _owned(self):
+        return (_read_json(self.path) or {}).get('worker') == self.worker
+
+    def held(self):
+        """True while the lease is still ours, checked against the lease file now."""
+        if not self.lost and not self._owned():
+            self.lost = True
+        return not self.lost
+
+    def _heartbeat(self):
+        while not self._stop.wait(options['lease_seconds'] / 4):
+            try:
+                if self.held():
+                    os.utime(self.path)
+                    continue
+            except FileNotFoundError:
+                # broken or moved aside by a worker taking the expired lease over
+                self.lost = True
+            logger.warning(f"Lease {self.path} was taken over by another worker")
+            return
+
+    def release(self):
+        self._stop.set()
+        self._thread.join()
+        if self.held():
+            os.remove(self.path)
+
+
+def claim(queue_dir, key, worker):
+    """
+    Lease the run key for worker, or None while another worker holds a live lease.
+    The lease file is created exclusively, so exactly one worker gets a free run; an expired
+    lease is moved aside with a rename, which only one of the workers racing for it wins.
+    """
+    path = os.path.join(queue_dir, key + LEASE_SUFFIX)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not _expired(path):
+                return None
+            holder = _read_json(path) or {}
+            stale = step_cache.temp_path(path)
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                continue
+            if not _expired(stale):
+                # another worker took the lease over between the check and the rename: hand it back
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return None
+            os.remove(stale)
+            logger.warning(f"Lease of {key} held by {holder.get('worker')} expired, taking the run over")
+            continue
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'worker': worker, 'host': socket.gethostname(), 'pid': os.getpid(),
+                       'acquired': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+        return Lease(path, worker)
+    return None
+
+
+def attempts(queue_dir, key):
+    """Failed conversions of the run key recorded by any worker."""
+    return (_read_json(os.path.join(queue_dir, key + FAILED_SUFFIX)) or {}).get('attempts', 0)
+
+
+def record_result(queue_dir, key, worker, state):
+    """Count a failed conversion of the run key; a success clears the count. Called while holding the lease."""
+    path = os.path.join(queue_dir, key + FAILED_SUFFIX)
+    if state in (0, 1):
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    _write_json(path, {'attempts': attempts(queue_dir, key) + 1, 'state': state, 'worker': worker,
+                       'failed': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+
+def work(runs, convert, queue_dir=None):
+    """
+    Convert the runs of a cohort together with the other workers pointing at queue_dir.
+    Every pass claims the free runs one at a time and converts them with convert(run); runs
+    leased by other workers are tried again after poll_seconds, when they are either done
+    (convert finds the cached output) or their lease expired. Runs that failed max_attempts
+    times are given up. Returns the state of every run, in the order of runs.
+    """
+    queue_dir = queue_dir or options['dir']
+    os.makedirs(queue_dir, exist_ok=True)
+    worker = worker_id()
+    keys = [run_key(run) for run in runs]
+    states = [None] * len(runs)
+    pending = list(range(len(runs)))
+    logger.info(f"Worker {worker} working on {len(runs)} runs from {queue_dir}")
+    while pending:
+        waiting = []
+        for i in pending:
+            failed = attempts(queue_dir, keys[i])
+            if failed >= options['max_attempts']:
+                logger.error(f"{runs[i].get('output')} failed {failed} times, giving up")
+                states[i] = -1
+                continue
+            lease = claim(queue_dir, keys[i], worker)
+            if lease is None:
+                waiting.append(i)
+                continue
+            # the outputs of a run whose lease was lost are left to the worker that took it over
+            step_cache.hold(lease.held)
+            try:
+                states[i] = convert(runs[i])
+            except Exception as e:
+                logger.error(f"Error occurs when generate {runs[i].get('output')}: {e}")
+                states[i] = -1
+            finally:
+                step_cache.hold(None)
+            if lease.held():
+                record_result(queue_dir, keys[i], worker, states[i])
+            else:
+                logger.warning(f"Lost the lease of {runs[i].get('output')}, abandoned the run")
+                states[i] = -1
+            lease.release()
+        pending = waiting
+        if pending:
+            logger.info(f"{len(pending)} runs are leased by other workers, checking again in {options['poll_seconds']}s")
+            time.sleep(options['poll_seconds'])
+    return states
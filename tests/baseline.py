@@ -0,0 +1,170 @@
+"""
+The conversions of the first release, kept as a reference: the outputs of the optimized steps
+must hold the same rows and values. Only the parts the tests compare are kept.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+from scripts.generate_msdt import residues_frag, residues_sage
+
+SAGE_LIST_COLUMNS = ['precursor_sequence', 'proteins', 'label', 'charge', 'matched_peaks', 'peptide_q', 'protein_q',
+                     'predicted_rt', 'ion_mobility', 'delta_rt', 'spectrum_q', 'sage_discriminant_score']
+
+
+def clean_psm_func(peptide, residues_dict):
+    for key, value in residues_dict.items():
+        if value not in peptide:
+            peptide = peptide.replace(key, value)
+    return peptide
+
+
+def read_raw(raw_data_path):
+    raw_df = pd.read_csv(raw_data_path, sep='\t', usecols=['scan', 'precursor_mz', 'rt', 'mz_array', 'intensity_array'])
+    raw_df = raw_df.dropna(subset=['scan', 'mz_array', 'intensity_array'])
+    raw_df['scan'] = raw_df['scan'].astype(int)
+    raw_df['mz_array'] = raw_df['mz_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
+    raw_df['intensity_array'] = raw_df['intensity_array'].str.split(',').map(lambda x: np.array(x, dtype='float32'))
+    return raw_df
+
+
+def sage_msdt(raw_data_path, search_result_path, unify_residue):
+    raw_df = read_raw(raw_data_path)
+    sage_df = pd.read_csv(search_result_path, sep='\t', usecols=['peptide', 'scannr', 'label', 'matched_peaks', 'peptide_q', 'protein_q', 'charge', 'predicted_rt', 'ion_mobility', 'delta_rt_model', 'sage_discriminant_score', 'spectrum_q', 'proteins'])
+    sage_df = sage_df.dropna(subset=['scannr'])
+    try:
+        sage_df['scannr'] = sage_df['scannr'].astype(int)
+    except (TypeError, ValueError):
+        sage_df['scannr'] = sage_df['scannr'].apply(lambda x: x.split('=')[-1]).astype(int)
+    decoy_df = sage_df[sage_df['label'] == -1]
+    target_df = sage_df[sage_df['label'] == 1]
+    sage_df_need = pd.concat([target_df[target_df['spectrum_q'] <= 0.01], decoy_df], axis=0, ignore_index=True)
+    sage_df_need = sage_df_need.rename(columns={'scannr': 'scan', 'delta_rt_model': 'delta_rt'})
+    if unify_residue:
+        sage_df_need['precursor_sequence'] = sage_df_need['peptide'].apply(lambda x: clean_psm_func(x, residues_sage))
+    else:
+        sage_df_need['precursor_sequence'] = sage_df_need['peptide']
+    sage_df_need['sequence_len'] = sage_df_need['precursor_sequence'].apply(lambda x: len(re.sub(r'[^A-Z]', '', x)))
+    sage_df_need = sage_df_need[(sage_df_need['sequence_len'] <= 50) & (sage_df_need['sequence_len'] >= 7)]
+    sage_df_need = sage_df_need[(sage_df_need['charge'] <= 5) & (sage_df_need['charge'] >= 2)]
+    sage_df_need['label'] = sage_df_need['label'].replace(-1, 0)
+    sage_df_need['ion_mobility'] = sage_df_need['ion_mobility'].fillna(0)
+    grouped = sage_df_need.groupby('scan')[SAGE_LIST_COLUMNS].agg(list).reset_index()
+    parquet_df = grouped.merge(raw_df, on='scan', how='inner')
+    assert len(parquet_df) == len(grouped)
+    return parquet_df
+
+
+def fragpipe_msdt(raw_data_path, fp_pin_path, unify_residue):
+    raw_df = read_raw(raw_data_path)
+    need_cols = ['SpecId', 'Label', 'ScanNr', 'ExpMass', 'retentiontime', 'rank', 'isotope_errors', 'hyperscore', 'delta_hyperscore', 'matched_ion_num', 'ion_series', 'unweighted_spectral_entropy', 'delta_RT_loess', 'Peptide', 'Proteins']
+    fp_sr_df = pd.read_csv(fp_pin_path, sep='\t', usecols=need_cols)
+    fp_sr_df = fp_sr_df.rename(columns={'ScanNr': 'scan', 'Label': 'label', 'Proteins': 'proteins'})
+    fp_sr_df['label'] = fp_sr_df['label'].replace(-1, 0)
+    fp_sr_df['charge'] = fp_sr_df['SpecId'].apply(lambda x: int(x.split('.')[-1].split('_')[0]))
+    if unify_residue:
+        fp_sr_df['precursor_sequence'] = fp_sr_df['Peptide'].apply(lambda x: clean_psm_func(x[2:-2], residues_frag))
+    else:
+        fp_sr_df['precursor_sequence'] = fp_sr_df['Peptide'].apply(lambda x: re.sub(r'\d+$', '', x[2:-2]))
+    fp_sr_df = fp_sr_df[['scan', 'label', 'charge', 'ExpMass', 'retentiontime', 'rank', 'isotope_errors', 'hyperscore', 'delta_hyperscore', 'matched_ion_num', 'ion_series', 'unweighted_spectral_entropy', 'delta_RT_loess', 'precursor_sequence', 'proteins']]
+    fp_parquet_df = fp_sr_df.merge(raw_df, on='scan', how='inner')
+    assert len(fp_parquet_df) == len(fp_sr_df)
+    return fp_parquet_df
+
+
+def _flat(values):
+    """Column values flattened to one array, list and array cells included."""
+    items = []
+    for value in values:
+        if isinstance(value, (list, tuple, np.ndarray)):
+            items.extend(value)
+        else:
+            items.append(value)
+    return np.array(items, dtype=object)
+
+
+def assert_same_rows(actual, expected):
+    """actual holds the rows of expected (in scan order) with equal values; floats are compared at float32 precision."""
+    assert len(actual) == len(expected)
+    for column in expected.columns:
+        assert column in actual.columns, column
+        actual_values, expected_values = _flat(actual[column]), _flat(expected[column])
+        assert len(actual_values) == len(expected_values), column
+        numeric = [isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in expected_values]
+        if all(numeric) and len(expected_values):
+            np.testing.assert_allclose(actual_values.astype(np.float64), expected_values.astype(np.float64),
+                                       rtol=1e-6, equal_nan=True, err_msg=column)
+        else:
+            assert [None if pd.isna(v) else v for v in actual_values] == \
+                   [None if pd.isna(v) else v for v in expected_values], column
+
+
+MGF_TEMPLATE = """BEGIN IONS
+TITLE={title}
+PEPMASS={pepmass}
+CHARGE={charge}
+SCANS={scan}
+RTINSECONDS={rt}
+SEQ={seq}
+LABEL={label}
+PROTEIN={protein}
+{spectrum}
+END IONS
+
+"""
+
+
+def msdt_mgf(msdt_path):
+    """MGF text of an MSDT file as the first release's msdt2mgf wrote it."""
+    spec_df = pd.read_parquet(msdt_path)
+    spec_df = spec_df[['scan', 'precursor_mz', 'charge', 'rt', 'label', 'mz_array', 'intensity_array', 'precursor_sequence', 'proteins']]
+    if isinstance(spec_df['label'][0], np.ndarray):
+        spec_df = spec_df.explode(['precursor_sequence', 'proteins', 'charge', 'label'])
+    spec_df = spec_df.dropna(subset=['mz_array', 'intensity_array'])
+    return ''.join(MGF_TEMPLATE.format(
+        title=msdt_path, pepmass=row['precursor_mz'], charge=str(int(row['charge'])) + '+', scan=row['scan'],
+        rt=row['rt'] * 60, seq=row['precursor_sequence'], label=row['label'], protein=row['proteins'],
+        spectrum="\n".join(f"{mz:.4f} {intensity:.2f}" for mz, intensity in zip(row['mz_array'], row['intensity_array'])))
+        for _, row in spec_df.iterrows())
+
+
+def mgf_frame(mgf_path, field_config):
+    """Spectra of an MGF file as the first release's mgf_to_parquet collected them."""
+    records, current = [], None
+    with open(mgf_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('COM='):
+                continue
+            if line == 'BEGIN IONS':
+                current = {'mz': [], 'intensity': []}
+            elif line == 'END IONS':
+                if current:
+                    records.append(current)
+                current = None
+            elif current is None:
+                continue
+            elif '=' in line:
+                key, value = line.split('=', 1)
+                key = key.strip().upper()
+                if key not in field_config:
+                    continue
+                dtype = field_config[key]
+                if key == 'CHARGE' and dtype == 'int':
+                    value = value.strip()
+                    current[key] = int(value[:-1]) * (1 if value.endswith('+') else -1) if value[-1] in '+-' else int(value)
+                elif dtype == 'int':
+                    current[key] = int(value)
+                elif dtype == 'float':
+                    current[key] = float(value.split()[0])
+                else:
+                    current[key] = value.strip()
+            else:
+                try:
+                    mz, intensity = map(float, line.split())
+                except ValueError:
+                    continue
+                current['mz'].append(mz)
+                current['intensity'].append(intensity)
+    return pd.DataFrame(records)
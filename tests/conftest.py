@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import generate_inputs
+from scripts import generate_msdt, pipeline, rawspectrum_reader, scan_join, step_cache
+
+
+@pytest.fixture(scope='session')
+def synthetic(tmp_path_factory):
+    """A small synthetic run: rawspectrum TSV, Sage results, FragPipe pin and MGF."""
+    return generate_inputs(str(tmp_path_factory.mktemp('synthetic')), spectra=400, mean_peaks=20)
+
+
+@pytest.fixture(autouse=True)
+def restore_options():
+    """Steps configure module level options; every test starts from the defaults."""
+    saved = [(options, dict(options)) for options in (step_cache.options, scan_join.options, pipeline.options,
+                                                      rawspectrum_reader.options, generate_msdt.writer_options)]
+    yield
+    for options, values in saved:
+        options.clear()
+        options.update(values)
@@ -0,0 +1,40 @@
+import shutil
+
+import pandas as pd
+
+from scripts import generate_msdt
+from tests import baseline
+
+
+def cohort(synthetic, tmp_path, names):
+    """A rawspectrum and Sage result per run name, named the way glob_runs pairs them."""
+    for name in names:
+        shutil.copy(synthetic['rawspectrum'], tmp_path / f'{name}_rawspectrum.tsv')
+        shutil.copy(synthetic['sage'], tmp_path / f'{name}_search_result.tsv')
+    return {'rawspectrum_glob': str(tmp_path / '*_rawspectrum.tsv'), 'search_result_dir': str(tmp_path),
+            'output_dir': str(tmp_path / 'msdt')}
+
+
+def test_runs_from_glob_and_manifest(tmp_path):
+    (tmp_path / 'b_rawspectrum.tsv').touch()
+    (tmp_path / 'a_rawspectrum.tsv').touch()
+    manifest = tmp_path / 'runs.tsv'
+    manifest.write_text('rawspectrum_path\tsearch_result_path\toutput\tunify_residue\nr.tsv\ts.tsv\to.parquet\tfalse\n')
+    runs = generate_msdt.collect_runs({'manifest': str(manifest), 'glob': {
+        'rawspectrum_glob': str(tmp_path / '*_rawspectrum.tsv'), 'search_result_dir': '/results', 'output_dir': '/out'}})
+    assert [run['output'] for run in runs] == ['o.parquet', '/out/a_sage_msdt.parquet', '/out/b_sage_msdt.parquet']
+    assert runs[0]['unify_residue'] is False
+    assert runs[1]['search_result_path'] == '/results/a_search_result.tsv'
+
+
+def test_batch_converts_every_run_and_reports_failures(synthetic, tmp_path):
+    batch = {'glob': cohort(synthetic, tmp_path, ['run1', 'run2']), 'workers': 2,
+             'runs': [{'rawspectrum_path': str(tmp_path / 'missing.tsv'), 'search_result_path': synthetic['sage'],
+                       'output': str(tmp_path / 'msdt' / 'missing.parquet')}]}
+    assert generate_msdt.generate_msdt_batch_fn(batch) == -1
+    expected = baseline.sage_msdt(synthetic['rawspectrum'], synthetic['sage'], True)
+    for name in ['run1', 'run2']:
+        baseline.assert_same_rows(pd.read_parquet(tmp_path / 'msdt' / f'{name}_sage_msdt.parquet'), expected)
+    # the converted runs are cached, only the one without input is left
+    del batch['runs']
+    assert generate_msdt.generate_msdt_batch_fn(batch) == 0
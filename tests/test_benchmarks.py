@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks import run_benchmarks
+from benchmarks.synthetic import generate_inputs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_synthetic_inputs_are_reproducible(tmp_path):
+    first = generate_inputs(str(tmp_path / 'a'), spectra=50, mean_peaks=5)
+    second = generate_inputs(str(tmp_path / 'b'), spectra=50, mean_peaks=5)
+    for name, path in first.items():
+        with open(path, 'rb') as a, open(second[name], 'rb') as b:
+            assert a.read() == b.read(), name
+
+
+def test_every_step_is_benchmarked(tmp_path):
+    output = str(tmp_path / 'result.json')
+    subprocess.run([sys.executable, 'benchmarks/run_benchmarks.py', '-spectra', '100', '-mean_peaks', '5',
+                    '-profiles', 'default,small', '-data_dir', str(tmp_path / 'data'), '-work_dir', str(tmp_path / 'work'),
+                    '-output', output], cwd=ROOT, check=True, capture_output=True)
+    with open(output) as f:
+        report = json.load(f)
+    assert [result['step'] for result in report['results']] == run_benchmarks.STEPS
+    assert all(result['state'] == 0 and result['spectra'] > 0 for result in report['results'])
+    assert [profile['profile'] for profile in report['profiles']] == ['default', 'small']
+
+
+def test_slower_steps_are_reported(tmp_path, caplog):
+    previous = tmp_path / 'previous.json'
+    previous.write_text(json.dumps({'results': [{'step': 'msdt2mgf', 'wall_s': 1.0}, {'step': 'mgf_to_parquet', 'wall_s': 1.0}]}))
+    with caplog.at_level('INFO'):
+        run_benchmarks.compare([{'step': 'msdt2mgf', 'wall_s': 1.5}, {'step': 'mgf_to_parquet', 'wall_s': 1.05}],
+                               str(previous), 0.1)
+    regressions = [record.getMessage() for record in caplog.records if record.levelname == 'WARNING']
+    assert len(regressions) == 1 and regressions[0].startswith('Regression msdt2mgf')
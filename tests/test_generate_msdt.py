@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from scripts import generate_msdt, rawspectrum_reader, scan_join
+from tests import baseline
+
+
+def test_group_psms_by_scan_matches_groupby():
+    # two chunks per column, like a concatenated Arrow table converted to pandas
+    table = pa.concat_tables([
+        pa.table({'scan': [3, 1, 3], 'peptide': ['PEPTIDEA', 'PEPTIDEB', 'PEPTIDEC'], 'q': [0.1, 0.2, 0.3]}),
+        pa.table({'scan': [1, 2], 'peptide': ['PEPTIDED', 'PEPTIDEE'], 'q': [0.4, 0.5]})])
+    psm_df = table.to_pandas()
+    grouped = generate_msdt.group_psms_by_scan(psm_df, 'scan', {'peptide': pa.string(), 'q': pa.float32()})
+
+    expected = psm_df.groupby('scan')[['peptide', 'q']].agg(list).reset_index()
+    assert grouped['scan'].to_pylist() == expected['scan'].tolist()
+    assert grouped['peptide'].to_pylist() == expected['peptide'].tolist()
+    assert grouped['q'].type == pa.list_(pa.float32())
+    np.testing.assert_allclose(np.concatenate(grouped['q'].to_pylist()), np.concatenate(expected['q'].tolist()), rtol=1e-6)
+
+
+def test_group_psms_by_scan_object_strings():
+    psm_df = pd.DataFrame({'scan': [2, 1, 2], 'proteins': pd.Series(['b', 'a', None], dtype=object)})
+    grouped = generate_msdt.group_psms_by_scan(psm_df, 'scan', {'proteins': pa.string()})
+    assert grouped['proteins'].to_pylist() == [['a'], ['b', None]]
+
+
+def test_sage_msdt_matches_baseline(synthetic, tmp_path):
+    output = str(tmp_path / 'sage_msdt.parquet')
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], output, True) == 0
+    expected = baseline.sage_msdt(synthetic['rawspectrum'], synthetic['sage'], True)
+    baseline.assert_same_rows(pd.read_parquet(output), expected)
+
+
+def test_fragpipe_msdt_matches_baseline(synthetic, tmp_path):
+    output = str(tmp_path / 'fp_msdt.parquet')
+    assert generate_msdt.gen_mzml_fragpipe_msdt(synthetic['rawspectrum'], synthetic['fragpipe'], output, False) == 0
+    expected = baseline.fragpipe_msdt(synthetic['rawspectrum'], synthetic['fragpipe'], False)
+    baseline.assert_same_rows(pd.read_parquet(output), expected.sort_values('scan', kind='stable'))
+
+
+MZML_SPECTRUM = ('<spectrum index="{index}" id="{id}"><cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{level}"/>'
+                 '</spectrum>\n')
+
+
+def write_wiff_inputs(tmp_path, ids):
+    """An mzML with an MS1 spectrum before every MS2 spectrum id, and a rawspectrum TSV of its MS2 spectra."""
+    spectra = ''.join(MZML_SPECTRUM.format(index=2 * i, id=f'cycle={i}', level=1) +
+                      MZML_SPECTRUM.format(index=2 * i + 1, id=scan_id, level=2) for i, scan_id in enumerate(ids))
+    mzml_path = tmp_path / 'run.mzML'
+    mzml_path.write_text(f'<?xml version="1.0"?><mzML xmlns="http://psi.hupo.org/ms/mzml"><run><spectrumList>\n'
+                         f'{spectra}</spectrumList></run></mzML>\n')
+    raw_path = tmp_path / 'run_rawspectrum.tsv'
+    raw_path.write_text('scan\tprecursor_mz\trt\tmz_array\tintensity_array\n' +
+                        ''.join(f'{i + 1}\t500.0\t{i}.0\t100.0,200.0\t1.0,2.0\n' for i in range(len(ids))))
+    return str(mzml_path), str(raw_path)
+
+
+def test_wiff_scan_frame_maps_search_scans(tmp_path):
+    mzml_path, raw_path = write_wiff_inputs(tmp_path, [101, 102, 103])
+    spectra = rawspectrum_reader.read_rawspectrum(raw_path, meta_columns=None)
+    raw_df = generate_msdt.wiff_scan_frame(spectra, mzml_path, str(tmp_path / 'out' / 'run.parquet'), pd.Series([103, 101]))
+    assert raw_df['scan_sr'].tolist() == [101, 102, 103]
+    assert raw_df['scan'].tolist() == [1, 2, 3]
+
+
+def test_wiff_scan_frame_rejects_unmapped_search_scans(tmp_path):
+    mzml_path, raw_path = write_wiff_inputs(tmp_path, [101, 102, 103])
+    spectra = rawspectrum_reader.read_rawspectrum(raw_path, meta_columns=None)
+    # one search scan matching by chance is not enough
+    with pytest.raises(ValueError, match='2 of 3 search result scans'):
+        generate_msdt.wiff_scan_frame(spectra, mzml_path, str(tmp_path / 'out' / 'run.parquet'), pd.Series([101, 7, 8]))
+
+
+def test_msdt_cache_key_covers_every_writer_setting(synthetic, monkeypatch):
+    inputs = [synthetic['rawspectrum'], synthetic['sage']]
+    key = generate_msdt.msdt_cache_key(inputs, 'sage', True)
+    assert generate_msdt.msdt_cache_key(inputs, 'sage', True) == key
+    # a changed default must not reuse outputs written with the old one
+    for name, value in (('row_group_size', 1024), ('peaks', {'top_n': 10}), ('profile', 'small')):
+        monkeypatch.setitem(generate_msdt.writer_options, name, value)
+        assert generate_msdt.msdt_cache_key(inputs, 'sage', True) != key, name
+        monkeypatch.undo()
+
+
+def test_msdt_cache_key_covers_the_join_settings(synthetic, monkeypatch):
+    inputs = [synthetic['rawspectrum'], synthetic['sage']]
+    key = generate_msdt.msdt_cache_key(inputs, 'sage', True)
+    monkeypatch.setitem(scan_join.options, 'on_missing', 'drop')
+    assert generate_msdt.msdt_cache_key(inputs, 'sage', True) != key
@@ -0,0 +1,75 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scripts import mgf2parquet
+from scripts.mgf2parquet import mgf_to_parquet
+from tests import baseline
+
+FIELD_TYPES = {"TITLE": "string", "PEPMASS": "float", "CHARGE": "int", "RTINSECONDS": "float", "SCANS": "string"}
+
+
+def mgf_param(synthetic, tmp_path, **param):
+    return {'mgf_path': synthetic['mgf'], 'output_path': str(tmp_path / 'mgf.parquet'), 'field_type_dict': FIELD_TYPES, **param}
+
+
+def test_writer_settings_are_part_of_the_cache_key(synthetic, tmp_path):
+    assert mgf_to_parquet(mgf_param(synthetic, tmp_path)) == 0
+    assert mgf_to_parquet(mgf_param(synthetic, tmp_path)) == 1
+    assert mgf_to_parquet(mgf_param(synthetic, tmp_path, peaks={'top_n': 5})) == 0
+    assert max(len(peaks) for peaks in pq.read_table(str(tmp_path / 'mgf.parquet'))['mz'].to_pylist()) <= 5
+
+
+def write_mgf(tmp_path, charges):
+    path = str(tmp_path / 'charges.mgf')
+    with open(path, 'w') as f:
+        for i, charge in enumerate(charges):
+            f.write(f"BEGIN IONS\nTITLE=s{i}\nPEPMASS=500.5\nCHARGE={charge}\n100.0 1.0\nEND IONS\n")
+    return path
+
+
+def test_charges_are_signed_integers(tmp_path):
+    param = {'mgf_path': write_mgf(tmp_path, ['2+', '3-', '4']), 'output_path': str(tmp_path / 'out.parquet'),
+             'field_type_dict': FIELD_TYPES}
+    assert mgf_to_parquet(param) == 0
+    assert pq.read_table(param['output_path'])['CHARGE'].to_pylist() == [2, -3, 4]
+
+
+def test_unparsable_charge_fails_unless_lenient(tmp_path):
+    param = {'mgf_path': write_mgf(tmp_path, ['2+', '2+ and 3+']), 'output_path': str(tmp_path / 'out.parquet'),
+             'field_type_dict': FIELD_TYPES}
+    assert mgf_to_parquet(param) == -1
+    assert not (tmp_path / 'out.parquet').exists()
+    assert mgf_to_parquet({**param, 'strict_charge': False}) == 0
+    assert pq.read_table(param['output_path'])['CHARGE'].to_pylist() == [2, None]
+
+
+def test_output_matches_baseline_in_bounded_row_groups(synthetic, tmp_path):
+    param = mgf_param(synthetic, tmp_path, batch_size=64)
+    assert mgf_to_parquet(param) == 0
+    parquet_file = pq.ParquetFile(param['output_path'])
+    assert parquet_file.metadata.num_row_groups > 1
+    assert max(parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.metadata.num_row_groups)) <= 64
+    actual = parquet_file.read().to_pandas()
+    assert actual.columns.tolist() == ['mz', 'intensity'] + list(FIELD_TYPES)
+    baseline.assert_same_rows(actual, baseline.mgf_frame(synthetic['mgf'], FIELD_TYPES))
+
+
+def test_chunks_start_at_spectra_and_parse_like_the_whole_file(synthetic):
+    chunks = mgf2parquet.split_mgf(synthetic['mgf'], 4096)
+    assert len(chunks) > 10
+    with open(synthetic['mgf'], 'rb') as f:
+        data = f.read()
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(data)
+    assert all(end == start for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]))
+    assert all(data[start:end].startswith(b'BEGIN IONS') for start, end in chunks[1:])
+    parsed = pa.Table.from_batches([batch for start, end in chunks
+                                    for batch in mgf2parquet.parse_chunk(synthetic['mgf'], start, end, FIELD_TYPES, 100)])
+    with open(synthetic['mgf']) as f:
+        assert parsed.equals(pa.Table.from_batches(list(mgf2parquet.spectrum_batches(f, FIELD_TYPES, 100))))
+
+
+def test_parallel_workers_write_the_same_output(synthetic, tmp_path):
+    serial, parallel = mgf_param(synthetic, tmp_path), mgf_param(synthetic, tmp_path, workers=2)
+    parallel['output_path'] = str(tmp_path / 'parallel.parquet')
+    assert mgf_to_parquet(serial) == 0 and mgf_to_parquet(parallel) == 0
+    assert pq.read_table(parallel['output_path']).equals(pq.read_table(serial['output_path']))
@@ -0,0 +1,23 @@
+import pytest
+
+from scripts import generate_msdt
+from scripts.msdt2mgf import msdt2mgf
+from tests import baseline
+
+
+@pytest.fixture(scope='module')
+def msdt_files(synthetic, tmp_path_factory):
+    directory = tmp_path_factory.mktemp('msdt')
+    sage, fragpipe = str(directory / 'sage_msdt.parquet'), str(directory / 'fp_msdt.parquet')
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], sage, True) == 0
+    assert generate_msdt.gen_mzml_fragpipe_msdt(synthetic['rawspectrum'], synthetic['fragpipe'], fragpipe, True) == 0
+    return {'sage': sage, 'fragpipe': fragpipe}
+
+
+@pytest.mark.parametrize('engine', ['sage', 'fragpipe'])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_mgf_matches_baseline(msdt_files, tmp_path, engine, workers):
+    output = str(tmp_path / 'out.mgf')
+    assert msdt2mgf({'msdt_path': msdt_files[engine], 'output_path': output, 'workers': workers, 'batch_size': 50}) == 0
+    with open(output) as f:
+        assert f.read() == baseline.msdt_mgf(msdt_files[engine])
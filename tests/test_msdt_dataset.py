@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from scripts import generate_msdt, msdt_dataset, msdt_reader
+
+
+def peaks_table(rows, peaks=50):
+    rng = np.random.default_rng(0)
+    offsets = pa.array(np.arange(rows + 1, dtype=np.int32) * peaks)
+    return pa.table({
+        'scan': pa.array(np.arange(rows, dtype=np.int64)),
+        'label': pa.array(np.arange(rows) % 2, pa.int8()),
+        'mz_array': pa.ListArray.from_arrays(offsets, pa.array(rng.random(rows * peaks, dtype=np.float32))),
+        'intensity_array': pa.ListArray.from_arrays(offsets, pa.array(rng.random(rows * peaks, dtype=np.float32)))
+    })
+
+
+def test_shards_are_size_bounded_and_summarized(tmp_path):
+    table = peaks_table(2000)
+    root = str(tmp_path / 'dataset')
+    shards = msdt_dataset.write_dataset(table, root, partition={'engine': 'sage'}, partition_by=['label'],
+                                        target_shard_mb=0.1, row_group_size=100)
+    assert len(shards) > 2
+    assert all(os.path.relpath(path, root).startswith('engine=sage' + os.sep + 'label=') for path in shards)
+    for path in shards:
+        metadata = pq.read_metadata(path)
+        assert all(metadata.row_group(i).num_rows <= 100 for i in range(metadata.num_row_groups))
+    summary = pq.read_metadata(os.path.join(root, msdt_dataset.METADATA_FILE))
+    assert summary.num_rows == table.num_rows
+    # every row once, in its original order within a partition
+    read = ds.dataset(root, format='parquet', partitioning='hive').to_table()
+    assert sorted(read['scan'].to_pylist()) == table['scan'].to_pylist()
+    for label in (0, 1):
+        part = read.filter(ds.field('label') == label)['scan'].to_pylist()
+        assert part == sorted(part)
+
+
+def test_rewrite_replaces_the_shards(tmp_path):
+    root = str(tmp_path / 'dataset')
+    msdt_dataset.write_dataset(peaks_table(2000), root, target_shard_mb=0.1, row_group_size=100)
+    msdt_dataset.write_dataset(peaks_table(10), root, target_shard_mb=0.1, row_group_size=100)
+    assert ds.dataset(root, format='parquet', exclude_invalid_files=True).count_rows() == 10
+
+
+def test_msdt_step_writes_a_dataset(synthetic, tmp_path):
+    generate_msdt.configure_writer({'dataset': {'target_shard_mb': 0.05}, 'row_group_size': 64})
+    output = str(tmp_path / 'sage_msdt')
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], output, True,
+                                                 {'engine': 'sage'}) == 0
+    generate_msdt.configure_writer({'dataset': None})
+    single = str(tmp_path / 'sage_msdt.parquet')
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], single, True) == 0
+    sharded = msdt_reader.concat_batches(list(msdt_reader.iter_msdt(output)))
+    whole = msdt_reader.read_msdt(single)
+    assert np.array_equal(sharded.mz, whole.mz) and np.array_equal(sharded.offsets, whole.offsets)
+    assert len(msdt_reader.expand_paths(output)) > 1
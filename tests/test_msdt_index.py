@@ -0,0 +1,42 @@
+import os
+
+import pyarrow.parquet as pq
+import pytest
+
+from scripts import generate_msdt, msdt_index
+
+
+@pytest.fixture
+def msdt_path(synthetic, tmp_path):
+    generate_msdt.configure_writer({'row_group_size': 50})
+    path = str(tmp_path / 'sage_msdt.parquet')
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], path, True) == 0
+    return path
+
+
+@pytest.mark.parametrize('with_index', [True, False])
+def test_spectra_by_scan(msdt_path, with_index):
+    assert os.path.exists(msdt_index.index_path(msdt_path))
+    if not with_index:
+        os.remove(msdt_index.index_path(msdt_path))
+    table = pq.read_table(msdt_path)
+    scans = sorted(table['scan'].to_pylist()[::37], reverse=True) + [10 ** 9]
+    spectra = msdt_index.get_spectra(msdt_path, scans=scans, columns=['scan', 'mz_array'])
+    assert spectra['scan'].to_pylist() == sorted(scans[:-1])
+    by_scan = dict(zip(table['scan'].to_pylist(), table['mz_array'].to_pylist()))
+    assert spectra['mz_array'].to_pylist() == [by_scan[scan] for scan in sorted(scans[:-1])]
+
+
+def test_spectra_by_peptide(msdt_path):
+    table = pq.read_table(msdt_path, columns=['scan', 'precursor_sequence'])
+    peptide = table['precursor_sequence'][5].as_py()[0]
+    spectra = msdt_index.get_spectra(msdt_path, peptides=[peptide])
+    expected = [scan for scan, peptides in zip(table['scan'].to_pylist(), table['precursor_sequence'].to_pylist())
+                if peptide in peptides]
+    assert spectra['scan'].to_pylist() == expected
+
+
+def test_index_of_another_file_version_is_ignored(msdt_path):
+    with open(msdt_path, 'ab') as f:
+        f.write(b'\0')
+    assert msdt_index.read_index(msdt_path) is None
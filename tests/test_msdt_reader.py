@@ -0,0 +1,41 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scripts import msdt_reader
+
+SPECTRA = [[100.0, 200.0], [150.0], [120.0, 130.0, 140.0]]
+
+
+def peak_lists(values, start):
+    """A list array over values whose first list starts at position start of the value buffer."""
+    lengths = [len(spectrum) for spectrum in SPECTRA]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32) + start
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))
+
+
+def test_lists_at_different_buffer_positions_stay_views():
+    flat = np.array([peak for spectrum in SPECTRA for peak in spectrum])
+    mz_values = np.concatenate([np.full(3, -1.0), flat])
+    intensity_values = np.concatenate([np.full(1, -1.0), flat * 10])
+    batch = pa.RecordBatch.from_arrays([peak_lists(mz_values, 3), peak_lists(intensity_values, 1), pa.array([1, 2, 3])],
+                                       ['mz_array', 'intensity_array', 'scan'])
+    spectra = msdt_reader.to_spectrum_batch(batch)
+    for i, expected in enumerate(SPECTRA):
+        mz, intensity = spectra.spectrum(i)
+        assert mz.tolist() == expected
+        assert intensity.tolist() == [peak * 10 for peak in expected]
+    assert np.shares_memory(spectra.mz, batch['mz_array'].values.to_numpy())
+    assert np.shares_memory(spectra.intensity, batch['intensity_array'].values.to_numpy())
+
+
+def test_several_row_groups_are_read_whole(tmp_path):
+    path = str(tmp_path / 'spectra.parquet')
+    table = pa.table({'mz_array': pa.array(SPECTRA), 'intensity_array': pa.array(SPECTRA), 'scan': [1, 2, 3]})
+    pq.write_table(table, path, row_group_size=1)
+    spectra = msdt_reader.read_msdt(path)
+    assert [spectra.spectrum(i)[0].tolist() for i in range(len(spectra))] == SPECTRA
+    assert spectra.meta['scan'].to_pylist() == [1, 2, 3]
+    batches = list(msdt_reader.iter_msdt(path, batch_size=2))
+    assert sum(len(batch) for batch in batches) == len(SPECTRA)
+    assert msdt_reader.concat_batches(batches).ragged()[1].tolist() == spectra.mz.tolist()
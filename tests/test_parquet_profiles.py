@@ -0,0 +1,27 @@
+import pyarrow.parquet as pq
+import pytest
+
+from scripts import generate_msdt, parquet_profiles
+
+
+@pytest.mark.parametrize('profile', list(parquet_profiles.PROFILES))
+def test_profiles_keep_the_values_and_record_themselves(synthetic, tmp_path, profile):
+    default = str(tmp_path / 'default.parquet')
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], default, True) == 0
+    generate_msdt.configure_writer({'profile': profile})
+    output = str(tmp_path / f'{profile}.parquet')
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], output, True) == 0
+    assert pq.read_table(output).equals(pq.read_table(default))
+    assert parquet_profiles.read_profile(output)['profile'] == profile
+    assert parquet_profiles.read_profile(default) is None
+    columns = pq.ParquetFile(output).metadata.row_group(0)
+    codecs = {columns.column(i).path_in_schema: columns.column(i).compression for i in range(columns.num_columns)}
+    assert codecs['mz_array.list.element'] == parquet_profiles.PROFILES[profile]['compression'].upper()
+    if parquet_profiles.PROFILES[profile]['byte_stream_split']:
+        peaks = [columns.column(i) for i in range(columns.num_columns) if columns.column(i).path_in_schema == 'mz_array.list.element'][0]
+        assert 'BYTE_STREAM_SPLIT' in peaks.encodings
+
+
+def test_unknown_profile_is_rejected():
+    with pytest.raises(ValueError, match='compact'):
+        generate_msdt.configure_writer({'profile': 'compact'})
@@ -0,0 +1,79 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from scripts import peak_processing
+
+
+def reference(mz, intensity, config, precursor):
+    """The stages applied to one spectrum with plain Python."""
+    peaks = list(zip(mz.tolist(), intensity.tolist()))
+    peaks = [(m, i) for m, i in peaks if m >= config.get('mz_min', -np.inf) and m <= config.get('mz_max', np.inf)]
+    if 'remove_precursor_da' in config and not np.isnan(precursor):
+        peaks = [(m, i) for m, i in peaks if abs(m - precursor) > config['remove_precursor_da']]
+    if 'min_relative_intensity' in config and peaks:
+        base = max(i for _, i in peaks)
+        peaks = [(m, i) for m, i in peaks if i >= config['min_relative_intensity'] * base]
+    if 'top_n' in config:
+        kept = sorted(range(len(peaks)), key=lambda k: (-peaks[k][1], k))[:config['top_n']]
+        peaks = [peaks[k] for k in sorted(kept)]
+    intensities = np.array([i for _, i in peaks], dtype=intensity.dtype)
+    if config.get('normalize') == 'sqrt':
+        intensities = np.sqrt(intensities)
+    if config.get('normalize') and len(intensities):
+        scale = intensities.sum() if config['normalize'] == 'sum' else intensities.max()
+        intensities = intensities / (scale or 1)
+    return [m for m, _ in peaks], intensities.tolist()
+
+
+CONFIGS = [
+    {'top_n': 3},
+    {'mz_min': 200, 'mz_max': 800, 'normalize': 'base_peak'},
+    {'remove_precursor_da': 20, 'min_relative_intensity': 0.3, 'normalize': 'sqrt'},
+    {'top_n': 5, 'min_relative_intensity': 0.1, 'normalize': 'sum'},
+]
+
+
+@pytest.mark.parametrize('config', CONFIGS)
+def test_stages_match_a_per_spectrum_reference(config):
+    rng = np.random.default_rng(1)
+    counts = rng.integers(0, 12, 200)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    mz = np.sort(rng.uniform(100, 1000, offsets[-1])).astype(np.float32)
+    # rounded intensities give ties for top_n
+    intensity = rng.integers(1, 6, offsets[-1]).astype(np.float32)
+    precursor = rng.uniform(100, 1000, len(counts))
+    precursor[::7] = np.nan
+    new_offsets, new_mz, new_intensity = peak_processing.process_peaks(offsets, mz, intensity, config, precursor)
+    for s in range(len(counts)):
+        expected_mz, expected_intensity = reference(mz[offsets[s]:offsets[s + 1]], intensity[offsets[s]:offsets[s + 1]],
+                                                    config, precursor[s])
+        assert new_mz[new_offsets[s]:new_offsets[s + 1]].tolist() == expected_mz
+        np.testing.assert_allclose(new_intensity[new_offsets[s]:new_offsets[s + 1]], expected_intensity, rtol=1e-6)
+
+
+def test_list_columns_are_processed_per_chunk():
+    mz = pa.chunked_array([pa.array([[100.0, 200.0, 300.0]], pa.list_(pa.float32())),
+                           pa.array([[150.0], [], [400.0, 500.0]], pa.list_(pa.float32())).slice(0, 3)])
+    intensity = pa.chunked_array([pa.array([[1.0, 3.0, 2.0]], pa.list_(pa.float32())),
+                                  pa.array([[5.0], [], [4.0, 8.0]], pa.list_(pa.float32()))])
+    new_mz, new_intensity = peak_processing.process_list_columns(mz, intensity, {'top_n': 1, 'normalize': 'base_peak'})
+    assert new_mz.to_pylist() == [[200.0], [150.0], [], [500.0]]
+    assert new_intensity.to_pylist() == [[1.0], [1.0], [], [1.0]]
+
+
+def test_unknown_settings_are_rejected():
+    with pytest.raises(ValueError, match='top_k'):
+        peak_processing.check_config({'top_k': 5})
+    with pytest.raises(ValueError, match='normalization'):
+        peak_processing.check_config({'normalize': 'max'})
+
+
+def test_msdt_writer_applies_the_stages(synthetic, tmp_path):
+    from scripts import generate_msdt, msdt_reader
+    output = str(tmp_path / 'sage_msdt.parquet')
+    generate_msdt.configure_writer({'peaks': {'top_n': 4, 'normalize': 'base_peak'}})
+    assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], output, True) == 0
+    spectra = msdt_reader.read_msdt(output)
+    assert spectra.lengths.max() == 4
+    assert all(spectra.spectrum(i)[1].max() == 1 for i in range(len(spectra)) if spectra.lengths[i])
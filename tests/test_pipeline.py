@@ -0,0 +1,66 @@
+import time
+
+import pyarrow.parquet as pq
+import pytest
+
+from scripts import generate_msdt, pipeline
+
+
+def test_ordered_map_keeps_input_order():
+    def slow_square(x):
+        time.sleep(0.01 * (x % 3))
+        return x * x
+
+    assert list(pipeline.ordered_map(slow_square, range(20), threads=4)) == [x * x for x in range(20)]
+
+
+def test_ordered_map_reads_items_lazily():
+    consumed = []
+
+    def items():
+        for x in range(100):
+            consumed.append(x)
+            yield x
+
+    results = pipeline.ordered_map(lambda x: x, items(), threads=2, window=3)
+    assert next(results) == 0
+    assert len(consumed) <= 4
+    results.close()
+
+
+def test_errors_reach_the_consumer():
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError('bad block')
+        return x
+
+    with pytest.raises(ValueError, match='bad block'):
+        list(pipeline.ordered_map(fail_on_three, range(10), threads=2))
+    with pytest.raises(ValueError, match='bad block'):
+        pipeline.Background(fail_on_three, 3).result()
+
+
+def test_background_writer_reraises_and_drains():
+    written = []
+
+    def write(item):
+        if item == 2:
+            raise OSError('disk full')
+        written.append(item)
+
+    writer = pipeline.BackgroundWriter(write, queue_size=1)
+    with pytest.raises(OSError, match='disk full'):
+        for item in range(50):
+            writer.put(item)
+        writer.close()
+    assert written == [0, 1]
+
+
+def test_threads_do_not_change_the_output(synthetic, tmp_path):
+    outputs = []
+    for threads in (1, 4):
+        pipeline.configure({'threads': threads, 'queue_size': 2})
+        generate_msdt.configure_writer({'row_group_size': 32})
+        outputs.append(str(tmp_path / f'sage_{threads}.parquet'))
+        assert generate_msdt.gen_mzml_tims_sage_msdt(synthetic['rawspectrum'], synthetic['sage'], outputs[-1], True) == 0
+    assert pq.read_table(outputs[0]).equals(pq.read_table(outputs[1]))
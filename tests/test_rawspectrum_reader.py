@@ -0,0 +1,131 @@
+import os
+import stat
+
+import numpy as np
+import pytest
+
+from scripts import generate_msdt, rawspectrum_reader
+from tests import baseline
+
+
+def fake_extractor(tmp_path, monkeypatch, script):
+    tool = str(tmp_path / 'extractor')
+    with open(tool, 'w') as f:
+        f.write('#!/bin/sh\n' + script)
+    os.chmod(tool, os.stat(tool).st_mode | stat.S_IEXEC)
+    monkeypatch.setitem(rawspectrum_reader.rawspectrum_tools, 'mzml', tool)
+    return tool
+
+
+def open_fds():
+    return set(os.listdir('/proc/self/fd'))
+
+
+def test_streamed_spectra_match_the_tsv(synthetic, tmp_path, monkeypatch):
+    fake_extractor(tmp_path, monkeypatch, f'cat "{synthetic["rawspectrum"]}" > "$2"\n')
+    raw_data_path = str(tmp_path / 'run_rawspectrum.tsv')
+    fused = {'data_type': 'mzml', 'input': synthetic['rawspectrum'], 'keep_tsv': True}
+    spectra = rawspectrum_reader.extract_rawspectrum(raw_data_path, fused)
+    expected = rawspectrum_reader.read_rawspectrum(synthetic['rawspectrum'])
+    assert spectra.meta_frame().equals(expected.meta_frame())
+    with open(raw_data_path, 'rb') as copy, open(synthetic['rawspectrum'], 'rb') as source:
+        assert copy.read() == source.read()
+
+
+def test_fused_runs_do_not_affect_later_runs(synthetic, tmp_path, monkeypatch):
+    fake_extractor(tmp_path, monkeypatch, f'cat "{synthetic["rawspectrum"]}" > "$2"\n')
+    run = {'rawspectrum_path': str(tmp_path / 'run_rawspectrum.tsv'), 'search_result_path': synthetic['sage'],
+           'output': str(tmp_path / 'fused.parquet')}
+    assert generate_msdt.convert_run({**run, 'raw_data_path': synthetic['rawspectrum']}) == 0
+    assert not os.path.exists(run['rawspectrum_path'])
+    # without raw_data_path the run reads its TSV, which was never written
+    assert generate_msdt.convert_run({**run, 'output': str(tmp_path / 'tsv.parquet')}) == 2
+
+
+def test_extractor_failure_is_raised(tmp_path, monkeypatch):
+    fake_extractor(tmp_path, monkeypatch, 'echo broken input >&2\nexit 3\n')
+    fused = {'data_type': 'mzml', 'input': str(tmp_path / 'run.mzML'), 'keep_tsv': False}
+    before = open_fds()
+    with pytest.raises(RuntimeError, match='broken input'):
+        rawspectrum_reader.extract_rawspectrum(str(tmp_path / 'run_rawspectrum.tsv'), fused)
+    assert open_fds() == before
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc')
+def test_fifo_is_closed_when_the_extractor_cannot_start(tmp_path, monkeypatch):
+    monkeypatch.setitem(rawspectrum_reader.rawspectrum_tools, 'mzml', str(tmp_path / 'missing'))
+    fused = {'data_type': 'mzml', 'input': str(tmp_path / 'run.mzML'), 'keep_tsv': False}
+    made = []
+    mkdtemp = rawspectrum_reader.tempfile.mkdtemp
+    monkeypatch.setattr(rawspectrum_reader.tempfile, 'mkdtemp', lambda **kw: made.append(mkdtemp(**kw)) or made[-1])
+    before = open_fds()
+    with pytest.raises(FileNotFoundError) as error:
+        rawspectrum_reader.extract_rawspectrum(str(tmp_path / 'run_rawspectrum.tsv'), fused)
+    # closed by the reader itself, not once the traceback holding its frame is collected
+    assert error.value and open_fds() == before
+    assert made and not os.path.exists(made[0])
+
+
+def test_parsed_spectra_match_baseline(synthetic):
+    expected = baseline.read_raw(synthetic['rawspectrum'])
+    # a small block size parses the file in many blocks
+    spectra = rawspectrum_reader.read_rawspectrum(synthetic['rawspectrum'], block_size=1 << 12)
+    assert spectra.meta['scan'].tolist() == expected['scan'].tolist()
+    np.testing.assert_allclose(spectra.meta['rt'], expected['rt'])
+    mz, intensity = spectra.peak_arrays()
+    assert mz.to_pylist() == [list(peaks) for peaks in expected['mz_array']]
+    assert intensity.to_pylist() == [list(peaks) for peaks in expected['intensity_array']]
+
+
+def test_incomplete_rows_are_dropped(tmp_path):
+    path = tmp_path / 'run_rawspectrum.tsv'
+    path.write_text('scan\tprecursor_mz\trt\tmz_array\tintensity_array\n'
+                    '1\t500.0\t1.0\t100.5,200.25\t10,20\n'
+                    '\t501.0\t2.0\t100.0\t1\n'
+                    '3\t502.0\t3.0\t\t\n'
+                    '4\t503.0\t4.0\t300.0\t30\n')
+    spectra = rawspectrum_reader.read_rawspectrum(str(path))
+    assert spectra.meta['scan'].tolist() == [1, 4]
+    assert spectra.source_row.tolist() == [0, 3] and spectra.num_source_rows == 4
+    mz, _ = spectra.peak_arrays(np.array([1, -1, 0]))
+    assert mz.to_pylist() == [[300.0], [], [100.5, 200.25]]
+
+
+def test_spectra_are_parsed_once_per_run(synthetic, tmp_path, monkeypatch):
+    parses = []
+    read = rawspectrum_reader.read_rawspectrum
+    monkeypatch.setattr(rawspectrum_reader, 'read_rawspectrum', lambda *a, **kw: parses.append(a) or read(*a, **kw))
+    mzml = {'need_mzml': True, 'need_sage': True, 'need_fragpipe': True, 'rawspectrum_path': synthetic['rawspectrum'],
+            'sage_search_result_path': synthetic['sage'], 'fp_pin_path': synthetic['fragpipe'],
+            'sage_output': str(tmp_path / 'sage.parquet'), 'fp_output': str(tmp_path / 'fragpipe.parquet')}
+    assert generate_msdt.generate_msdt_fn({'mzml': mzml}) == 0
+    assert len(parses) == 1
+    # nothing is kept once the call returns
+    mzml = {**mzml, 'sage_output': str(tmp_path / 'sage_again.parquet'), 'fp_output': str(tmp_path / 'fragpipe_again.parquet')}
+    assert generate_msdt.generate_msdt_fn({'mzml': mzml}) == 0
+    assert len(parses) == 2
+
+
+def test_sidecar_is_reused_by_later_processes(synthetic, tmp_path, monkeypatch):
+    rawspectrum_reader.configure({'sidecar': True, 'sidecar_dir': str(tmp_path)})
+    first = rawspectrum_reader.load_rawspectrum(synthetic['rawspectrum'])
+    assert os.path.exists(rawspectrum_reader.sidecar_path(synthetic['rawspectrum']))
+    monkeypatch.setattr(rawspectrum_reader, 'read_rawspectrum', None)
+    again = rawspectrum_reader.load_rawspectrum(synthetic['rawspectrum'])
+    assert again.meta.equals(first.meta)
+    assert np.array_equal(again.offsets, first.offsets) and np.array_equal(again.mz_values, first.mz_values)
+    assert np.array_equal(again.source_row, first.source_row) and again.num_source_rows == first.num_source_rows
+
+
+def test_stale_sidecar_is_replaced(synthetic, tmp_path):
+    rawspectrum_reader.configure({'sidecar': True, 'sidecar_dir': str(tmp_path)})
+    path = str(tmp_path / 'run_rawspectrum.tsv')
+    with open(synthetic['rawspectrum']) as source, open(path, 'w') as f:
+        f.write(source.read())
+    first = rawspectrum_reader.load_rawspectrum(path)
+    # a changed TSV is parsed again
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, 'w') as f:
+        f.writelines(lines[:-1])
+    assert len(rawspectrum_reader.load_rawspectrum(path)) == len(first) - 1
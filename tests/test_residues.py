@@ -0,0 +1,36 @@
+import random
+import re
+
+import pandas as pd
+
+from scripts import generate_msdt
+from tests import baseline
+
+
+def random_peptides(residues_dict, count, seed=0):
+    """Peptides mixing plain residues with the spellings and unified forms of the dict, overlapping keys included."""
+    rng = random.Random(seed)
+    tokens = list(residues_dict) + list(residues_dict.values()) + list('ACDEFGHIKLMNPQRSTVWY')
+    return [''.join(rng.choice(tokens) for _ in range(rng.randint(1, 8))) for _ in range(count)]
+
+
+def test_sage_residues_match_baseline():
+    peptides = pd.Series(random_peptides(generate_msdt.residues_sage, 2000) * 2)
+    sequences, lengths = generate_msdt.unify_peptides(peptides, generate_msdt.residues_sage)
+    expected = [baseline.clean_psm_func(peptide, generate_msdt.residues_sage) for peptide in peptides]
+    assert sequences.tolist() == expected
+    assert lengths.tolist() == [len(re.sub(r'[^A-Z]', '', peptide)) for peptide in expected]
+
+
+def test_fragpipe_residues_match_baseline():
+    peptides = pd.Series([f'K.{peptide}.R' for peptide in random_peptides(generate_msdt.residues_frag, 2000, seed=1)])
+    sequences, _ = generate_msdt.unify_peptides(peptides, generate_msdt.residues_frag, strip_flanks=True)
+    assert sequences.tolist() == [baseline.clean_psm_func(peptide[2:-2], generate_msdt.residues_frag) for peptide in peptides]
+    sequences, _ = generate_msdt.unify_peptides(pd.Series(['K.PEPTIDE12.R']), strip_flanks=True, strip_trailing_numbers=True)
+    assert sequences.tolist() == ['PEPTIDE']
+
+
+def test_index_follows_the_rows():
+    peptides = pd.Series(['PEPTIDEK', 'PEPTIDEK', 'ACDK'], index=[7, 3, 5])
+    sequences, lengths = generate_msdt.unify_peptides(peptides)
+    assert sequences.index.tolist() == [7, 3, 5] and lengths.tolist() == [8, 8, 4]
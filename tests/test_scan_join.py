@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts import scan_join
+from scripts.rawspectrum_reader import RAW_ROW
+
+
+def spectra_frame(scans):
+    return pd.DataFrame({'scan': scans, 'rt': np.arange(len(scans), dtype=float), RAW_ROW: np.arange(len(scans))})
+
+
+def test_join_matches_an_inner_merge():
+    search = pd.DataFrame({'scan': [5, 2, 9, 2], 'psm': list('abcd')})
+    raw = spectra_frame([1, 2, 5, 9, 40])
+    joined = scan_join.join_spectra(search, raw, 'scan', on_duplicate='keep')
+    expected = search.merge(raw, on='scan', how='inner')
+    pd.testing.assert_frame_equal(joined[expected.columns].reset_index(drop=True), expected)
+
+
+def test_text_scans_are_factorized():
+    search = pd.DataFrame({'scan': ['x=3', 'x=1']})
+    raw = spectra_frame(['x=1', 'x=2', 'x=3'])
+    assert scan_join.join_spectra(search, raw, 'scan')[RAW_ROW].tolist() == [2, 0]
+
+
+def test_missing_scans():
+    search = pd.DataFrame({'scan': [1, 7], 'psm': ['a', 'b']})
+    raw = spectra_frame([1, 2])
+    with pytest.raises(ValueError, match='1 search rows without a spectrum'):
+        scan_join.join_spectra(search, raw, 'scan')
+    assert scan_join.join_spectra(search, raw, 'scan', on_missing='drop')['psm'].tolist() == ['a']
+    kept = scan_join.join_spectra(search, raw, 'scan', on_missing='keep')
+    assert kept[RAW_ROW].tolist() == [0, -1]
+    assert np.isnan(kept['rt'].iloc[1])
+
+
+def test_duplicate_scans():
+    search = pd.DataFrame({'scan': [1, 2, 2], 'psm': ['a', 'b', 'c']})
+    raw = spectra_frame([1, 2, 3])
+    with pytest.raises(ValueError, match='duplicate scans'):
+        scan_join.join_spectra(search, raw, 'scan')
+    assert scan_join.join_spectra(search, raw, 'scan', on_duplicate='drop')['psm'].tolist() == ['a']
+
+
+def test_spectra_are_selected_by_position():
+    search = pd.DataFrame({'scan': [9, 1, 4], 'psm': list('abc')})
+    # a filtered spectra frame keeps its old labels
+    raw = spectra_frame([1, 2, 9, 4]).set_index(pd.Index([30, 2, 0, 1]))
+    joined = scan_join.join_spectra(search, raw, 'scan')
+    assert joined['rt'].tolist() == [2.0, 0.0, 3.0]
+    assert joined[RAW_ROW].tolist() == [2, 0, 3]
+
+
+def test_configure_rejects_unknown_actions():
+    with pytest.raises(ValueError):
+        scan_join.configure({'on_missing': 'ignore'})
@@ -0,0 +1,57 @@
+import threading
+import time
+
+from scripts.scheduler import Step, link_steps, run_steps, split_threads
+
+
+def test_steps_depend_on_the_producers_of_their_inputs():
+    steps = link_steps([
+        Step('raw', None, {}, inputs=['/d/run.mzML'], outputs=['/w/run_rawspectrum.tsv']),
+        Step('search', None, {}, inputs=['/d/run.mzML'], outputs=['/w/fragpipe']),
+        Step('msdt', None, {}, inputs=['/w/run_rawspectrum.tsv', '/w/fragpipe/run/run_edited.pin'], outputs=['/w/run.parquet']),
+        Step('batch', None, {})
+    ])
+    assert [step.deps for step in steps] == [set(), set(), {'raw', 'search'}, {'raw', 'search', 'msdt'}]
+
+
+def test_independent_steps_overlap_and_dependents_wait():
+    started, finished = {}, {}
+
+    def step_fn(name):
+        def run(param):
+            started[name] = time.perf_counter()
+            time.sleep(0.2)
+            finished[name] = time.perf_counter()
+            return 0 if name != 'b' else -1
+        return run
+
+    steps = link_steps([Step('a', step_fn('a'), {}, inputs=[], outputs=['/w/a']),
+                        Step('b', step_fn('b'), {}, inputs=[], outputs=['/w/b']),
+                        Step('c', step_fn('c'), {}, inputs=['/w/a', '/w/b'])])
+    assert run_steps(steps, 2) == {'a': 0, 'b': -1, 'c': 0}
+    assert started['b'] < finished['a']
+    # a failed dependency does not cancel its dependents
+    assert started['c'] >= max(finished['a'], finished['b'])
+
+
+def test_max_parallel_bounds_running_steps():
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def run(param):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        raise RuntimeError('boom')
+
+    states = run_steps([Step(f's{i}', run, {}, inputs=[]) for i in range(4)], 2)
+    assert states == {f's{i}': -1 for i in range(4)}
+    assert peak[0] == 2
+
+
+def test_thread_budget_is_shared():
+    steps = split_threads([Step('sage', None, {'thread_num': 2}, threaded=True), Step('fragpipe', None, {}, threaded=True),
+                           Step('msdt', None, {})], 8)
+    assert [step.param.get('thread_num') for step in steps] == [2, 4, None]
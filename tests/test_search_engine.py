@@ -0,0 +1,113 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from scripts import search_engine
+
+FAKE_FRAGPIPE = f"""#!{sys.executable}
+import os, sys
+args = sys.argv[1:]
+manifest, workdir = args[args.index('--manifest') + 1], args[args.index('--workdir') + 1]
+if os.environ.get('FAKE_FRAGPIPE_WRITE', '1') == '1':
+    for line in open(manifest):
+        data_path, experiment = line.split('\\t')[:2]
+        run = os.path.splitext(os.path.basename(data_path))[0]
+        os.makedirs(os.path.join(workdir, experiment), exist_ok=True)
+        open(os.path.join(workdir, experiment, run + '_edited.pin'), 'w').write('SpecId\\n')
+sys.exit(int(os.environ.get('FAKE_FRAGPIPE_EXIT', '0')))
+"""
+
+
+@pytest.fixture
+def fragpipe(tmp_path, monkeypatch):
+    exe = tmp_path / 'FragPipe' / 'bin' / 'fragpipe'
+    exe.parent.mkdir(parents=True)
+    exe.write_text(FAKE_FRAGPIPE)
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(search_engine, 'fragpipe_exe_path', str(exe))
+    workdir = tmp_path / 'fp'
+    data_paths = [str(tmp_path / 'a.mzML'), str(tmp_path / 'b.mzML')]
+    return {'workdir': str(workdir), 'data_paths': data_paths, 'workflow_path': str(tmp_path / 'wf.workflow')}
+
+
+def write_stale_pins(workdir):
+    os.makedirs(os.path.join(workdir, 'old'), exist_ok=True)
+    for run in ('a', 'b'):
+        open(os.path.join(workdir, 'old', f'{run}_edited.pin'), 'w').write('stale\n')
+
+
+def test_fragpipe_search_finds_pins_of_every_run(fragpipe):
+    assert search_engine.generate_fp_search_result_fn(fragpipe) == 0
+    assert sorted(search_engine.find_pin_files(fragpipe['workdir'])) == ['a', 'b']
+
+
+def test_fragpipe_failure_is_not_hidden_by_stale_pins(fragpipe, monkeypatch):
+    write_stale_pins(fragpipe['workdir'])
+    monkeypatch.setenv('FAKE_FRAGPIPE_EXIT', '1')
+    assert search_engine.generate_fp_search_result_fn(fragpipe) == -1
+
+
+def test_stale_pins_are_removed_before_the_search(fragpipe, monkeypatch):
+    write_stale_pins(fragpipe['workdir'])
+    monkeypatch.setenv('FAKE_FRAGPIPE_WRITE', '0')
+    assert search_engine.generate_fp_search_result_fn(fragpipe) == -1
+    assert search_engine.find_pin_files(fragpipe['workdir']) == {}
+
+
+FAKE_SAGE = f"""#!{sys.executable}
+import json, os, sys
+config = json.load(open(sys.argv[1]))
+with open(os.path.join(config['output_directory'], 'invocations.log'), 'a') as log:
+    log.write(','.join(os.path.basename(path) for path in config['mzml_paths']) + '\\n')
+with open(os.path.join(config['output_directory'], 'results.sage.tsv'), 'w') as f:
+    f.write('peptide\\tfilename\\tscannr\\n')
+    for i in range(3):
+        for path in config['mzml_paths']:
+            f.write(f'PEPTIDE{{i}}\\t{{os.path.basename(path)}}\\t{{i}}\\n')
+"""
+
+
+@pytest.fixture
+def sage(tmp_path, monkeypatch):
+    exe = tmp_path / 'sage'
+    exe.write_text(FAKE_SAGE)
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(search_engine, 'sage_script', str(exe))
+    config = tmp_path / 'sage.json'
+    config.write_text('{"database": {"fasta": "user.fasta", "enzyme": {"missed_cleavages": 2}}}')
+    data_paths = []
+    for run in ('a', 'b'):
+        (tmp_path / f'{run}.mzML').write_text(run)
+        data_paths.append(str(tmp_path / f'{run}.mzML'))
+    (tmp_path / 'db.fasta').write_text('>p\nPEPTIDE\n')
+    return {'workdir': str(tmp_path / 'sage_out'), 'fasta': str(tmp_path / 'db.fasta'), 'data_paths': data_paths,
+            'config_path': str(config)}
+
+
+def invocations(workdir):
+    with open(os.path.join(workdir, 'invocations.log')) as f:
+        return f.read().split()
+
+
+def test_runs_are_searched_together_and_split(sage, tmp_path):
+    assert search_engine.generate_sage_search_result_fn(sage) == 0
+    assert invocations(sage['workdir']) == ['a.mzML,b.mzML']
+    for run in ('a', 'b'):
+        with open(search_engine.sage_output_path(sage['workdir'], str(tmp_path / f'{run}.mzML'))) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == 'peptide\tfilename\tscannr'
+        assert [line.split('\t')[1] for line in lines[1:]] == [f'{run}.mzML'] * 3
+    # the user's config is left as is and no run config stays behind
+    with open(sage['config_path']) as f:
+        assert 'mzml_paths' not in f.read()
+    assert not [name for name in os.listdir(sage['workdir']) if name.startswith('sage_config_')]
+
+
+def test_only_runs_without_a_valid_output_are_searched(sage, tmp_path):
+    assert search_engine.generate_sage_search_result_fn(sage) == 0
+    assert search_engine.generate_sage_search_result_fn(sage) == 1
+    (tmp_path / 'b.mzML').write_text('changed run')
+    assert search_engine.generate_sage_search_result_fn(sage) == 0
+    assert invocations(sage['workdir']) == ['a.mzML,b.mzML', 'b.mzML']
@@ -0,0 +1,51 @@
+import pyarrow as pa
+
+from benchmarks.synthetic import sage_columns
+from scripts import search_results
+
+
+def write_sage(path, rows):
+    with open(path, 'w') as f:
+        f.write('\t'.join(sage_columns) + '\n')
+        for i, (peptide, proteins, scannr, label, charge, q, *ion_mobility) in enumerate(rows):
+            f.write(f"{i}\t{peptide}\t{proteins}\t{scannr}\t{label}\t5\t0.001\t0.001\t{charge}\t0.5\t"
+                    f"{ion_mobility[0] if ion_mobility else ''}\t0.1\t0.9\t{q}\trun.mzML\n")
+
+
+def test_read_sage_results_filters_and_orders(tmp_path):
+    path = str(tmp_path / 'results.sage.tsv')
+    write_sage(path, [
+        ('PEPTIDEK', 'P1', 'scan=3', -1, 2, 0.5),   # decoy, kept whatever its q-value
+        ('PEPTIDER', 'P2', 'scan=1', 1, 3, 0.005),  # target
+        ('PEPTIDEKK', 'P3', 'scan=2', 1, 2, 0.02),  # target above the q-value cut
+        ('PEPK', 'P4', 'scan=4', 1, 2, 0.001),      # too short
+        ('PEPTIDEKR', 'P5', 'scan=5', 1, 6, 0.001), # charge out of range
+        ('PEPTIDEKM', 'P6', 'scan=6', 1, 4, 0.001),
+    ])
+    df = search_results.read_sage_results(path)
+    assert df['peptide'].tolist() == ['PEPTIDER', 'PEPTIDEKM', 'PEPTIDEK']
+    assert df['scannr'].tolist() == [1, 6, 3]
+    assert list(df.columns) == search_results.SAGE_COLUMNS
+    # single chunk columns, whatever pandas stores the strings as
+    for column in df.columns:
+        assert not isinstance(pa.array(df[column], from_pandas=True), pa.ChunkedArray), column
+
+
+def test_read_sage_results_types_do_not_depend_on_the_first_block(tmp_path, monkeypatch):
+    # numeric looking scans and proteins and no ion mobility in the first blocks, text and values further down
+    rows = [('PEPTIDEK', str(1000 + i), str(i + 1), 1, 2, 0.001) for i in range(2000)]
+    rows += [('PEPTIDER', 'sp|P1|PROT_HUMAN', 'controllerType=0 scan=9999', 1, 2, 0.001, 0.85)]
+    path = str(tmp_path / 'results.sage.tsv')
+    write_sage(path, rows)
+    monkeypatch.setattr(search_results, 'BLOCK_SIZE', 1 << 12)
+    df = search_results.read_sage_results(path)
+    assert len(df) == len(rows)
+    assert df['scannr'].iloc[-1] == 9999
+    assert df['proteins'].iloc[0] == '1000'
+    assert df['ion_mobility'].iloc[-1] == 0.85
+
+
+def test_read_pin_parses_charge(synthetic):
+    df = search_results.read_pin(synthetic['fragpipe'])
+    expected = [int(spec_id.split('.')[-1].split('_')[0]) for spec_id in df['SpecId']]
+    assert df['charge'].tolist() == expected
@@ -0,0 +1,75 @@
+import os
+import time
+
+from scripts import step_cache
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def test_cached_until_an_input_or_setting_changes(tmp_path):
+    source, output = str(tmp_path / 'in.tsv'), str(tmp_path / 'out.parquet')
+    write(source, 'a\n')
+    write(output, 'result')
+    key = step_cache.step_key([source], {'setting': 1})
+    step_cache.store(output, key)
+    assert step_cache.is_cached(output, step_cache.step_key([source], {'setting': 1}))
+    assert not step_cache.is_cached(output, step_cache.step_key([source], {'setting': 2}))
+    write(source, 'a changed input\n')
+    assert not step_cache.is_cached(output, step_cache.step_key([source], {'setting': 1}))
+
+
+def test_input_paths_are_not_part_of_the_key(tmp_path):
+    source = str(tmp_path / 'in.tsv')
+    write(source, 'a\n')
+    key = step_cache.step_key([source])
+    moved = str(tmp_path / 'moved.tsv')
+    os.rename(source, moved)
+    assert step_cache.step_key([moved]) == key
+    assert step_cache.step_key([source]) is None
+
+
+def test_relocated_outputs_stay_cached(tmp_path):
+    source, output = str(tmp_path / 'in.tsv'), str(tmp_path / 'out.parquet')
+    write(source, 'a\n')
+    write(output, 'result')
+    key = step_cache.step_key([source])
+    step_cache.store(output, key)
+    moved = str(tmp_path / 'archive' / 'out.parquet')
+    step_cache.relocate(output, moved)
+    assert step_cache.is_cached(moved, step_cache.step_key([source]))
+    assert not os.path.exists(output) and not os.path.exists(step_cache.manifest_path(output))
+
+
+def test_outputs_without_manifest_are_not_adopted_by_default(tmp_path):
+    source, output = str(tmp_path / 'in.tsv'), str(tmp_path / 'out.parquet')
+    write(source, 'a\n')
+    write(output, 'partial')
+    key = step_cache.step_key([source])
+    assert not step_cache.is_cached(output, key)
+    step_cache.configure({'adopt_existing': True})
+    assert step_cache.is_cached(output, key)
+    assert os.path.exists(step_cache.manifest_path(output))
+
+
+def test_a_changed_output_is_not_cached(tmp_path):
+    source, output = str(tmp_path / 'in.tsv'), str(tmp_path / 'out.parquet')
+    write(source, 'a\n')
+    write(output, 'result')
+    key = step_cache.step_key([source])
+    step_cache.store(output, key)
+    write(output, 'truncated')
+    assert not step_cache.is_cached(output, key)
+
+
+def test_fast_hash_sees_same_size_rewrites(tmp_path):
+    source = str(tmp_path / 'in.tsv')
+    write(source, 'abc\n')
+    step_cache.configure({'fast_hash': True})
+    key = step_cache.step_key([source])
+    stat = os.stat(source)
+    write(source, 'xyz\n')
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert step_cache.step_key([source]) != key
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from scripts import pipeline, telemetry
+
+
+def burn(seconds):
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+
+def test_cpu_time_includes_helper_threads(monkeypatch):
+    monkeypatch.setattr(telemetry, 'records', [])
+    step = telemetry.instrument('helpers', lambda _: pipeline.Background(burn, 0.2).result() or 0)
+    assert step(None) == 0
+    record, = telemetry.records
+    assert record['cpu_s'] >= 0.2
+    assert record['process_peak_rss_mb'] >= record['process_start_rss_mb'] > 0
+
+
+def test_cpu_time_leaves_out_other_steps(monkeypatch):
+    monkeypatch.setattr(telemetry, 'records', [])
+    busy = threading.Thread(target=telemetry.instrument('busy', lambda _: burn(0.3)), args=(None,))
+    busy.start()
+    telemetry.instrument('idle', lambda _: time.sleep(0.3))(None)
+    busy.join()
+    records = {record['name']: record for record in telemetry.records}
+    assert records['busy']['cpu_s'] >= 0.3
+    assert records['idle']['cpu_s'] < 0.1
+
+
+def test_background_writer_charges_its_step(monkeypatch):
+    monkeypatch.setattr(telemetry, 'records', [])
+
+    def write_all(_):
+        writer = pipeline.BackgroundWriter(lambda seconds: burn(seconds))
+        writer.put(0.2)
+        writer.close()
+        return 0
+
+    telemetry.instrument('writer', write_all)(None)
+    assert telemetry.records[0]['cpu_s'] >= 0.2
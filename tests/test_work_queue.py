@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from scripts import step_cache, work_queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_two_workers_convert_every_run_once(synthetic, tmp_path):
+    runs = [{'data_type': 'mzml', 'engine': 'sage', 'rawspectrum_path': synthetic['rawspectrum'],
+             'search_result_path': synthetic['sage'], 'output': str(tmp_path / f'run{i}.parquet')} for i in range(4)]
+    config_path = str(tmp_path / 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump({'generate_msdt': {'batch': {'runs': runs}},
+                   'work_queue': {'dir': str(tmp_path / 'queue'), 'poll_seconds': 0.2},
+                   'telemetry': {'report': str(tmp_path / 'report.json')}}, f)
+    workers = [subprocess.Popen([sys.executable, 'convert.py', f'-config={config_path}', '-worker'], cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) for _ in range(2)]
+    logs = [worker.communicate(timeout=300)[0] for worker in workers]
+    assert [worker.returncode for worker in workers] == [0, 0], logs
+    for run in runs:
+        # generated by exactly one worker, found done by the other
+        assert sum(log.count(f"[0] {run['output']}") for log in logs) == 1, logs
+        assert os.path.exists(step_cache.manifest_path(run['output']))
+    assert os.listdir(tmp_path / 'queue') == []
+
+
+def test_heartbeat_marks_a_broken_lease_lost(tmp_path, monkeypatch):
+    monkeypatch.setitem(work_queue.options, 'lease_seconds', 0.08)
+    # the lease file goes away between the ownership check and its renewal
+    monkeypatch.setattr(work_queue.Lease, '_owned', lambda self: True)
+    lease = work_queue.claim(str(tmp_path), 'run', 'me')
+    os.remove(lease.path)
+    lease._thread.join(timeout=5)
+    assert not lease._thread.is_alive()
+    assert lease.lost
+    lease.release()
+
+
+def test_a_run_whose_lease_was_taken_over_is_abandoned(tmp_path, monkeypatch):
+    monkeypatch.setitem(work_queue.options, 'lease_seconds', 3600)
+    queue_dir, output = str(tmp_path / 'queue'), str(tmp_path / 'run.parquet')
+    run = {'output': output}
+    key = work_queue.run_key(run)
+
+    def convert(run):
+        # another worker took the lease over while this one was converting
+        with open(os.path.join(queue_dir, key + work_queue.LEASE_SUFFIX), 'w') as f:
+            json.dump({'worker': 'other'}, f)
+        temp = step_cache.temp_path(output)
+        with open(temp, 'w') as f:
+            f.write('late result')
+        try:
+            step_cache.commit(temp, output)
+        finally:
+            step_cache.discard(temp)
+        return 0
+
+    assert work_queue.work([run], convert, queue_dir) == [-1]
+    assert not os.path.exists(output)
+    # not counted as a failed attempt, and the lease of the other worker stays
+    assert work_queue.attempts(queue_dir, key) == 0
+    assert os.listdir(queue_dir) == [key + work_queue.LEASE_SUFFIX]